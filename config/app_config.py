@@ -344,4 +344,153 @@ COMPUTE_EMB_CONFIG = {
                         --AND [index] NOT LIKE '%ADFD-%'
                         """
     }
-}
\ No newline at end of file
+}
+
+# Assumptions used by the extraction --plan dry run (utils/extraction_planner.py).
+# Token counts are estimated at ~4 characters per token; adjust prices/latency
+# to the model actually configured for the run.
+EXTRACTION_PLAN_CONFIG = {
+    "chars_per_token": 4,
+    # langextract splits inputs longer than max_char_buffer into separate calls
+    "max_char_buffer": 1000,
+    "completion_tokens_per_call": 350,
+    "avg_latency_s": 8.0,
+    "price_per_1m_input_tokens": 0.40,
+    "price_per_1m_output_tokens": 1.60,
+    "concurrency_levels": [1, 4, 8, 16],
+    "hash_workers": None,   # None -> os.cpu_count()
+}
+
+
+# Shared rate governor per model provider (utils/rate_governor.py).
+# rpm / tpm are the provider budgets; concurrency starts at
+# initial_concurrency and moves between min/max by AIMD on 429s / timeouts.
+RATE_GOVERNOR_CONFIG = {
+    "openai": {
+        "rpm": 500,
+        "tpm": 200_000,
+        "initial_concurrency": 4,
+        "min_concurrency": 1,
+        "max_concurrency": 16,
+        "max_retries": 6,
+        "base_backoff_s": 1.0,
+        "max_backoff_s": 60.0,
+    },
+    "ollama": {
+        "rpm": None,
+        "tpm": None,
+        "initial_concurrency": 1,
+        "min_concurrency": 1,
+        "max_concurrency": 2,
+        "max_retries": 3,
+        "base_backoff_s": 2.0,
+        "max_backoff_s": 30.0,
+    },
+}
+
+# Micro-batch daemon (src/1_microbatch_daemon.py). A row is new/changed when
+# its 1a fingerprint (utils/master_source.py: model text + amounts) differs
+# from silver.source_fingerprints; 1b stores it once the row is in silver.
+# Batches are sized from the measured rows/second so one batch finishes
+# within latency_target_s.
+MICROBATCH_CONFIG = {
+    "poll_s": 60,
+    "latency_target_s": 600,
+    "min_batch_rows": 20,
+    "max_batch_rows": 2000,
+    "initial_rows_per_s": 2.0,
+    "max_parallel_steps": 3,
+}
+
+# Where rows of deleted source indexes are removed (utils/source_fingerprints.py,
+# applied by 1b). project_code keys are looked up in project_code_source
+# before any delete runs.
+DELETION_PROPAGATION_CONFIG = {
+    "project_code_source": "silver.MasterTable_extracted",
+    "targets": [
+        {"table": "silver.cleaned_project_type", "key": "project_code"},
+        {"table": "silver.cleaned_project_asset_extracted", "key": "project_code"},
+        {"table": "silver.cleaned_project_beneficiary_group", "key": "project_code"},
+        {"table": "silver.cleaned_project_attributes", "key": "index"},
+        {"table": "silver.master_project_embeddings", "key": "index"},
+        {"table": "silver.project_embeddings", "key": "index"},
+        {"table": "silver.cleaned_master_project", "key": "index"},
+        {"table": "silver.cleaned_project", "key": "index"},
+        {"table": "silver.cleaned_project_asset", "key": "index"},
+        {"table": "silver.MasterTable_extracted", "key": "index"},
+    ],
+}
+
+# DataFrame writes to SQL (utils/bulk_writer.py). "auto" picks bcp for frames
+# of at least bcp_min_rows when the bcp CLI is on PATH and the target is SQL
+# Server, else fast_executemany batches of batch_rows. workers > 1 loads
+# partitions over that many pooled connections (appends only, not atomic).
+BULK_WRITE_CONFIG = {
+    "method": "auto",
+    "batch_rows": 10000,
+    "workers": 1,
+    "bcp_min_rows": 200000,
+    "bcp_path": "bcp",
+    "bcp_extra_args": [],
+    # False: '' loads as '' (like to_sql); True: as NULL
+    "bcp_empty_as_null": False,
+    "tmp_dir": "data/tmp/bcp",
+}
+
+# Database engine (utils/db.py). Every key can be overridden with the
+# environment variable DB_<KEY> (e.g. DB_BACKEND=sqlite, DB_SERVER=...).
+# backend "sqlite" / "duckdb" run against local files at `path` with the
+# same schemas, for offline runs and benchmarks.
+DB_CONFIG = {
+    "backend": "mssql",
+    "driver": "ODBC Driver 17 for SQL Server",
+    "server": "SREESPOORTHY\\SQLEXPRESS01",
+    "database": "ForeignAidDatabase_2019",
+    "uid": "",
+    "pwd": "",
+    "trusted_connection": "yes",
+    "trust_server_certificate": "yes",
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_recycle_s": 1800,
+    "pool_pre_ping": True,
+    "fast_executemany": True,
+    "path": "data/local_db/ForeignAidDatabase_2019",
+    "schemas": ["dbo", "silver", "ollama"],
+}
+
+# Local columnar snapshot of the master table (utils/master_snapshot.py).
+# `columns` are kept in <dir>/<table>_<marker>.parquet; the marker is row
+# count + CHECKSUM_AGG(BINARY_CHECKSUM), or + MAX(rowversion_column) when
+# set, so an unchanged table is never transferred again and a changed one
+# only sends (key, row hash) pairs plus its changed rows. key_column
+# identifies rows for that refresh. Source queries reading this table run
+# in-process with DuckDB; the other tables they join are pulled first.
+MASTER_SNAPSHOT_CONFIG = {
+    "enabled": True,
+    "table": "dbo.MasterTableDenormalizedCleanedFinal",
+    "key_column": "index",
+    "rowversion_column": None,
+    "columns": [
+        "index",
+        "SourceID",
+        "year",
+        "ProjectTitleEnglish",
+        "DescriptionEnglish",
+        "ProjectTitleArabic",
+        "DescriptionArabic",
+        "Amount",
+        "ODA_Amount",
+        "GE_Amount",
+        "OFF_Amount",
+        "CountryNameEnglish",
+        "DonorNameEnglish",
+        "ImplementingOrganizationEnglish",
+        "SubSectorNameEnglish",
+        "EmergencyTitle",
+        "EmergencyTitleAR",
+    ],
+    "dir": "data/snapshots",
+    "chunksize": 50000,
+    "keep": 2,
+}
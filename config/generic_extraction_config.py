@@ -19,6 +19,12 @@ GENERIC_CONFIG = {
             "index_key": "project_code",
             "upstream_filter_column": "index",
             "checkpoint_every": 50,
+            # projects packed per model call in 1c (1 = one call per project;
+            # packing is opt-in, e.g. --batch-size 8)
+            "batch_size": 1,
+            "batch_max_chars": 6000,
+            # a packed project with fewer extractions is re-run alone (one per asset_* class)
+            "min_extractions_per_doc": 5,
             "force_refresh_supported": True,
             "use_schema_constraints": False,
             "model_id": "gpt-4.1-mini",
@@ -204,6 +210,12 @@ Return EXACTLY 5 extractions, in this order:
             "index_key": "project_code",
             "upstream_filter_column": "index",
             "checkpoint_every": 50,
+            # projects packed per model call in 1c (1 = one call per project;
+            # packing is opt-in, e.g. --batch-size 8)
+            "batch_size": 1,
+            "batch_max_chars": 6000,
+            # a packed project with fewer extractions is re-run alone (group + count)
+            "min_extractions_per_doc": 2,
             "force_refresh_supported": True,
             "use_schema_constraints": False,
             "model_id": "gpt-4.1-mini",
@@ -318,6 +330,12 @@ Return EXACTLY 2 extractions, in this order:
             "index_key": "project_code",
             "upstream_filter_column": "index",
             "checkpoint_every": 50,
+            # projects packed per model call in 1c (1 = one call per project;
+            # packing is opt-in, e.g. --batch-size 8)
+            "batch_size": 1,
+            "batch_max_chars": 6000,
+            # a packed project with fewer extractions is re-run alone
+            "min_extractions_per_doc": 1,
             "force_refresh_supported": True,
             "use_schema_constraints": False,
             "model_id": "gpt-4.1-mini",
@@ -423,6 +441,10 @@ Return a single extraction with:
             "output_csv_suffix": "project_type.csv",
             "target_table": "silver.cleaned_project_type",
             "primary_key": "project_code",
+            # 1b builds cleaned_project / cleaned_project_asset with a LEFT JOIN
+            # on this table before 1d has written it: refresh their rows for
+            # the upserted project codes afterwards
+            "refresh_dependent_silver": True,
 
             "output_columns": [
                 "project_code",
@@ -1,9 +1,14 @@
 import argparse
-import subprocess
 import sys
 from datetime import datetime
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.pipeline_runner import run_pipeline, shared_engine
+from utils.run_manifest import RunManifest, fingerprint_parts
+from utils.db import get_engine
+
 
 # =========================================================
 # HELPERS
@@ -16,25 +21,6 @@ def generate_run_id() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
-def run_step(step_name: str, cmd: list[str]) -> None:
-    """
-    Run one pipeline step and stop the pipeline if it fails.
-    """
-    print("\n" + "=" * 80)
-    print(f"[PIPELINE] Starting: {step_name}")
-    print("[PIPELINE] Command:", " ".join(cmd))
-    print("=" * 80)
-
-    result = subprocess.run(cmd, check=False)
-
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"Step failed: {step_name} | returncode={result.returncode}"
-        )
-
-    print(f"[PIPELINE] Completed: {step_name}")
-
-
 # =========================================================
 # ARGS
 # =========================================================
@@ -51,16 +37,73 @@ parser.add_argument(
     action="store_true",
     help="If set, pass --force-refresh to extraction steps.",
 )
+parser.add_argument(
+    "--full-refresh",
+    action="store_true",
+    help="Pass --full-refresh to 1b: rebuild the cleaned_* silver tables instead of refreshing this run's indexes.",
+)
+parser.add_argument(
+    "--separate-entity-calls",
+    action="store_true",
+    help="Run 1c once per entity (one model call per entity per project) instead of the combined 1c step.",
+)
+parser.add_argument(
+    "--max-parallel",
+    type=int,
+    default=3,
+    help="Max pipeline steps running at the same time (independent steps only).",
+)
+parser.add_argument(
+    "--force-step",
+    nargs="+",
+    default=[],
+    help=(
+        "Rerun these steps even if their inputs are unchanged. Step name or prefix "
+        "(e.g. 1b, 1d_generic_post_processing [asset]) or 'all'."
+    ),
+)
+parser.add_argument(
+    "--subprocess",
+    action="store_true",
+    help="Run every step in its own Python process (old behaviour) instead of in-process.",
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help=(
+        "Overlap 1a, 1b and combined 1c: documents and projects flow through bounded in-memory "
+        "queues as they are written, instead of each step waiting for the previous one."
+    ),
+)
+parser.add_argument(
+    "--stream-queue-size",
+    type=int,
+    default=256,
+    help="--stream: max items waiting between two steps; a full queue pauses the upstream step.",
+)
 
 args = parser.parse_args()
 
 RUN_ID = args.run_id.strip() if args.run_id else generate_run_id()
 FORCE_REFRESH = args.force_refresh
+SEPARATE_ENTITY_CALLS = args.separate_entity_calls
+MAX_PARALLEL = args.max_parallel
+IN_PROCESS = not args.subprocess
+STREAM = args.stream
+# --force-refresh asks for fresh extraction, so nothing may be skipped
+FORCE_STEPS = ["all"] if FORCE_REFRESH else args.force_step
 
 print(f"[PIPELINE] RUN_ID = {RUN_ID}")
 print(f"[PIPELINE] FORCE_REFRESH = {FORCE_REFRESH}")
+print(f"[PIPELINE] MODE = {'in-process' if IN_PROCESS else 'subprocess'} | MAX_PARALLEL = {MAX_PARALLEL}")
+print(f"[PIPELINE] FORCE_STEPS = {FORCE_STEPS}")
 
-PYTHON_EXE = sys.executable
+if STREAM and (not IN_PROCESS or SEPARATE_ENTITY_CALLS):
+    raise ValueError("--stream runs in-process with the combined 1c step; drop --subprocess / --separate-entity-calls")
+if STREAM:
+    # 1a, 1b and 1c all run at once
+    MAX_PARALLEL = max(MAX_PARALLEL, 3)
+    print(f"[PIPELINE] STREAM = True | queue size = {args.stream_queue_size} | MAX_PARALLEL = {MAX_PARALLEL}")
 
 BASE_DIR = Path(__file__).resolve().parent
 PROJECT_ROOT = BASE_DIR.parent
@@ -68,19 +111,90 @@ PROJECT_ROOT = BASE_DIR.parent
 STEP_1A = BASE_DIR / "1a_data_extraction.py"
 STEP_1B = BASE_DIR / "1b_post_processing.py"
 STEP_1C = BASE_DIR / "1c_generic_extraction.py"
+STEP_1C_COMBINED = BASE_DIR / "1c_combined_extraction.py"
 STEP_1D = BASE_DIR / "1d_generic_post_processing.py"
 
-for step_file in [STEP_1A, STEP_1B, STEP_1C, STEP_1D]:
+# one combined 1c call per project for all entities, then 1d per entity
+ENTITIES = ["project_type", "asset", "beneficiary_group"]
+
+for step_file in [STEP_1A, STEP_1B, STEP_1C, STEP_1C_COMBINED, STEP_1D]:
     if not step_file.exists():
         raise FileNotFoundError(f"Missing pipeline file: {step_file}")
 
-UPSTREAM_IDS_FILE = PROJECT_ROOT / "data" / "outputs" / RUN_ID / f"{RUN_ID}_processed_indexes.txt"
+RUN_OUTPUT_DIR = PROJECT_ROOT / "data" / "outputs" / RUN_ID
+UPSTREAM_IDS_FILE = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
+TIMINGS_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_pipeline_timings.json"
+MANIFEST_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_run_manifest.json"
+
+OUT_1A_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.jsonl"
+OUT_1B_CSV = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction.csv"
+OUT_1B_PROJECT_CODES = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_project_codes.txt"
+
+CONFIG_DIR = PROJECT_ROOT / "config"
+UTILS_DIR = PROJECT_ROOT / "utils"
+GENERIC_CONFIG_FILE = CONFIG_DIR / "generic_extraction_config.py"
+
+
+def entity_jsonl(entity: str) -> Path:
+    # "<run>_<entity>_extraction.jsonl" (output_jsonl_suffix in generic_extraction_config.py)
+    return RUN_OUTPUT_DIR / f"{RUN_ID}_{entity}_extraction.jsonl"
 
 
-def build_1c_cmd(entity: str) -> list[str]:
-    cmd = [
-        PYTHON_EXE,
-        str(STEP_1C),
+# =========================================================
+# STEP FINGERPRINTS (inputs that decide whether a step must rerun)
+# =========================================================
+def fingerprint_1a(argv: list[str]):
+    return lambda: fingerprint_parts(
+        engine=shared_engine(get_engine),
+        tables=["dbo.MasterTableDenormalizedCleanedFinal"],
+        files=[STEP_1A, CONFIG_DIR / "prompt.py", *sorted((CONFIG_DIR / "examples").glob("*.py"))],
+        values={"argv": argv},
+    )
+
+
+def fingerprint_1b(argv: list[str]):
+    return lambda: fingerprint_parts(
+        files=[
+            OUT_1A_JSONL,
+            UPSTREAM_IDS_FILE,
+            STEP_1B,
+            UTILS_DIR / "post_processing_sql_queries.py",
+            UTILS_DIR / "post_processing_helpers.py",
+        ],
+        values={"argv": argv},
+    )
+
+
+def fingerprint_1c(script: Path, argv: list[str]):
+    return lambda: fingerprint_parts(
+        engine=shared_engine(get_engine),
+        tables=["silver.cleaned_project"],
+        files=[
+            UPSTREAM_IDS_FILE,
+            script,
+            GENERIC_CONFIG_FILE,
+            UTILS_DIR / "generic_extraction.py",
+            UTILS_DIR / "batch_packing.py",
+        ],
+        values={"argv": argv},
+    )
+
+
+def fingerprint_1d(entity: str, argv: list[str]):
+    return lambda: fingerprint_parts(
+        files=[
+            entity_jsonl(entity),
+            UPSTREAM_IDS_FILE,
+            STEP_1D,
+            GENERIC_CONFIG_FILE,
+            UTILS_DIR / "post_processing_helpers.py",
+        ],
+        values={"argv": argv},
+    )
+
+
+def build_1c_argv(entity: str) -> list[str]:
+    argv = [
         "--entity",
         entity,
         "--run-id",
@@ -90,14 +204,26 @@ def build_1c_cmd(entity: str) -> list[str]:
         "--use-main-source-query",
     ]
     if FORCE_REFRESH:
-        cmd.append("--force-refresh")
-    return cmd
+        argv.append("--force-refresh")
+    return argv
+
+
+def build_1c_combined_argv(entities: list[str]) -> list[str]:
+    argv = [
+        "--entities",
+        ",".join(entities),
+        "--run-id",
+        RUN_ID,
+        "--upstream-ids-file",
+        str(UPSTREAM_IDS_FILE),
+    ]
+    if FORCE_REFRESH:
+        argv.append("--force-refresh")
+    return argv
 
 
-def build_1d_cmd(entity: str) -> list[str]:
+def build_1d_argv(entity: str) -> list[str]:
     return [
-        PYTHON_EXE,
-        str(STEP_1D),
         "--entity",
         entity,
         "--run-id",
@@ -107,56 +233,150 @@ def build_1d_cmd(entity: str) -> list[str]:
     ]
 
 
+def build_stream_steps() -> list[dict]:
+    """
+    1a, 1b and combined 1c start together and hand over work through the
+    '1a_docs' / '1b_projects' streams; the 1d steps wait for all three.
+    Streaming steps are not fingerprinted: a skipped producer would leave
+    its consumer with an empty stream.
+    """
+    argv_1a = ["--run-id", RUN_ID, "--stream"]
+    argv_1c = ["--entities", ",".join(ENTITIES), "--run-id", RUN_ID, "--stream"]
+    if FORCE_REFRESH:
+        argv_1a.append("--force-refresh")
+        argv_1c.append("--force-refresh")
+
+    step_1c = f"1c_combined_extraction [{', '.join(ENTITIES)}]"
+    steps = [
+        {
+            "name": "1a_data_extraction",
+            "script": STEP_1A,
+            "argv": argv_1a,
+            "deps": [],
+            "streams": ["1a_docs"],
+        },
+        {
+            "name": "1b_post_processing",
+            "script": STEP_1B,
+            "argv": ["--run-id", RUN_ID, "--stream", *(["--full-refresh"] if args.full_refresh else [])],
+            "deps": [],
+            "consumes": ["1a_docs"],
+            "streams": ["1b_projects"],
+        },
+        {
+            "name": step_1c,
+            "script": STEP_1C_COMBINED,
+            "argv": argv_1c,
+            "deps": [],
+            "consumes": ["1b_projects"],
+        },
+    ]
+    for entity in ENTITIES:
+        steps.append({
+            "name": f"1d_generic_post_processing [{entity}]",
+            "script": STEP_1D,
+            "argv": build_1d_argv(entity),
+            "deps": ["1a_data_extraction", "1b_post_processing", step_1c],
+        })
+    return steps
+
+
+def build_steps() -> list[dict]:
+    argv_1a = ["--run-id", RUN_ID]
+    if FORCE_REFRESH:
+        argv_1a.append("--force-refresh")
+
+    argv_1b = ["--run-id", RUN_ID]
+    if args.full_refresh:
+        argv_1b.append("--full-refresh")
+
+    steps = [
+        {
+            "name": "1a_data_extraction",
+            "script": STEP_1A,
+            "argv": argv_1a,
+            "deps": [],
+            "fingerprint": fingerprint_1a(argv_1a),
+            "outputs": [OUT_1A_JSONL, UPSTREAM_IDS_FILE],
+        },
+        {
+            "name": "1b_post_processing",
+            "script": STEP_1B,
+            "argv": argv_1b,
+            "deps": ["1a_data_extraction"],
+            "fingerprint": fingerprint_1b(argv_1b),
+            "outputs": [OUT_1B_CSV, OUT_1B_PROJECT_CODES],
+        },
+    ]
+
+    if SEPARATE_ENTITY_CALLS:
+        # independent 1c -> 1d chain per entity
+        for entity in ENTITIES:
+            argv_1c = build_1c_argv(entity)
+            argv_1d = build_1d_argv(entity)
+            steps.append({
+                "name": f"1c_generic_extraction [{entity}]",
+                "script": STEP_1C,
+                "argv": argv_1c,
+                "deps": ["1b_post_processing"],
+                "fingerprint": fingerprint_1c(STEP_1C, argv_1c),
+                "outputs": [entity_jsonl(entity)],
+            })
+            steps.append({
+                "name": f"1d_generic_post_processing [{entity}]",
+                "script": STEP_1D,
+                "argv": argv_1d,
+                "deps": [f"1c_generic_extraction [{entity}]"],
+                "fingerprint": fingerprint_1d(entity, argv_1d),
+            })
+    else:
+        step_1c = f"1c_combined_extraction [{', '.join(ENTITIES)}]"
+        argv_1c = build_1c_combined_argv(ENTITIES)
+        steps.append({
+            "name": step_1c,
+            "script": STEP_1C_COMBINED,
+            "argv": argv_1c,
+            "deps": ["1b_post_processing"],
+            "fingerprint": fingerprint_1c(STEP_1C_COMBINED, argv_1c),
+            "outputs": [entity_jsonl(e) for e in ENTITIES],
+        })
+        for entity in ENTITIES:
+            argv_1d = build_1d_argv(entity)
+            steps.append({
+                "name": f"1d_generic_post_processing [{entity}]",
+                "script": STEP_1D,
+                "argv": argv_1d,
+                "deps": [step_1c],
+                "fingerprint": fingerprint_1d(entity, argv_1d),
+            })
+
+    return steps
+
+
 # =========================================================
-# PIPELINE ORDER
-# 1.a
-# 1.b
-# 1.c project_type
-# 1.d project_type
-# 1.c asset
-# 1.d asset
-# 1.c beneficiary_group
-# 1.d beneficiary_group
+# PIPELINE DAG
+# (a step whose input fingerprint matches <run>_run_manifest.json is skipped)
+# 1.a -> 1.b -> 1.c combined (project_type + asset + beneficiary_group)
+#                 -> 1.d project_type | 1.d asset | 1.d beneficiary_group   (parallel)
+#
+# with --separate-entity-calls:
+# 1.a -> 1.b -> 1.c project_type      -> 1.d project_type        (parallel
+#             -> 1.c asset             -> 1.d asset                chains)
+#             -> 1.c beneficiary_group -> 1.d beneficiary_group
+#
+# with --stream:
+# 1.a ==docs==> 1.b ==projects==> 1.c combined   (running at the same time)
+#                                   -> 1.d project_type | asset | beneficiary_group
 # =========================================================
 try:
-    # -------------------------
-    # 1.a
-    # -------------------------
-    cmd_1a = [PYTHON_EXE, str(STEP_1A), "--run-id", RUN_ID]
-    if FORCE_REFRESH:
-        cmd_1a.append("--force-refresh")
-    run_step("1a_data_extraction", cmd_1a)
-
-    # -------------------------
-    # 1.b
-    # -------------------------
-    cmd_1b = [PYTHON_EXE, str(STEP_1B), "--run-id", RUN_ID]
-    run_step("1b_post_processing", cmd_1b)
-
-    if not UPSTREAM_IDS_FILE.exists():
-        raise FileNotFoundError(
-            f"Missing upstream processed indexes file from previous step: {UPSTREAM_IDS_FILE}"
-        )
-
-    print(f"[PIPELINE] Upstream indexes file = {UPSTREAM_IDS_FILE}")
-
-    # -------------------------
-    # project_type
-    # -------------------------
-    run_step("1c_generic_extraction [project_type]", build_1c_cmd("project_type"))
-    run_step("1d_generic_post_processing [project_type]", build_1d_cmd("project_type"))
-
-    # -------------------------
-    # asset
-    # -------------------------
-    run_step("1c_generic_extraction [asset]", build_1c_cmd("asset"))
-    run_step("1d_generic_post_processing [asset]", build_1d_cmd("asset"))
-
-    # -------------------------
-    # beneficiary_group
-    # -------------------------
-    run_step("1c_generic_extraction [beneficiary_group]", build_1c_cmd("beneficiary_group"))
-    run_step("1d_generic_post_processing [beneficiary_group]", build_1d_cmd("beneficiary_group"))
+    run_pipeline(
+        build_stream_steps() if STREAM else build_steps(),
+        max_workers=MAX_PARALLEL,
+        in_process=IN_PROCESS,
+        timings_path=TIMINGS_JSON,
+        manifest=None if STREAM else RunManifest(MANIFEST_JSON, force_steps=FORCE_STEPS),
+        stream_maxsize=args.stream_queue_size,
+    )
 
     print("\n" + "=" * 80)
     print("[PIPELINE] ALL STEPS COMPLETED SUCCESSFULLY")
@@ -169,4 +389,4 @@ except Exception as e:
     print(f"[PIPELINE] RUN_ID: {RUN_ID}")
     print(f"[PIPELINE] ERROR: {e}")
     print("=" * 80)
-    sys.exit(1)
\ No newline at end of file
+    sys.exit(1)
@@ -0,0 +1,219 @@
+import argparse
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import MICROBATCH_CONFIG as CONFIG
+from utils.master_source import FINGERPRINT_STAGE, source_fingerprints, prompt_version
+from utils.pipeline_runner import run_pipeline, write_ids_txt
+from utils.source_fingerprints import (
+    count_fingerprints,
+    commit_fingerprints,
+    diff_fingerprints,
+    forget_fingerprints,
+    propagate_deletions,
+)
+from utils.db import get_engine
+
+
+# =========================================================
+# HELPERS
+# =========================================================
+def generate_run_id() -> str:
+    """
+    Format: mb_<date_time>
+    Example: mb_20260311_143205
+    """
+    return datetime.now().strftime("mb_%Y%m%d_%H%M%S")
+
+
+# =========================================================
+# ARGS
+# =========================================================
+parser = argparse.ArgumentParser(
+    description=(
+        "Long-running micro-batch mode: poll MasterTable for new/changed/deleted rows "
+        "(against the 1a rows in silver.source_fingerprints) and push them through "
+        "1a -> 1b -> 1c -> 1d and 3a."
+    )
+)
+parser.add_argument("--poll-s", type=float, default=CONFIG["poll_s"], help="Seconds between polls when there is no backlog.")
+parser.add_argument(
+    "--latency-target-s",
+    type=float,
+    default=CONFIG["latency_target_s"],
+    help="Target wall time of one micro-batch; batch size is derived from measured throughput.",
+)
+parser.add_argument("--max-batch-rows", type=int, default=CONFIG["max_batch_rows"])
+parser.add_argument("--once", action="store_true", help="Run one poll (and at most one batch), then exit.")
+parser.add_argument(
+    "--process-existing",
+    action="store_true",
+    help="With no 1a fingerprints yet, process every row instead of taking the current table as the baseline.",
+)
+
+args = parser.parse_args()
+
+POLL_S = args.poll_s
+LATENCY_TARGET_S = args.latency_target_s
+MIN_BATCH_ROWS = CONFIG["min_batch_rows"]
+MAX_BATCH_ROWS = max(MIN_BATCH_ROWS, args.max_batch_rows)
+
+BASE_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = BASE_DIR.parent
+
+STEP_1A = BASE_DIR / "1a_data_extraction.py"
+STEP_1B = BASE_DIR / "1b_post_processing.py"
+STEP_1C_COMBINED = BASE_DIR / "1c_combined_extraction.py"
+STEP_1D = BASE_DIR / "1d_generic_post_processing.py"
+STEP_3A = BASE_DIR / "3a_compute_embeddings.py"
+
+ENTITIES = ["project_type", "asset", "beneficiary_group"]
+
+print(f"[DAEMON] POLL_S = {POLL_S} | LATENCY_TARGET_S = {LATENCY_TARGET_S} | MAX_BATCH_ROWS = {MAX_BATCH_ROWS}")
+
+engine = get_engine()
+PROMPT_VERSION = prompt_version()
+
+
+# =========================================================
+# ONE MICRO-BATCH
+# =========================================================
+def build_batch_steps(run_id: str, ids_file: Path) -> list[dict]:
+    run_dir = PROJECT_ROOT / "data" / "outputs" / run_id
+    upstream_ids = run_dir / f"{run_id}_processed_indexes.txt"
+
+    steps = [
+        {"name": "1a_data_extraction", "script": STEP_1A,
+         "argv": ["--run-id", run_id, "--ids-file", str(ids_file)], "deps": []},
+        {"name": "1b_post_processing", "script": STEP_1B,
+         "argv": ["--run-id", run_id], "deps": ["1a_data_extraction"]},
+        {"name": "1c_combined_extraction", "script": STEP_1C_COMBINED,
+         "argv": ["--entities", ",".join(ENTITIES), "--run-id", run_id, "--upstream-ids-file", str(upstream_ids)],
+         "deps": ["1b_post_processing"]},
+    ]
+    for entity in ENTITIES:
+        steps.append({
+            "name": f"1d_generic_post_processing [{entity}]",
+            "script": STEP_1D,
+            "argv": ["--entity", entity, "--run-id", run_id, "--upstream-ids-file", str(upstream_ids)],
+            "deps": ["1c_combined_extraction"],
+        })
+    # embedding refresh for the batch; 3a reads the silver tables 1b writes
+    for mode in ["master projects", "projects"]:
+        steps.append({
+            "name": f"3a_compute_embeddings [{mode}]",
+            "script": STEP_3A,
+            "argv": ["--source-mode", mode, "--ids-file", str(upstream_ids)],
+            "deps": ["1b_post_processing"],
+        })
+    return steps
+
+
+def run_batch(keys: list[str]) -> float:
+    """
+    Push `keys` through the pipeline under a fresh run id; returns wall
+    seconds. 1b stores the fingerprints of the rows that reached silver, so
+    anything the batch did not finish is polled again.
+    """
+    run_id = generate_run_id()
+    run_dir = PROJECT_ROOT / "data" / "outputs" / run_id
+    run_dir.mkdir(parents=True, exist_ok=True)
+
+    ids_file = run_dir / f"{run_id}_source_ids.txt"
+    write_ids_txt(ids_file, keys)
+
+    print(f"\n[DAEMON] Batch {run_id}: {len(keys)} rows")
+    t0 = time.perf_counter()
+    run_pipeline(
+        build_batch_steps(run_id, ids_file),
+        max_workers=CONFIG["max_parallel_steps"],
+        timings_path=run_dir / f"{run_id}_pipeline_timings.json",
+    )
+    return time.perf_counter() - t0
+
+
+def apply_deletions(indexes: list[str]):
+    """Remove deleted source rows from silver and forget their fingerprints, in one transaction."""
+    with engine.begin() as conn:
+        deleted = propagate_deletions(conn, indexes)
+        forget_fingerprints(conn, FINGERPRINT_STAGE, indexes)
+    print(f"[DAEMON] Deleted {len(indexes)} source rows: " + ", ".join(f"{t}={n}" for t, n in deleted.items()))
+
+
+# =========================================================
+# LOOP
+# =========================================================
+rows_per_s = CONFIG["initial_rows_per_s"]
+first_seen = {}
+
+try:
+    while True:
+        t_poll = time.perf_counter()
+        # same fingerprints as 1a; 1b stores them once a batch's rows are in silver
+        current = source_fingerprints(engine)
+
+        if count_fingerprints(engine, FINGERPRINT_STAGE) == 0 and not args.process_existing:
+            commit_fingerprints(engine, FINGERPRINT_STAGE, current, PROMPT_VERSION)
+            print(f"[DAEMON] No 1a fingerprints: took current table as baseline ({len(current)} rows)")
+            if args.once:
+                break
+            time.sleep(POLL_S)
+            continue
+
+        new, changed, deleted = diff_fingerprints(engine, FINGERPRINT_STAGE, current, PROMPT_VERSION)
+        pending = new + changed
+        now = time.time()
+        for k in pending:
+            first_seen.setdefault(k, now)
+        for k in set(first_seen) - set(pending):
+            del first_seen[k]
+
+        print(
+            f"[DAEMON] poll in {time.perf_counter() - t_poll:.1f}s | rows={len(current)} "
+            f"| new={len(new)} | changed={len(changed)} | deleted={len(deleted)}"
+        )
+
+        if deleted:
+            apply_deletions(deleted)
+
+        backlog = 0
+        if pending:
+            # size the batch so it completes within the latency target at the measured rate
+            batch_rows = int(min(MAX_BATCH_ROWS, max(MIN_BATCH_ROWS, rows_per_s * LATENCY_TARGET_S)))
+            batch = sorted(pending, key=lambda k: (first_seen[k], k))[:batch_rows]
+            oldest_lag = now - first_seen[batch[0]]
+
+            try:
+                seconds = run_batch(batch)
+            except Exception as e:
+                # nothing committed: the same rows come back on the next poll
+                print(f"[DAEMON] Batch failed: {e}")
+                if args.once:
+                    sys.exit(1)
+                time.sleep(POLL_S)
+                continue
+
+            backlog = len(pending) - len(batch)
+            measured = len(batch) / max(seconds, 1e-6)
+            rows_per_s = 0.5 * rows_per_s + 0.5 * measured
+            print(
+                f"[DAEMON] Batch done: rows={len(batch)} in {seconds:.1f}s ({measured:.2f} rows/s) "
+                f"| oldest row waited {oldest_lag:.0f}s | backlog={backlog}"
+            )
+            if seconds > LATENCY_TARGET_S:
+                print(f"[DAEMON] Batch exceeded latency target ({seconds:.0f}s > {LATENCY_TARGET_S:.0f}s); shrinking batches")
+
+        if args.once:
+            break
+
+        # keep draining without sleeping while there is a backlog
+        if backlog == 0:
+            time.sleep(POLL_S)
+
+except KeyboardInterrupt:
+    print("\n[DAEMON] Stopped")
@@ -7,31 +7,43 @@ logging.getLogger("absl").setLevel(logging.ERROR)
 import sys
 import os
 import argparse
+import subprocess
+import time
 from pathlib import Path
-from sqlalchemy import create_engine
-import urllib
 
 import pandas as pd
 import langextract as lx
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from config.examples.infrastructure_projects import EXAMPLES as INFRA_EXAMPLES
-from config.examples.distribution_projects import EXAMPLES as DIST_EXAMPLES
-from config.examples.service_projects import EXAMPLES as SERV_EXAMPLES
 from config.prompt import PROMPT
 
 from utils.extraction_helpers import (
     text_hash,
-    load_cache,
-    save_cache,
     annotated_to_dict,
     jsonl_upsert_by_index,
-    load_processed_indexes_from_jsonl,
+    get_jsonl_writer,
+    compact_jsonl,
     jsonl_to_json_snapshot,
-    safe_str,
-    build_labeled_bilingual_input,
+    bounded_ordered_map,
+    merge_jsonl_shards,
+    iter_jsonl_latest,
 )
+from utils.master_source import (
+    EXAMPLES,
+    MODEL_ID,
+    LLM_NAMESPACE,
+    FINGERPRINT_STAGE,
+    iter_source_rows,
+    row_fingerprint,
+)
+from utils.extraction_cache import open_run_cache, open_llm_cache
+from utils.extraction_planner import plan_extraction, print_plan, estimate_tokens, prompt_overhead_tokens
+from utils.rate_governor import get_governor
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt, write_ids_txt, get_stream
+from utils.work_queue import WorkQueue, LeaseHeartbeat, default_worker_id
+from utils.source_fingerprints import diff_fingerprints, commit_fingerprints, write_pending_fingerprints
+from utils.db import get_engine
 
 # -----------------------
 # args + output paths
@@ -43,50 +55,104 @@ parser.add_argument(
     action="store_true",
     help="If set, bypass cache reads and re-run extraction even if index exists in cache."
 )
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="Dry run: report skips, cache hits, fresh calls, tokens, cost and wall time, then exit. No model calls."
+)
+parser.add_argument(
+    "--max-in-flight",
+    type=int,
+    default=1,
+    help="Max model requests kept outstanding at once. 1 = sequential (default)."
+)
+parser.add_argument(
+    "--ids-file",
+    default=None,
+    help="Only extract the indexes listed in this txt file (one per line), e.g. a micro-batch of new/changed rows.",
+)
+parser.add_argument(
+    "--role",
+    choices=["single", "coordinator", "worker"],
+    default="single",
+    help=(
+        "single: one process (default). coordinator: queue pending texts, start --workers local "
+        "worker processes, wait, merge worker shards. worker: lease and extract queued texts "
+        "(start more on other hosts sharing data/outputs with the same --run-id)."
+    ),
+)
+parser.add_argument("--workers", type=int, default=2, help="Coordinator: local worker processes to start (0 = external only).")
+parser.add_argument("--worker-id", default=None, help="Worker: id used for leases and the shard file (default host-pid).")
+parser.add_argument("--lease-s", type=float, default=900, help="Worker: lease duration, renewed every lease_s/3 while the worker runs; a lease not renewed for this long is retried elsewhere.")
+parser.add_argument(
+    "--no-fingerprints",
+    action="store_true",
+    help=(
+        "Ignore silver.source_fingerprints and only skip indexes already in this run's JSONL (old behaviour: "
+        "a fresh --run-id extracts every row). With fingerprints a fresh --run-id only extracts rows that are "
+        "new or changed since they last reached silver; --force-refresh redoes every row."
+    ),
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Also put every written document on the pipeline stream '1a_docs' for 1b --stream (1_main.py --stream).",
+)
 
-args = parser.parse_args()
+args = parser.parse_args(step_argv())
 
 RUN_ID = args.run_id
 FORCE_REFRESH = args.force_refresh
+MAX_IN_FLIGHT = max(1, args.max_in_flight)
+PLAN_ONLY = args.plan
+ROLE = args.role
+WORKER_ID = args.worker_id or default_worker_id()
+WORKERS = max(0, args.workers)
+LEASE_S = args.lease_s
+IDS_FILE = Path(args.ids_file) if args.ids_file else None
+# workers only process what the coordinator queued; it owns the fingerprints
+FINGERPRINTS_ON = not args.no_fingerprints and ROLE != "worker"
+
+if args.stream and ROLE != "single":
+    raise ValueError("--stream needs --role single: worker shards are only merged at the end")
+# bounded; a slow 1b blocks the writes here (backpressure)
+doc_stream = get_stream("1a_docs") if args.stream else None
 
 RUN_OUTPUT_DIR = Path("data/outputs") / RUN_ID
 RUN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 OUT_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.jsonl"
 OUT_JSON  = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.json"
+DELETED_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_deleted_indexes.txt"
+# fingerprints of this run's rows; 1b commits them once the rows are in silver
+PENDING_FP_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_pending_fingerprints.json"
 
-processed_indexes = load_processed_indexes_from_jsonl(OUT_JSONL)
+processed_indexes = get_jsonl_writer(OUT_JSONL, index_key="index").keys()
 print(f"[INFO] Already in JSONL: {len(processed_indexes)} indexes")
 print(f"[INFO] Force refresh mode: {FORCE_REFRESH}")
+print(f"[INFO] Max in-flight requests: {MAX_IN_FLIGHT}")
+
+source_ids = None
+if IDS_FILE:
+    if not IDS_FILE.exists():
+        raise FileNotFoundError(f"Missing ids file: {IDS_FILE}")
+    source_ids = read_ids_txt(IDS_FILE)
+    print(f"[INFO] Restricted to {len(source_ids)} indexes from {IDS_FILE}")
 
 CACHE_PKL = RUN_OUTPUT_DIR / f"{RUN_ID}_lx_cache.pkl"
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+# work-queue mode: one queue per run; each worker writes its own shard JSONL
+QUEUE_DB = RUN_OUTPUT_DIR / f"{RUN_ID}_work_queue.sqlite"
+SHARD_DIR = RUN_OUTPUT_DIR / "shards"
 
-engine = get_sql_server_engine()
+engine = shared_engine(get_engine)
 
-# =====================================
-# SOURCE QUERY
-# =====================================
-SOURCE_QUERY = """
-SELECT *
-FROM dbo.MasterTableDenormalizedCleanedFinal
---where [index] = 'DAR-2012-083'
-"""
-df_input = pd.read_sql(SOURCE_QUERY, engine)
+# source query, text builder and row fingerprints: utils/master_source.py
+# (shared with the micro-batch daemon)
+PROMPT_OVERHEAD_TOKENS = prompt_overhead_tokens(PROMPT, EXAMPLES)
 
-EXAMPLES = INFRA_EXAMPLES + DIST_EXAMPLES + SERV_EXAMPLES
+# shared request/token budgets + AIMD concurrency for all OpenAI calls in this process
+governor = get_governor("openai")
 
 # -----------------------
 # extraction loop
@@ -99,106 +165,426 @@ if FORCE_REFRESH:
     disk_cache = {}
     print("[INFO] Force refresh mode: ignoring disk cache")
 else:
-    disk_cache = load_cache(CACHE_PKL)
-    print(f"[INFO] Loaded disk cache entries: {len(disk_cache)} from {CACHE_PKL.name}")
+    disk_cache = open_run_cache(CACHE_PKL)
+    print(f"[INFO] Opened disk cache entries: {len(disk_cache)} from {disk_cache.path.name}")
+
+# cross-run cache shared by every RUN_ID; versioned by prompt/examples/model
+llm_cache = open_llm_cache(LLM_NAMESPACE, PROMPT, EXAMPLES, MODEL_ID)
+print(f"[INFO] Global LLM cache: {llm_cache.cache.path} | version={llm_cache.version[:12]}")
+
+# a prompt/examples/model change re-extracts every fingerprinted row
+PROMPT_VERSION = llm_cache.version
 
 cache_hits = 0
 fresh_calls = 0
 processed_this_run_indexes = set()
 
-for i, row in enumerate(df_input.to_dict("records"), start=1):
-    index = row.get("index", None) or row.get("Index", None)
-    index = safe_str(index)
 
-    if not index:
-        continue
+def iter_source_texts(skip_keys=None, only_keys=None, include_blank=False):
+    """
+    Stream source rows and yield (index, text_bilingual, row) for every row
+    with text (every row if include_blank). skip_keys / only_keys are applied
+    in the source query (anti-join on a key table), on top of the --ids-file
+    restriction.
+    """
+    key_filters = []
+    if skip_keys is not None:
+        key_filters.append({"column": "index", "keys": skip_keys, "mode": "exclude"})
+    if only_keys is not None:
+        key_filters.append({"column": "index", "keys": only_keys, "mode": "include"})
+    if source_ids is not None:
+        key_filters.append({"column": "index", "keys": source_ids, "mode": "include"})
+
+    for index, text_bilingual, row in iter_source_rows(engine, key_filters, include_blank=include_blank):
+        if skip_keys is not None and index in skip_keys:
+            continue
+        if only_keys is not None and index not in only_keys:
+            continue
+
+        yield index, text_bilingual, row
+
+
+def plan_row_groups() -> dict:
+    """
+    Planning pass: walk the pending source rows once, hash each text and
+    group indexes by text_hash (first-seen order). Many MasterTable rows
+    (seasonal / sponsorship programmes across years) share the same text;
+    each group is extracted once and the result fanned out to every index.
+    Only the text and the per-row amounts are kept, not the source rows.
+    """
+    if FINGERPRINTS_ON:
+        source_rows = iter_source_texts(only_keys=pending_keys)
+    else:
+        source_rows = iter_source_texts(skip_keys=None if FORCE_REFRESH else processed_indexes)
+
+    groups = {}
+    for index, text_bilingual, row in source_rows:
+        h = text_hash(text_bilingual)
+
+        group = groups.get(h)
+        if group is None:
+            group = groups[h] = {"hash": h, "text": text_bilingual, "rows": []}
+
+        group["rows"].append(
+            {
+                "index": index,
+                "master_project_amount_actual": row.get("Amount", None),
+                "master_project_oda_amount": row.get("ODA_Amount", None),
+                "master_project_ge_amount": row.get("GE_Amount", None),
+                "master_project_off_amount": row.get("OFF_Amount", None),
+            }
+        )
 
-    if (not FORCE_REFRESH) and (index in processed_indexes):
-        continue
+    return groups
+
+
+def iter_group_tasks(groups: dict):
+    """
+    Yield one task per unique text. Cache lookups happen here (main thread);
+    tasks without a cached result are resolved by resolve_task in the worker
+    pool. One task per hash means identical texts are never in flight twice.
+    """
+    global cache_hits
+
+    for group in groups.values():
+        h = group["hash"]
+
+        result = None
+        if h in run_cache:
+            result = run_cache[h]
+            cache_hits += 1
+        elif not FORCE_REFRESH:
+            result = disk_cache.get(h)
+            if result is None:
+                result = llm_cache.get(h)
+                if result is not None:
+                    disk_cache[h] = result
+            if result is not None:
+                run_cache[h] = result
+                cache_hits += 1
+
+        yield {
+            "hash": h,
+            "text": group["text"],
+            "rows": group["rows"],
+            "result": result,
+            "fresh": result is None,
+        }
+
+
+def resolve_task(task: dict) -> dict:
+    """Call the model for tasks that had no cached result. Runs in worker threads."""
+    if not task["fresh"]:
+        return task
+
+    task["result"] = governor.call(
+        lx.extract,
+        est_tokens=PROMPT_OVERHEAD_TOKENS + estimate_tokens(task["text"]),
+        text_or_documents=task["text"],
+        prompt_description=PROMPT,
+        examples=EXAMPLES,
+        model_id=MODEL_ID,
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        fence_output=True,
+        use_schema_constraints=False,
+    )
+    return task
 
-    title_en = safe_str(row.get("ProjectTitleEnglish", "") or "")
-    description_en = safe_str(row.get("DescriptionEnglish", "") or "")
-    title_ar = safe_str(row.get("ProjectTitleArabic", "") or "")
-    description_ar = safe_str(row.get("DescriptionArabic", "") or "")
 
-    text_bilingual = build_labeled_bilingual_input(
-        title_en=title_en,
-        desc_en=description_en,
-        title_ar=title_ar,
-        desc_ar=description_ar,
+# -----------------------
+# change detection
+# -----------------------
+# With fingerprints (default) the run id no longer decides what is
+# extracted: a fresh RUN_ID extracts only rows that are new or changed
+# since they last reached silver. Reusing a RUN_ID resumes it: pending rows
+# already in its JSONL are handed to 1b as they are (without committing
+# their fingerprints, so the next run re-checks them from cache).
+# --force-refresh redoes every row; --no-fingerprints restores the old
+# per-RUN_ID full pass.
+source_hashes = {}
+pending_keys = None
+deleted_indexes = []
+blank_hashes = {}
+blank_pending = set()
+resumed_keys = set()
+
+if FINGERPRINTS_ON:
+    # fingerprint (model text + amounts) of every source row, then one
+    # set-based comparison against silver.source_fingerprints. Rows with
+    # blank text are included: they still exist, so they must not come back
+    # as deleted, but there is nothing to extract
+    for index, text, row in iter_source_texts(include_blank=True):
+        source_hashes[index] = row_fingerprint(text, row)
+        if not text.strip():
+            blank_hashes[index] = source_hashes[index]
+
+    new_keys, changed_keys, deleted_indexes = diff_fingerprints(
+        engine,
+        FINGERPRINT_STAGE,
+        source_hashes,
+        PROMPT_VERSION,
+        # an --ids-file batch is only part of the source
+        detect_deletions=source_ids is None,
     )
+    pending_keys = set(source_hashes) if FORCE_REFRESH else set(new_keys) | set(changed_keys)
 
-    if not text_bilingual or not text_bilingual.strip():
-        continue
+    # blank rows keep whatever silver holds for them; only their fingerprint moves
+    blank_pending = pending_keys & set(blank_hashes)
+    pending_keys -= blank_pending
 
-    master_project_amount_actual = row.get("Amount", None)
-    master_project_oda_amount = row.get("ODA_Amount", None)
-    master_project_ge_amount = row.get("GE_Amount", None)
-    master_project_off_amount = row.get("OFF_Amount", None)
+    if not FORCE_REFRESH:
+        resumed_keys = pending_keys & processed_indexes
+        pending_keys -= resumed_keys
+        processed_this_run_indexes |= resumed_keys
 
-    h = text_hash(text_bilingual)
-    input_for_llm = text_bilingual
+    print(
+        f"[fingerprints] source_rows={len(source_hashes)} | new={len(new_keys)} | changed={len(changed_keys)} "
+        f"| deleted={len(deleted_indexes)} | unchanged={len(source_hashes) - len(new_keys) - len(changed_keys)} "
+        f"| blank_text={len(blank_pending)} | resumed_from_jsonl={len(resumed_keys)}"
+    )
 
-    if h in run_cache:
-        result = run_cache[h]
-        cache_hits += 1
-    elif (not FORCE_REFRESH) and (h in disk_cache):
-        result = disk_cache[h]
-        run_cache[h] = result
-        cache_hits += 1
-    else:
-        result = lx.extract(
-            text_or_documents=input_for_llm,
-            prompt_description=PROMPT,
-            examples=EXAMPLES,
-            model_id="gpt-4.1-mini",
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            fence_output=True,
-            use_schema_constraints=False,
-        )
+if PLAN_ONLY:
+    # dry run: count skips / cache hits / fresh calls without calling the model
+    plan = plan_extraction(
+        ((index, text) for index, text, _ in iter_source_texts()),
+        prompt=PROMPT,
+        examples=EXAMPLES,
+        caches=[disk_cache, llm_cache],
+        processed_keys=(set(source_hashes) - pending_keys) if FINGERPRINTS_ON else processed_indexes,
+        force_refresh=FORCE_REFRESH,
+        max_in_flight=MAX_IN_FLIGHT,
+        label=f"1a {RUN_ID}",
+    )
+    print_plan(plan)
+    raise SystemExit(0)
+
+if blank_pending:
+    # nothing goes to silver for these, so there is nothing to wait for
+    commit_fingerprints(engine, FINGERPRINT_STAGE, {k: blank_hashes[k] for k in blank_pending}, PROMPT_VERSION)
+
+if doc_stream is not None and resumed_keys:
+    # 1b --stream only sees what comes over the stream
+    for doc in iter_jsonl_latest(OUT_JSONL, index_key="index"):
+        if str(doc.get("index")) in resumed_keys:
+            doc_stream.put(doc)
+
+rows_written = 0
+
+# fingerprints of every row written by this run, saved to PENDING_FP_JSON at
+# the end; a crashed run commits nothing, so its rows come back as new (cache hits)
+fp_pending = {}
+
+
+def flush_fingerprints():
+    if fp_pending:
+        write_pending_fingerprints(PENDING_FP_JSON, FINGERPRINT_STAGE, fp_pending, PROMPT_VERSION)
+
+
+def write_task(task: dict, out_jsonl: Path, total_rows=None):
+    """Cache a resolved task's result and fan it out to every index sharing its text."""
+    global fresh_calls, rows_written
+
+    h = task["hash"]
+    result = task["result"]
 
+    if task["fresh"]:
         run_cache[h] = result
         if not FORCE_REFRESH:
             disk_cache[h] = result
-
+        llm_cache[h] = result
         fresh_calls += 1
 
     d = annotated_to_dict(result)
 
-    out = {
-        "extractions": d.get("extractions", []),
-        "text": text_bilingual,
-        "index": index,
-        "master_project_amount_actual": master_project_amount_actual,
-        "master_project_oda_amount": master_project_oda_amount,
-        "master_project_ge_amount": master_project_ge_amount,
-        "master_project_off_amount": master_project_off_amount,
-    }
+    # fan the single result out to every index sharing this text
+    for row in task["rows"]:
+        index = row["index"]
+
+        out = {
+            "extractions": d.get("extractions", []),
+            "text": task["text"],
+            "index": index,
+            "master_project_amount_actual": row["master_project_amount_actual"],
+            "master_project_oda_amount": row["master_project_oda_amount"],
+            "master_project_ge_amount": row["master_project_ge_amount"],
+            "master_project_off_amount": row["master_project_off_amount"],
+        }
+
+        if d.get("document_id"):
+            out["document_id"] = d.get("document_id")
+
+        jsonl_upsert_by_index(out_jsonl, out, index_key="index")
+        if doc_stream is not None:
+            doc_stream.put(out)
+        processed_this_run_indexes.add(index)
+        rows_written += 1
+        if FINGERPRINTS_ON:
+            fp_pending[index] = source_hashes[index]
+
+        # checkpoints only report progress: every record is already durable in the
+        # JSONL; the debug JSON is rebuilt once at the end (or via utils/jsonl_tools.py)
+        if rows_written % CHECKPOINT_EVERY == 0:
+            print(
+                f"[checkpoint] rows_written={rows_written}/{total_rows if total_rows is not None else '?'} "
+                f"| upserted_this_run={len(processed_this_run_indexes)} "
+                f"| cache_hits={cache_hits} | fresh_calls={fresh_calls} | cache_size={len(disk_cache)}"
+            )
+            llm_cache.flush_stats()
+            print(governor.stats_line())
 
-    if d.get("document_id"):
-        out["document_id"] = d.get("document_id")
 
-    jsonl_upsert_by_index(OUT_JSONL, out, index_key="index")
-    processed_this_run_indexes.add(index)
+# -----------------------
+# work-queue mode
+# -----------------------
+def run_worker():
+    """
+    Lease text groups from the run's queue until it is drained. Results go
+    to this worker's shard JSONL before the item is marked done, so a crash
+    at worst repeats one lease; the coordinator merges the shards. Open
+    leases are renewed in the background while the batch runs.
+    """
+    queue = WorkQueue(QUEUE_DB)
+    shard_jsonl = SHARD_DIR / f"{RUN_ID}_combined_extraction_results.{WORKER_ID}.jsonl"
+    lease_n = max(1, MAX_IN_FLIGHT * 2)
+    print(f"[worker {WORKER_ID}] queue={QUEUE_DB} | shard={shard_jsonl}")
+
+    while True:
+        leased = queue.lease(WORKER_ID, lease_n, LEASE_S)
+        if not leased:
+            if queue.drained():
+                break
+            # other workers hold the rest; their leases may still expire
+            time.sleep(5)
+            continue
+
+        groups = {h: {"hash": h, "text": p["text"], "rows": p["rows"]} for h, p in leased}
+        try:
+            with LeaseHeartbeat(queue, WORKER_ID, LEASE_S, lambda: list(groups)):
+                for _, task in bounded_ordered_map(resolve_task, iter_group_tasks(groups), max_in_flight=MAX_IN_FLIGHT):
+                    write_task(task, shard_jsonl)
+                    if not queue.complete(task["hash"], WORKER_ID):
+                        print(f"[worker {WORKER_ID}] lease for {task['hash'][:12]} expired; result kept, merge dedups it")
+                    groups.pop(task["hash"], None)
+        except Exception as e:
+            print(f"[worker {WORKER_ID}] batch failed ({type(e).__name__}: {e}); releasing {len(groups)} leases")
+            for h in groups:
+                queue.fail(h, WORKER_ID, f"{type(e).__name__}: {e}")
+
+    print(f"[worker {WORKER_ID}] queue drained | rows_written={rows_written} | {queue.counts()}")
+
+
+def run_coordinator(groups: dict) -> set:
+    """
+    Queue every pending text group, start local workers, wait for the queue
+    to drain and merge the worker shards into OUT_JSONL. Rerunning the
+    coordinator for the same run resumes: finished items stay done.
+    """
+    queue = WorkQueue(QUEUE_DB)
+    requeued = queue.requeue_failed()
+    added = queue.enqueue((g["hash"], {"text": g["text"], "rows": g["rows"]}) for g in groups.values())
+    print(f"[coordinator] queued={added} | requeued_failed={requeued} | {queue.counts()}")
+
+    def worker_cmd(n: int) -> list[str]:
+        cmd = [
+            sys.executable, str(Path(__file__).resolve()),
+            "--run-id", RUN_ID,
+            "--role", "worker",
+            "--worker-id", f"{default_worker_id()}-w{n}",
+            "--max-in-flight", str(MAX_IN_FLIGHT),
+            "--lease-s", str(LEASE_S),
+        ]
+        if FORCE_REFRESH:
+            cmd.append("--force-refresh")
+        return cmd
+
+    procs = {n: subprocess.Popen(worker_cmd(n)) for n in range(WORKERS)}
+    restarts = 0
+
+    while not queue.drained():
+        time.sleep(10)
+        for n, proc in list(procs.items()):
+            code = proc.poll()
+            if code not in (None, 0) and restarts < 3 * max(1, WORKERS):
+                print(f"[coordinator] worker {n} exited with {code}; restarting")
+                procs[n] = subprocess.Popen(worker_cmd(n))
+                restarts += 1
+        print(f"[coordinator] {queue.counts()}")
+
+        if procs and all(proc.poll() not in (None, 0) for proc in procs.values()):
+            raise RuntimeError("All local workers failed and the restart budget is used up; queue kept for a rerun")
+
+    for proc in procs.values():
+        proc.wait()
+
+    failed = queue.failed_keys()
+    if failed:
+        print(f"[WARN] {len(failed)} text groups failed after retries; rerun the coordinator to retry them")
+
+    merged = merge_jsonl_shards(OUT_JSONL, sorted(SHARD_DIR.glob(f"{RUN_ID}_combined_extraction_results.*.jsonl")))
+    print(f"[coordinator] merged {len(merged)} indexes from worker shards")
+
+    # also covers shards merged by an earlier, interrupted coordinator of this run
+    done_indexes = set()
+    for _, payload in queue.iter_done():
+        for row in payload["rows"]:
+            done_indexes.add(row["index"])
+            if FINGERPRINTS_ON and row["index"] in source_hashes:
+                fp_pending[row["index"]] = source_hashes[row["index"]]
+    return merged | done_indexes
+
+
+if ROLE == "worker":
+    run_worker()
+    if not FORCE_REFRESH:
+        disk_cache.flush()
+    llm_cache.flush_stats()
+    print(llm_cache.stats_line())
+    print(governor.stats_line())
+    raise SystemExit(0)
+
+row_groups = plan_row_groups()
+pending_rows = sum(len(g["rows"]) for g in row_groups.values())
+unique_texts = len(row_groups)
+dedup_ratio = (pending_rows / unique_texts) if unique_texts else 1.0
+print(
+    f"[plan] pending_rows={pending_rows} | unique_texts={unique_texts} "
+    f"| dedup_ratio={dedup_ratio:.2f} | calls_saved_by_dedup={pending_rows - unique_texts}"
+)
 
-    if i % CHECKPOINT_EVERY == 0:
-        jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
-        if not FORCE_REFRESH:
-            save_cache(disk_cache, CACHE_PKL)
-        print(
-            f"[checkpoint] rows_seen={i} | upserted_this_run={len(processed_this_run_indexes)} "
-            f"| cache_hits={cache_hits} | fresh_calls={fresh_calls} | cache_size={len(disk_cache)}"
-        )
+if ROLE == "coordinator":
+    processed_this_run_indexes |= run_coordinator(row_groups)
+else:
+    # results come back in plan order, so JSONL/cache writes stay deterministic
+    # and a crash leaves a clean prefix to resume from
+    for _, task in bounded_ordered_map(resolve_task, iter_group_tasks(row_groups), max_in_flight=MAX_IN_FLIGHT):
+        write_task(task, OUT_JSONL, pending_rows)
+
+flush_fingerprints()
+
+dropped_lines = compact_jsonl(OUT_JSONL, index_key="index")
+print(f"[INFO] Compacted JSONL: dropped {dropped_lines} superseded lines")
 
-jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
+jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON, index_key="index")
 
 if not FORCE_REFRESH:
-    save_cache(disk_cache, CACHE_PKL)
-    print(f"Saved disk cache: {CACHE_PKL} (entries={len(disk_cache)})")
+    disk_cache.flush()
+    print(f"Saved disk cache: {disk_cache.path} (entries={len(disk_cache)})")
+
+llm_cache.flush_stats()
+print(llm_cache.stats_line())
+print(governor.stats_line())
 
 print(f"Saved extraction JSONL: {OUT_JSONL}")
 print(f"Saved debug JSON:      {OUT_JSON}")
-print(f"[DONE] upserted_this_run={len(processed_this_run_indexes)} | cache_hits={cache_hits} | fresh_calls={fresh_calls}")
+print(
+    f"[DONE] upserted_this_run={len(processed_this_run_indexes)} | cache_hits={cache_hits} "
+    f"| fresh_calls={fresh_calls} | unique_texts={unique_texts} | dedup_ratio={dedup_ratio:.2f}"
+)
 
 PROCESSED_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
-PROCESSED_TXT.write_text("\n".join(sorted(processed_this_run_indexes)), encoding="utf-8")
\ No newline at end of file
+write_ids_txt(PROCESSED_TXT, processed_this_run_indexes)
+
+if FINGERPRINTS_ON:
+    # 1b removes these from the silver tables and forgets their fingerprints
+    write_ids_txt(DELETED_TXT, deleted_indexes)
+    print(f"Saved deleted indexes:  {DELETED_TXT} ({len(deleted_indexes)})")
\ No newline at end of file
@@ -1,583 +1,311 @@
-import json
-import re
+import os
 import pandas as pd
 from pathlib import Path
 import argparse
-from sqlalchemy import create_engine
-import urllib
 import sys
 from datetime import datetime, timezone
 from sqlalchemy import text as sql_text
-from sqlalchemy.types import NVARCHAR, DateTime, UnicodeText
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from utils.post_processing_helpers import (
-    smart_title_case,
-    normalize_class,
-    to_int_or_none,
-    to_float_or_none,
-    is_missing_or_bad,
-    fmt_mp,
-    fmt_prj,
-    _is_blank,
-)
+from utils.master_doc_parser import parse_master_docs_parallel, MASTER_SQL_DTYPE
+from utils.code_allocator import CodeAllocator
+from utils.sql_upsert import upsert_dataframe, format_counts
 
-from utils.post_processing_sql_queries import QUERIES
+from utils.post_processing_sql_queries import QUERIES, INCREMENTAL_QUERIES
+from utils.extraction_helpers import iter_jsonl_latest, stage_key_table
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt, write_ids_txt, get_stream
+from utils.source_fingerprints import propagate_deletions, forget_fingerprints, commit_pending_fingerprints
+from utils.db import get_engine
 
 # -----------------------
 # args + paths
 # -----------------------
 parser = argparse.ArgumentParser()
 parser.add_argument("--run-id", required=True)
-args = parser.parse_args()
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help=(
+        "Consume documents from the pipeline stream '1a_docs' while 1a is still running, write them "
+        "in micro-batches and put the new projects on '1b_projects' for 1c --stream (1_main.py --stream)."
+    ),
+)
+parser.add_argument("--micro-batch", type=int, default=200, help="--stream: documents per MasterTable_extracted write.")
+parser.add_argument(
+    "--batch-wait-s",
+    type=float,
+    default=5.0,
+    help="--stream: write a partial micro-batch after this many seconds without a new document.",
+)
+parser.add_argument(
+    "--full-refresh",
+    action="store_true",
+    help="Truncate and rebuild the cleaned_* silver tables from all of MasterTable_extracted (default: only this run's indexes).",
+)
+parser.add_argument(
+    "--parse-workers",
+    type=int,
+    default=None,
+    help="Processes parsing documents (default: CPU count; 1 = in this process).",
+)
+args = parser.parse_args(step_argv())
 
 RUN_ID = args.run_id
+STREAM = args.stream
+PARSE_WORKERS = args.parse_workers
+FULL_REFRESH = args.full_refresh
+MICRO_BATCH = max(1, args.micro_batch)
+BATCH_WAIT_S = args.batch_wait_s
 RUN_OUTPUT_DIR = Path("data/outputs") / RUN_ID
 
 INPUT_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.jsonl"
 OUT_CSV = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction.csv"
+# --stream: micro-batches are appended here, then merged into OUT_CSV at the end
+STREAM_CSV = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction.stream.csv"
 
 PROCESSED_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
-if not PROCESSED_TXT.exists():
-    raise FileNotFoundError(f"Processed index list not found: {PROCESSED_TXT}")
 
-processed_run_indexes = set(
-    x.strip() for x in PROCESSED_TXT.read_text(encoding="utf-8").splitlines() if x.strip()
-)
-print(f"[INFO] Incremental mode: {len(processed_run_indexes)} indexes to post-process")
+if STREAM:
+    # filled as documents arrive; 1a writes PROCESSED_TXT only when it finishes
+    processed_run_indexes = set()
+    print(f"[INFO] Stream mode: micro_batch={MICRO_BATCH} | batch_wait_s={BATCH_WAIT_S}")
+else:
+    if not PROCESSED_TXT.exists():
+        raise FileNotFoundError(f"Processed index list not found: {PROCESSED_TXT}")
 
-# -----------------------
-# SQL Server
-# -----------------------
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
+    processed_run_indexes = read_ids_txt(PROCESSED_TXT)
+    print(f"[INFO] Incremental mode: {len(processed_run_indexes)} indexes to post-process")
+
+# written by 1a when source rows disappeared since their fingerprints were
+# stored; in --stream mode only once 1a has finished, i.e. after its stream closes
+DELETED_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_deleted_indexes.txt"
+# written by 1a; committed here once this run's rows are in silver, so a
+# failed 1b leaves them unfingerprinted and the next run extracts them again
+PENDING_FP_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_pending_fingerprints.json"
 
 TARGET_SCHEMA = "silver"
 TARGET_TABLE = "MasterTable_extracted"
 
-def _trail_int(s: str):
-    if s is None:
-        return None
-    m = re.search(r"(\d+)\s*$", str(s))
-    return int(m.group(1)) if m else None
-
-if not INPUT_JSONL.exists():
+if not STREAM and not INPUT_JSONL.exists():
     raise FileNotFoundError(f"Input JSONL not found: {INPUT_JSONL}")
 
-engine = get_sql_server_engine()
-
-index_to_master_code = {}
-max_master_num = 0
-
-try:
-    existing_master = pd.read_sql(
-        sql_text(
-            f"""
-            SELECT [index], master_project_code
-            FROM {TARGET_SCHEMA}.{TARGET_TABLE}
-            WHERE [index] IS NOT NULL
-              AND master_project_code IS NOT NULL
-            """
-        ),
-        engine,
-    )
+engine = shared_engine(get_engine)
 
-    existing_master["index"] = existing_master["index"].astype(str)
-    existing_master = (
-        existing_master.sort_values(["index", "master_project_code"])
-        .drop_duplicates("index", keep="first")
-    )
-    index_to_master_code = dict(
-        zip(existing_master["index"], existing_master["master_project_code"])
-    )
+# master codes come from silver.master_code_map / master_code_seq; only the
+# indexes of this run are looked up
+code_allocator = CodeAllocator(engine, schema=TARGET_SCHEMA, target_table=TARGET_TABLE)
 
-    master_nums = existing_master["master_project_code"].apply(_trail_int).dropna().tolist()
-    max_master_num = max(master_nums) if master_nums else 0
+# -----------------------
+# deletions
+# -----------------------
+def apply_deletions():
+    """
+    Remove 1a's deleted indexes from the silver tables and forget their
+    fingerprints. The code mapping is kept, so an index that comes back
+    gets its old code. Runs before the empty-run exits below.
+    """
+    deleted_indexes = read_ids_txt(DELETED_TXT) if DELETED_TXT.exists() else set()
+    if not deleted_indexes:
+        return
 
-except Exception as e:
-    print("Warning: could not load existing mappings from target table. Starting fresh.")
-    print("Reason:", str(e))
+    with engine.begin() as conn:
+        deleted_counts = propagate_deletions(conn, deleted_indexes)
+        forget_fingerprints(conn, "1a", deleted_indexes)
+    print(f"[INFO] Propagated {len(deleted_indexes)} deleted source indexes:")
+    for table, n in deleted_counts.items():
+        print(f"  {table}: {n} rows")
 
-next_master_num = max_master_num
-TS_INSERTED = datetime.now(timezone.utc)
 
-rows = []
+if not STREAM:
+    apply_deletions()
 
-with open(INPUT_JSONL, "r", encoding="utf-8") as f:
-    for doc_index, line in enumerate(f, start=1):
-        line = line.strip()
-        if not line:
-            continue
 
-        doc = json.loads(line)
-        text = doc.get("text")
-        index = doc.get("index")
-        index_key = str(index) if index is not None else None
+def commit_run_fingerprints():
+    n = commit_pending_fingerprints(engine, PENDING_FP_JSON, indexes=processed_run_indexes)
+    if n:
+        print(f"[INFO] Committed {n} source fingerprints of this run")
 
-        if not index_key or index_key not in processed_run_indexes:
-            continue
+TS_INSERTED = datetime.now(timezone.utc)
 
-        document_id = doc.get("document_id") or doc.get("_document_id") or doc.get("doc_id")
-
-        master_project_amount_actual = to_float_or_none(doc.get("master_project_amount_actual"))
-        master_project_oda_amount = to_float_or_none(doc.get("master_project_oda_amount"))
-        master_project_ge_amount = to_float_or_none(doc.get("master_project_ge_amount"))
-        master_project_off_amount = to_float_or_none(doc.get("master_project_off_amount"))
-
-        raw_extractions = doc.get("extractions", [])
-
-        exs = []
-        for e in raw_extractions:
-            cls = normalize_class(e.get("extraction_class"))
-            val = e.get("extraction_text")
-            if val is None or str(val).strip() == "":
-                continue
-            exs.append(
-                {
-                    "cls": cls,
-                    "val": val,
-                    "idx": e.get("extraction_index", 10**9),
-                }
-            )
-
-        exs.sort(key=lambda x: x["idx"])
-
-        master_project_title_en = None
-        master_project_title_ar = None
-        master_project_description_en = None
-        master_project_description_ar = None
-
-        for x in exs:
-            if x["cls"] == "master_project_title_en" and master_project_title_en is None:
-                master_project_title_en = smart_title_case(x["val"])
-            elif x["cls"] == "master_project_title_ar" and master_project_title_ar is None:
-                master_project_title_ar = str(x["val"]).strip()
-            elif x["cls"] == "master_project_description_en" and master_project_description_en is None:
-                master_project_description_en = str(x["val"]).strip()
-            elif x["cls"] == "master_project_description_ar" and master_project_description_ar is None:
-                master_project_description_ar = str(x["val"]).strip()
-
-        if index_key in index_to_master_code:
-            master_project_code = index_to_master_code[index_key]
-        else:
-            next_master_num += 1
-            master_project_code = fmt_mp(next_master_num)
-            index_to_master_code[index_key] = master_project_code
-
-        current_project_code = None
-        current_project_title_en = None
-        current_project_title_ar = None
-        current_project_description_en = None
-        current_project_description_ar = None
-
-        current_item = None
-        pending_item_qty = None
-        pending_item_category = None
-        pending_item_uom = None
-
-        project_amount_extracted_map = {}
-        project_description_en_map = {}
-        project_description_ar_map = {}
-        project_title_ar_map = {}
-
-        seen_projects_in_doc = []
-        projects_with_items = set()
-        row_indices_by_project = {}
-        index_to_next_prj = 0
-
-        def append_row(r: dict):
-            rows.append(r)
-            prj = r.get("project_code")
-            if prj:
-                row_indices_by_project.setdefault(prj, []).append(len(rows) - 1)
-
-        def backfill_project_amount_extracted(prj_code: str, amt: float):
-            for ridx in row_indices_by_project.get(prj_code, []):
-                if rows[ridx].get("project_amount_extracted") is None or pd.isna(
-                    rows[ridx].get("project_amount_extracted")
-                ):
-                    rows[ridx]["project_amount_extracted"] = amt
-
-        for x in exs:
-            cls, val = x["cls"], x["val"]
-
-            if cls == "project_title_en":
-                if current_item is not None:
-                    append_row(current_item)
-                    projects_with_items.add(current_item["project_code"])
-                    current_item = None
-
-                current_project_title_en = smart_title_case(val)
-                index_to_next_prj += 1
-                current_project_code = fmt_prj(master_project_code, index_to_next_prj)
-
-                seen_projects_in_doc.append((current_project_code, current_project_title_en))
-                project_amount_extracted_map.setdefault(current_project_code, None)
-
-                current_project_description_en = None
-                current_project_description_ar = None
-                current_project_title_ar = None
-
-                project_description_en_map.setdefault(current_project_code, None)
-                project_description_ar_map.setdefault(current_project_code, None)
-                project_title_ar_map.setdefault(current_project_code, None)
-
-                pending_item_qty = None
-                pending_item_category = None
-                pending_item_uom = None
-                continue
-
-            if cls == "project_title_ar":
-                if current_project_code is None:
-                    continue
-                ar_title = str(val).strip()
-                if _is_blank(project_title_ar_map.get(current_project_code)):
-                    project_title_ar_map[current_project_code] = ar_title
-                current_project_title_ar = project_title_ar_map[current_project_code]
-                if current_item is not None and current_item.get("project_code") == current_project_code:
-                    current_item["project_title_ar"] = current_project_title_ar
-                continue
-
-            if cls == "project_description_en":
-                if current_project_code is None:
-                    continue
-                desc = re.sub(r"\s+", " ", str(val).strip())
-                if _is_blank(project_description_en_map.get(current_project_code)):
-                    project_description_en_map[current_project_code] = desc
-                current_project_description_en = project_description_en_map[current_project_code]
-                if current_item is not None and current_item.get("project_code") == current_project_code:
-                    current_item["project_description_en"] = current_project_description_en
-                continue
-
-            if cls == "project_description_ar":
-                if current_project_code is None:
-                    continue
-                desc_ar = re.sub(r"\s+", " ", str(val).strip())
-                if _is_blank(project_description_ar_map.get(current_project_code)):
-                    project_description_ar_map[current_project_code] = desc_ar
-                current_project_description_ar = project_description_ar_map[current_project_code]
-                if current_item is not None and current_item.get("project_code") == current_project_code:
-                    current_item["project_description_ar"] = current_project_description_ar
-                continue
-
-            if cls == "project_amount_extracted":
-                a = to_float_or_none(val)
-                if current_project_code is not None and a is not None:
-                    if project_amount_extracted_map.get(current_project_code) is None:
-                        project_amount_extracted_map[current_project_code] = a
-                    backfill_project_amount_extracted(current_project_code, a)
-                    if (
-                        current_item is not None
-                        and current_item.get("project_code") == current_project_code
-                        and is_missing_or_bad(current_item.get("project_amount_extracted"))
-                    ):
-                        current_item["project_amount_extracted"] = a
-                continue
-
-            if cls in ("item", "items"):
-                if current_item is not None:
-                    append_row(current_item)
-                    projects_with_items.add(current_item["project_code"])
-                    current_item = None
-
-                amt_extr = project_amount_extracted_map.get(current_project_code)
-
-                current_item = {
-                    "document_id": document_id,
-                    "ts_inserted": TS_INSERTED,
-                    "index": index,
-                    "master_project_code": master_project_code,
-                    "master_project_title_en": master_project_title_en,
-                    "master_project_title_ar": master_project_title_ar,
-                    "master_project_description_en": master_project_description_en,
-                    "master_project_description_ar": master_project_description_ar,
-                    "master_project_amount_actual": master_project_amount_actual,
-                    "master_project_oda_amount": master_project_oda_amount,
-                    "master_project_ge_amount": master_project_ge_amount,
-                    "master_project_off_amount": master_project_off_amount,
-                    "project_code": current_project_code,
-                    "project_title_en": current_project_title_en,
-                    "project_title_ar": current_project_title_ar,
-                    "project_description_en": current_project_description_en,
-                    "project_description_ar": current_project_description_ar,
-                    "beneficiary_count": None,
-                    "beneficiary_group_name": None,
-                    "asset": None,
-                    "asset_category": None,
-                    "asset_quantity": None,
-                    "asset_quantity_uom": None,
-                    "asset_capacity": None,
-                    "asset_capacity_uom": None,
-                    "item": smart_title_case(val),
-                    "item_category": None,
-                    "item_quantity": None,
-                    "item_quantity_uom": None,
-                    "project_amount_extracted": amt_extr,
-                    "input_text": text,
-                }
-
-                if pending_item_qty is not None:
-                    current_item["item_quantity"] = pending_item_qty
-                    pending_item_qty = None
-                if pending_item_category is not None:
-                    current_item["item_category"] = pending_item_category
-                    pending_item_category = None
-                if pending_item_uom is not None:
-                    current_item["item_quantity_uom"] = pending_item_uom
-                    pending_item_uom = None
-                continue
-
-            if cls == "item_quantity":
-                qty = to_int_or_none(val)
-                if current_item is not None:
-                    current_item["item_quantity"] = qty
-                else:
-                    pending_item_qty = qty
-                continue
-
-            if cls == "item_category":
-                category = smart_title_case(val)
-                if current_item is not None:
-                    current_item["item_category"] = category
-                else:
-                    pending_item_category = category
-                continue
-
-            if cls == "item_quantity_uom":
-                uom = str(val).strip()
-                if current_item is not None:
-                    current_item["item_quantity_uom"] = uom
-                else:
-                    pending_item_uom = uom
-                continue
-
-        if current_item is not None:
-            append_row(current_item)
-            projects_with_items.add(current_item["project_code"])
-            current_item = None
-
-        for prj_code, amt in project_amount_extracted_map.items():
-            if amt is not None:
-                backfill_project_amount_extracted(prj_code, amt)
-
-        if not seen_projects_in_doc:
-            index_to_next_prj += 1
-            current_project_code = fmt_prj(master_project_code, index_to_next_prj)
-            seen_projects_in_doc.append((current_project_code, None))
-            project_amount_extracted_map[current_project_code] = None
-            project_description_en_map[current_project_code] = None
-            project_description_ar_map[current_project_code] = None
-            project_title_ar_map[current_project_code] = None
-
-        for prj_code, prj_title in seen_projects_in_doc:
-            if prj_code not in projects_with_items:
-                append_row(
-                    {
-                        "document_id": document_id,
-                        "ts_inserted": TS_INSERTED,
-                        "index": index,
-                        "master_project_code": master_project_code,
-                        "master_project_title_en": master_project_title_en,
-                        "master_project_title_ar": master_project_title_ar,
-                        "master_project_description_en": master_project_description_en,
-                        "master_project_description_ar": master_project_description_ar,
-                        "master_project_amount_actual": master_project_amount_actual,
-                        "master_project_oda_amount": master_project_oda_amount,
-                        "master_project_ge_amount": master_project_ge_amount,
-                        "master_project_off_amount": master_project_off_amount,
-                        "project_code": prj_code,
-                        "project_title_en": prj_title,
-                        "project_title_ar": project_title_ar_map.get(prj_code),
-                        "project_description_en": project_description_en_map.get(prj_code),
-                        "project_description_ar": project_description_ar_map.get(prj_code),
-                        "beneficiary_count": None,
-                        "beneficiary_group_name": None,
-                        "asset": None,
-                        "asset_category": None,
-                        "asset_quantity": None,
-                        "asset_quantity_uom": None,
-                        "asset_capacity": None,
-                        "asset_capacity_uom": None,
-                        "item": None,
-                        "item_category": None,
-                        "item_quantity": None,
-                        "item_quantity_uom": None,
-                        "project_amount_extracted": project_amount_extracted_map.get(prj_code),
-                        "input_text": text,
-                    }
-                )
-
-df_new = pd.DataFrame(rows)
-if df_new.empty:
-    print("[INFO] No rows produced for this run. Nothing to upsert.")
-    sys.exit(0)
-
-df_new["master_project_amount_actual"] = pd.to_numeric(df_new.get("master_project_amount_actual"), errors="coerce")
-df_new["master_project_oda_amount"] = pd.to_numeric(df_new.get("master_project_oda_amount"), errors="coerce")
-df_new["master_project_ge_amount"] = pd.to_numeric(df_new.get("master_project_ge_amount"), errors="coerce")
-df_new["master_project_off_amount"] = pd.to_numeric(df_new.get("master_project_off_amount"), errors="coerce")
-df_new["project_amount_extracted"] = pd.to_numeric(df_new.get("project_amount_extracted"), errors="coerce")
-
-project_counts = (
-    df_new[["master_project_code", "project_code"]]
-    .drop_duplicates()
-    .groupby("master_project_code")["project_code"]
-    .nunique()
-)
-df_new["_project_count"] = df_new["master_project_code"].map(project_counts).fillna(1).astype(int)
 
-df_new["project_amount_actual"] = df_new["master_project_amount_actual"] / df_new["_project_count"]
-df_new["project_oda_amount"] = df_new["master_project_oda_amount"] / df_new["_project_count"]
-df_new["project_ge_amount"] = df_new["master_project_ge_amount"] / df_new["_project_count"]
-df_new["project_off_amount"] = df_new["master_project_off_amount"] / df_new["_project_count"]
+def parse_docs(docs) -> pd.DataFrame:
+    """
+    Allocate master codes for all `docs` in one call, then parse them in a
+    process pool into one typed frame (document order).
+    """
+    docs = [doc for doc in docs if doc.get("index") is not None and str(doc.get("index")).strip()]
+    codes = code_allocator.master_codes(str(doc.get("index")) for doc in docs)
+
+    return parse_master_docs_parallel(docs, codes, TS_INSERTED, workers=PARSE_WORKERS)
 
-df_new.loc[df_new["master_project_amount_actual"].apply(is_missing_or_bad), "project_amount_actual"] = pd.NA
-df_new.loc[df_new["master_project_oda_amount"].apply(is_missing_or_bad), "project_oda_amount"] = pd.NA
-df_new.loc[df_new["master_project_ge_amount"].apply(is_missing_or_bad), "project_ge_amount"] = pd.NA
-df_new.loc[df_new["master_project_off_amount"].apply(is_missing_or_bad), "project_off_amount"] = pd.NA
 
-df_new.drop(columns=["_project_count"], inplace=True)
+def upsert_master_rows(df: pd.DataFrame):
+    """
+    Bring the target rows of every index in `df` in line with it: staged
+    MERGE in one transaction. Rows of an index are paired on project and
+    item, so re-processing an unchanged index rewrites nothing.
+    """
+    print(f"[INFO] Upserting {df['index'].nunique()} indexes into {TARGET_SCHEMA}.{TARGET_TABLE} (staged MERGE)")
 
-FINAL_COLUMNS = [
-    "document_id",
-    "ts_inserted",
+    counts = upsert_dataframe(
+        engine,
+        df,
+        f"{TARGET_SCHEMA}.{TARGET_TABLE}",
+        scope_columns=["index"],
+        key_columns=["project_code", "item"],
+        ignore_columns=["ts_inserted"],
+        dtype=MASTER_SQL_DTYPE,
+    )
+    print(f"[INFO] MERGE {TARGET_SCHEMA}.{TARGET_TABLE}: {format_counts(counts)}")
+
+
+PROJECT_STREAM_COLUMNS = [
     "index",
-    "master_project_code",
-    "master_project_title_en",
-    "master_project_title_ar",
-    "master_project_description_en",
-    "master_project_description_ar",
     "project_code",
     "project_title_en",
     "project_title_ar",
     "project_description_en",
     "project_description_ar",
-    "beneficiary_count",
-    "beneficiary_group_name",
-    "asset",
-    "asset_category",
-    "asset_quantity",
-    "asset_quantity_uom",
-    "asset_capacity",
-    "asset_capacity_uom",
-    "item",
-    "item_category",
-    "item_quantity",
-    "item_quantity_uom",
-    "input_text",
-    "master_project_amount_actual",
-    "master_project_oda_amount",
-    "master_project_ge_amount",
-    "master_project_off_amount",
-    "project_amount_actual",
-    "project_amount_extracted",
-    "project_oda_amount",
-    "project_ge_amount",
-    "project_off_amount",
 ]
 
-for c in FINAL_COLUMNS:
-    if c not in df_new.columns:
-        df_new[c] = None
-df_new = df_new[FINAL_COLUMNS]
 
-OUT_CSV.parent.mkdir(parents=True, exist_ok=True)
+def project_rows(df: pd.DataFrame) -> list[dict]:
+    """One record per project, in the columns 1c reads from silver.cleaned_project."""
+    projects = (
+        df[PROJECT_STREAM_COLUMNS]
+        .dropna(subset=["project_code"])
+        .groupby("project_code", sort=False, as_index=False)
+        .first()
+    )
+    projects = projects.astype(object).where(projects.notna(), None)
+    return projects.to_dict("records")
 
-df_new["index"] = df_new["index"].astype(str)
 
-if OUT_CSV.exists():
-    old_df = pd.read_csv(OUT_CSV, dtype={"index": str})
-    old_df["index"] = old_df["index"].astype(str)
-    old_df = old_df[~old_df["index"].isin(processed_run_indexes)]
-    df_final = pd.concat([old_df, df_new], ignore_index=True)
-else:
-    df_final = df_new
+def merge_stream_csv():
+    """OUT_CSV = its rows for other indexes + this run's micro-batches, in chunks."""
+    tmp_csv = OUT_CSV.with_name(OUT_CSV.name + ".tmp")
+    first = True
 
-df_final.to_csv(OUT_CSV, index=False)
+    def write_chunk(chunk):
+        nonlocal first
+        chunk.to_csv(tmp_csv, mode="w" if first else "a", header=first, index=False)
+        first = False
 
-PROCESSED_PROJECT_CODES_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_project_codes.txt"
+    if OUT_CSV.exists():
+        for chunk in pd.read_csv(OUT_CSV, dtype={"index": str}, chunksize=50000):
+            write_chunk(chunk[~chunk["index"].astype(str).isin(processed_run_indexes)])
+    if STREAM_CSV.exists():
+        for chunk in pd.read_csv(STREAM_CSV, dtype={"index": str}, chunksize=50000):
+            write_chunk(chunk)
+        STREAM_CSV.unlink()
 
-processed_project_codes = sorted(
-    {
-        str(x).strip()
-        for x in df_new["project_code"].dropna().tolist()
-        if str(x).strip()
-    }
-)
+    if not first:
+        os.replace(tmp_csv, OUT_CSV)
 
-PROCESSED_PROJECT_CODES_TXT.write_text(
-    "\n".join(processed_project_codes),
-    encoding="utf-8"
-)
 
-print(f"[INFO] Saved processed project_codes txt: {PROCESSED_PROJECT_CODES_TXT}")
-print(f"[INFO] Project codes in this run: {len(processed_project_codes)}")
+OUT_CSV.parent.mkdir(parents=True, exist_ok=True)
 
-indexes_to_upsert = sorted(set(df_new["index"].dropna().astype(str)) & processed_run_indexes)
-
-dtype = {
-    "master_project_title_en": UnicodeText(),
-    "master_project_description_en": UnicodeText(),
-    "project_title_en": UnicodeText(),
-    "project_description_en": UnicodeText(),
-    "master_project_title_ar": UnicodeText(),
-    "master_project_description_ar": UnicodeText(),
-    "project_title_ar": UnicodeText(),
-    "project_description_ar": UnicodeText(),
-    "ts_inserted": DateTime(),
-    "document_id": NVARCHAR(length=128),
-}
-
-if indexes_to_upsert:
-    print(
-        f"[INFO] Upserting {len(indexes_to_upsert)} indexes into {TARGET_SCHEMA}.{TARGET_TABLE} "
-        f"(temp table delete-join)"
-    )
+if STREAM:
+    # -----------------------
+    # stream mode: 1a -> 1b -> 1c overlap
+    # -----------------------
+    doc_stream = get_stream("1a_docs")
+    project_stream = get_stream("1b_projects")
+    STREAM_CSV.unlink(missing_ok=True)
 
-    df_idx = pd.DataFrame({"index": indexes_to_upsert})
+    processed_project_codes = set()
+    rows_written = 0
 
-    with engine.begin() as conn:
-        conn.execute(sql_text("IF OBJECT_ID('tempdb..#idx') IS NOT NULL DROP TABLE #idx;"))
-        conn.execute(sql_text("CREATE TABLE #idx ([index] NVARCHAR(255) NOT NULL PRIMARY KEY);"))
-
-        df_idx.to_sql("#idx", conn, if_exists="append", index=False, method=None)
-
-        conn.execute(
-            sql_text(
-                f"""
-                DELETE T
-                FROM {TARGET_SCHEMA}.{TARGET_TABLE} AS T
-                INNER JOIN #idx AS I
-                    ON CAST(T.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
-                     = I.[index] COLLATE DATABASE_DEFAULT;
-                """
-            )
+    for batch in doc_stream.batches(MICRO_BATCH, BATCH_WAIT_S):
+        # latest document per index
+        docs = {str(d.get("index")): d for d in batch if d.get("index") is not None}
+        processed_run_indexes.update(docs)
+
+        df_batch = parse_docs(list(docs.values()))
+        if df_batch.empty:
+            continue
+
+        upsert_master_rows(df_batch)
+        df_batch.to_csv(STREAM_CSV, mode="a", header=not STREAM_CSV.exists(), index=False)
+
+        for project in project_rows(df_batch):
+            project_stream.put(project)
+            processed_project_codes.add(str(project["project_code"]).strip())
+
+        rows_written += len(df_batch)
+        print(
+            f"[stream] docs={len(docs)} | rows={len(df_batch)} | total_indexes={len(processed_run_indexes)} "
+            f"| total_rows={rows_written} | projects={len(processed_project_codes)}"
         )
 
-    df_new.to_sql(
-        TARGET_TABLE,
-        engine,
-        schema=TARGET_SCHEMA,
-        if_exists="append",
-        index=False,
-        chunksize=2000,
-        dtype=dtype,
-        method=None,
+    # the stream is closed: 1a has written its deleted-index list
+    apply_deletions()
+
+    if rows_written == 0:
+        print("[INFO] No rows produced for this run. Nothing to upsert.")
+        commit_run_fingerprints()
+        sys.exit(0)
+
+    merge_stream_csv()
+    processed_project_codes = sorted(processed_project_codes)
+
+else:
+    # JSONL is append-only during extraction; read only the latest record per index
+    df_new = parse_docs(
+        doc
+        for doc in iter_jsonl_latest(INPUT_JSONL, index_key="index")
+        if doc.get("index") is not None and str(doc.get("index")) in processed_run_indexes
+    )
+    if df_new.empty:
+        print("[INFO] No rows produced for this run. Nothing to upsert.")
+        commit_run_fingerprints()
+        sys.exit(0)
+
+    if OUT_CSV.exists():
+        old_df = pd.read_csv(OUT_CSV, dtype={"index": str})
+        old_df["index"] = old_df["index"].astype(str)
+        old_df = old_df[~old_df["index"].isin(processed_run_indexes)]
+        df_final = pd.concat([old_df, df_new], ignore_index=True)
+    else:
+        df_final = df_new
+
+    df_final.to_csv(OUT_CSV, index=False)
+
+    processed_project_codes = sorted(
+        {
+            str(x).strip()
+            for x in df_new["project_code"].dropna().tolist()
+            if str(x).strip()
+        }
     )
 
+    upsert_master_rows(df_new)
+
+    rows_written = len(df_new)
+
+PROCESSED_PROJECT_CODES_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_project_codes.txt"
+
+write_ids_txt(PROCESSED_PROJECT_CODES_TXT, processed_project_codes)
+
+print(f"[INFO] Saved processed project_codes txt: {PROCESSED_PROJECT_CODES_TXT}")
+print(f"[INFO] Project codes in this run: {len(processed_project_codes)}")
+
 print(f"Saved combined output: {OUT_CSV}")
 print(f"Saved to SQL Server: {TARGET_SCHEMA}.{TARGET_TABLE}")
-print("Rows written (this run):", len(df_new))
-print("Non-null counts (this run):\n", df_new.notna().sum())
+print("Rows written (this run):", rows_written)
+if not STREAM:
+    print("Non-null counts (this run):\n", df_new.notna().sum())
 
 with engine.begin() as conn:
-    for q in QUERIES:
-        conn.execute(sql_text(q))
\ No newline at end of file
+    if FULL_REFRESH:
+        print("[INFO] Silver refresh: full rebuild")
+        for q in QUERIES:
+            conn.execute(sql_text(q))
+    else:
+        print(f"[INFO] Silver refresh: {len(processed_run_indexes)} indexes (#idx delete + insert)")
+        stage_key_table(conn, "#idx", processed_run_indexes, column="index")
+        for q in INCREMENTAL_QUERIES:
+            conn.execute(sql_text(q))
+
+commit_run_fingerprints()
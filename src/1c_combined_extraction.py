@@ -0,0 +1,400 @@
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+import logging
+logging.getLogger("absl").setLevel(logging.ERROR)
+
+import os
+import argparse
+from pathlib import Path
+
+import langextract as lx
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.generic_extraction_config import GENERIC_CONFIG, BASE_OUTPUT_DIR
+
+from utils.extraction_helpers import (
+    text_hash,
+    annotated_to_dict,
+    safe_str,
+    jsonl_to_json_snapshot,
+    jsonl_upsert_by_index,
+    compact_jsonl,
+    iter_sql_records,
+)
+from utils.extraction_cache import open_run_cache, open_llm_cache
+from utils.extraction_planner import estimate_tokens, prompt_overhead_tokens
+from utils.rate_governor import get_governor
+from utils.batch_packing import PACKED_PROMPT_SUFFIX, extract_packed, packing_spec
+from utils.pipeline_runner import step_argv, shared_engine, get_stream
+from utils.generic_extraction import (
+    MAIN_SOURCE_QUERY,
+    load_ids_txt,
+    load_processed_ids_from_jsonl,
+    build_text_from_row,
+    apply_post_extract_rules,
+    build_combined_prompt,
+    build_combined_examples,
+    entity_class_map,
+    split_extractions_by_entity,
+)
+from utils.db import get_engine
+
+
+# =========================================================
+# ARGS
+# Combined 1c: one model call per project for all entities, written to
+# the same per-entity JSONL / cache files as 1c_generic_extraction.py,
+# so 1d_generic_post_processing.py runs unchanged.
+# To refresh a single entity: --entities asset --force-refresh
+# (or 1c_generic_extraction.py --entity asset --force-refresh).
+# =========================================================
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--entities",
+    default=",".join(GENERIC_CONFIG.keys()),
+    help="Comma-separated GENERIC_CONFIG entities to extract together (default: all)."
+)
+parser.add_argument("--run-id", required=True)
+parser.add_argument(
+    "--force-refresh",
+    action="store_true",
+    help="Re-extract the listed entities even if already in their JSONL / cache."
+)
+parser.add_argument(
+    "--upstream-ids-file",
+    required=False,
+    help="Txt file containing upstream processed indexes from 1a/1b. Read-only."
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Projects packed into one model call. Defaults to the smallest batch_size of the listed entities."
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Read projects from the pipeline stream '1b_projects' as 1b writes them instead of silver.cleaned_project.",
+)
+args = parser.parse_args(step_argv())
+
+ENTITIES = [e.strip() for e in args.entities.split(",") if e.strip()]
+RUN_ID = args.run_id.strip()
+FORCE_REFRESH = args.force_refresh
+UPSTREAM_IDS_FILE = Path(args.upstream_ids_file) if args.upstream_ids_file else None
+STREAM = args.stream
+
+unknown = [e for e in ENTITIES if e not in GENERIC_CONFIG]
+if unknown or not ENTITIES:
+    raise ValueError(
+        f"Unknown entities={unknown}. Allowed values: {', '.join(sorted(GENERIC_CONFIG.keys()))}"
+    )
+
+CFGS = {e: GENERIC_CONFIG[e]["extraction"] for e in ENTITIES}
+
+# everything that shapes the shared call must agree across the combined entities
+for key in ("index_key", "upstream_filter_column", "text_builder", "model_id", "use_schema_constraints"):
+    values = {repr(cfg.get(key)) for cfg in CFGS.values()}
+    if len(values) > 1:
+        raise ValueError(f"Entities {ENTITIES} can't be combined: they differ on '{key}'")
+
+INDEX_KEY = CFGS[ENTITIES[0]]["index_key"]
+UPSTREAM_FILTER_COLUMN = CFGS[ENTITIES[0]].get("upstream_filter_column", "index")
+TEXT_BUILDER = CFGS[ENTITIES[0]]["text_builder"]
+MODEL_ID = CFGS[ENTITIES[0]].get("model_id", "gpt-4.1-mini")
+USE_SCHEMA_CONSTRAINTS = CFGS[ENTITIES[0]].get("use_schema_constraints", False)
+CHECKPOINT_EVERY = min(cfg.get("checkpoint_every", 50) for cfg in CFGS.values())
+BATCH_SIZE = max(1, args.batch_size if args.batch_size is not None else min(cfg.get("batch_size", 1) for cfg in CFGS.values()))
+BATCH_MAX_CHARS = min(cfg.get("batch_max_chars", 6000) for cfg in CFGS.values())
+SOURCE_CHUNKSIZE = 2000
+
+CLASS_TO_ENTITY = entity_class_map(ENTITIES)
+
+
+# =========================================================
+# OUTPUT PATHS (same files as 1c_generic_extraction.py)
+# =========================================================
+RUN_OUTPUT_DIR = BASE_OUTPUT_DIR / RUN_ID
+RUN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+OUT_JSONL = {e: RUN_OUTPUT_DIR / f"{RUN_ID}_{CFGS[e]['output_jsonl_suffix']}" for e in ENTITIES}
+OUT_JSON = {e: RUN_OUTPUT_DIR / f"{RUN_ID}_{CFGS[e]['output_json_suffix']}" for e in ENTITIES}
+CACHE_PKL = {e: RUN_OUTPUT_DIR / f"{RUN_ID}_{CFGS[e]['cache_suffix']}" for e in ENTITIES}
+
+
+engine = shared_engine(get_engine)
+
+
+# =========================================================
+# STATE PER ENTITY
+# =========================================================
+print(f"[INFO] Entities: {', '.join(ENTITIES)}")
+print(f"[INFO] Force refresh mode: {FORCE_REFRESH}")
+print(f"[INFO] Batch size: {BATCH_SIZE} (max {BATCH_MAX_CHARS} chars per pack)")
+
+# combined answers are not single-entity answers: they live in their own
+# 1c_combined_<entity> namespaces, one version per (entity set, combined
+# prompt, merged examples, packing), and are never served to 1c_generic
+# (nor its results here). In the shared run cache their keys are prefixed.
+llm_caches = {}
+
+
+def combined_cache(entity: str, entities, packed: bool = False):
+    entities = tuple(entities)
+    key = (entity, entities, packed)
+    if key not in llm_caches:
+        spec = {"prompt": build_combined_prompt(list(entities)), "entities": sorted(entities)}
+        if packed:
+            spec["packing"] = packing_spec(BATCH_SIZE, BATCH_MAX_CHARS)
+        llm_caches[key] = open_llm_cache(
+            f"1c_combined_{entity}", spec, build_combined_examples(list(entities)), MODEL_ID
+        )
+    return llm_caches[key]
+
+
+def run_cache_key(ns, h: str) -> str:
+    return f"combined:{ns.version[:12]}:{h}"
+
+
+def store_result(entity: str, entities, packed: bool, h: str, result):
+    ns = combined_cache(entity, entities, packed)
+    caches[entity][run_cache_key(ns, h)] = result
+    ns[h] = result
+
+
+def cached_result(entity: str, h: str):
+    for packed in ((False, True) if BATCH_SIZE > 1 else (False,)):
+        ns = combined_cache(entity, ENTITIES, packed)
+        result = caches[entity].get(run_cache_key(ns, h))
+        if result is None:
+            result = ns.get(h)
+            if result is not None:
+                caches[entity][run_cache_key(ns, h)] = result
+        if result is not None:
+            return result
+    return None
+
+
+processed_ids = {}
+caches = {}
+for e in ENTITIES:
+    processed_ids[e] = load_processed_ids_from_jsonl(OUT_JSONL[e], INDEX_KEY)
+    caches[e] = open_run_cache(CACHE_PKL[e])
+    print(
+        f"[INFO] {e}: already in JSONL={len(processed_ids[e])} "
+        f"| run cache entries={len(caches[e])} | combined cache version={combined_cache(e, ENTITIES).version[:12]}"
+    )
+
+governor = get_governor("openai")
+
+cache_hits = {e: 0 for e in ENTITIES}
+fresh_docs = {e: 0 for e in ENTITIES}
+fallback_calls = {e: 0 for e in ENTITIES}
+processed_this_run = {e: set() for e in ENTITIES}
+batch_stats = {}
+
+
+# =========================================================
+# SOURCE (+ SQL-side filters)
+# =========================================================
+key_filters = []
+if UPSTREAM_IDS_FILE and not STREAM:
+    if not UPSTREAM_IDS_FILE.exists():
+        raise FileNotFoundError(f"Missing upstream ids file: {UPSTREAM_IDS_FILE}")
+
+    upstream_indexes = load_ids_txt(UPSTREAM_IDS_FILE)
+    if not upstream_indexes:
+        print(f"[INFO] Upstream indexes file is empty: {UPSTREAM_IDS_FILE}")
+        raise SystemExit(0)
+
+    print(f"[INFO] Upstream indexes file: {UPSTREAM_IDS_FILE} ({len(upstream_indexes)} ids)")
+    key_filters.append({"column": UPSTREAM_FILTER_COLUMN, "keys": upstream_indexes, "mode": "include"})
+
+if not FORCE_REFRESH:
+    # only rows every listed entity already has can be skipped server-side
+    done_for_all = set.intersection(*(processed_ids[e] for e in ENTITIES))
+    key_filters.append({"column": INDEX_KEY, "keys": done_for_all, "mode": "exclude"})
+
+
+# =========================================================
+# EXTRACTION
+# =========================================================
+def run_extract(entities: tuple, text: str, packed: bool = False):
+    prompt = build_combined_prompt(list(entities))
+    examples = build_combined_examples(list(entities))
+    extra = {}
+    if packed:
+        prompt = prompt + PACKED_PROMPT_SUFFIX
+        extra["max_char_buffer"] = len(text) + 1
+
+    return governor.call(
+        lx.extract,
+        est_tokens=prompt_overhead_tokens(prompt, examples) + estimate_tokens(text),
+        text_or_documents=text,
+        prompt_description=prompt,
+        examples=examples,
+        model_id=MODEL_ID,
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        fence_output=True,
+        use_schema_constraints=USE_SCHEMA_CONSTRAINTS,
+        **extra,
+    )
+
+
+def write_record(entity: str, record_id: str, row_index, text_input: str, result):
+    d = annotated_to_dict(result)
+    d = apply_post_extract_rules(d, CFGS[entity])
+
+    out = {
+        INDEX_KEY: record_id,
+        "text": text_input,
+        "extractions": d.get("extractions", []),
+    }
+
+    if row_index is not None:
+        out["index"] = row_index
+
+    if d.get("document_id"):
+        out["document_id"] = d.get("document_id")
+
+    jsonl_upsert_by_index(OUT_JSONL[entity], out, index_key=INDEX_KEY)
+    processed_this_run[entity].add(record_id)
+
+
+# (entities still missing for a text) -> {text_hash -> {"hash", "text", "records"}}
+pending = {}
+
+
+def pending_size() -> int:
+    return sum(len(groups) for groups in pending.values())
+
+
+def pending_chars() -> int:
+    return sum(len(g["text"]) for groups in pending.values() for g in groups.values())
+
+
+def flush_pending():
+    for entities, groups in list(pending.items()):
+        groups = list(groups.values())
+        results = extract_packed(
+            lambda text, packed: run_extract(entities, text, packed),
+            [g["text"] for g in groups],
+            min_extractions_per_doc=sum(CFGS[e].get("min_extractions_per_doc", 1) for e in entities),
+            stats=batch_stats,
+        )
+
+        for g, d in zip(groups, results):
+            packed = d.pop("packed")
+            by_entity = split_extractions_by_entity(d.get("extractions", []), CLASS_TO_ENTITY)
+
+            for e in entities:
+                exs = by_entity.get(e) or []
+                if exs:
+                    entity_result = {"text": g["text"], "extractions": exs}
+                    store_result(e, entities, packed, g["hash"], entity_result)
+                else:
+                    # the combined answer skipped this entity; ask for it alone
+                    fallback_calls[e] += 1
+                    entity_result = annotated_to_dict(run_extract((e,), g["text"]))
+                    store_result(e, (e,), False, g["hash"], entity_result)
+
+                fresh_docs[e] += 1
+
+                for record_id, row_index in g["records"]:
+                    write_record(e, record_id, row_index, g["text"], entity_result)
+
+    pending.clear()
+
+
+if STREAM:
+    # only this run's projects arrive on the stream; the skip of rows already
+    # in every entity's JSONL happens per row below instead of server-side
+    print("[INFO] Stream mode: reading projects from 1b as they are written")
+    source_rows = get_stream("1b_projects")
+else:
+    source_rows = iter_sql_records(engine, MAIN_SOURCE_QUERY, chunksize=SOURCE_CHUNKSIZE, key_filters=key_filters)
+
+source_rows_seen = 0
+
+for i, row in enumerate(source_rows, start=1):
+    source_rows_seen = i
+    record_id = safe_str(row.get(INDEX_KEY, ""))
+
+    if not record_id:
+        continue
+
+    needed = [e for e in ENTITIES if FORCE_REFRESH or record_id not in processed_ids[e]]
+    if not needed:
+        continue
+
+    text_input = build_text_from_row(row, TEXT_BUILDER)
+
+    if not text_input or not text_input.strip():
+        continue
+
+    row_index = safe_str(row.get("index", "")) if ("index" in row and INDEX_KEY != "index") else None
+
+    h = text_hash(text_input)
+
+    missing = []
+    for e in needed:
+        result = None if FORCE_REFRESH else cached_result(e, h)
+
+        if result is not None:
+            cache_hits[e] += 1
+            write_record(e, record_id, row_index, text_input, result)
+        else:
+            missing.append(e)
+
+    if missing:
+        groups = pending.setdefault(tuple(missing), {})
+        if h not in groups:
+            groups[h] = {"hash": h, "text": text_input, "records": []}
+        groups[h]["records"].append((record_id, row_index))
+
+        if pending_size() >= BATCH_SIZE or pending_chars() >= BATCH_MAX_CHARS:
+            flush_pending()
+
+    if i % CHECKPOINT_EVERY == 0:
+        print(
+            f"[checkpoint] rows_seen={i} | "
+            + " | ".join(
+                f"{e}: done={len(processed_this_run[e])} hits={cache_hits[e]} fresh={fresh_docs[e]}"
+                for e in ENTITIES
+            )
+        )
+        for ns in list(llm_caches.values()):
+            ns.flush_stats()
+        print(governor.stats_line())
+
+flush_pending()
+
+
+# =========================================================
+# FINAL SAVE
+# =========================================================
+print(f"[INFO] Source rows still needing work (after SQL-side filters): {source_rows_seen}")
+print(
+    f"[batch] batch_size={BATCH_SIZE} | model_calls={batch_stats.get('calls', 0)} "
+    f"| packed_calls={batch_stats.get('packed_calls', 0)} | splits={batch_stats.get('splits', 0)} "
+    f"| solo_retries={batch_stats.get('solo_retries', 0)} | entity_fallback_calls={sum(fallback_calls.values())}"
+)
+
+for e in ENTITIES:
+    dropped_lines = compact_jsonl(OUT_JSONL[e], index_key=INDEX_KEY)
+    jsonl_to_json_snapshot(OUT_JSONL[e], OUT_JSON[e], index_key=INDEX_KEY)
+    caches[e].flush()
+    print(
+        f"[DONE] entity={e} | processed_this_run={len(processed_this_run[e])} "
+        f"| cache_hits={cache_hits[e]} | fresh_docs={fresh_docs[e]} | fallback_calls={fallback_calls[e]} "
+        f"| compacted_lines={dropped_lines}"
+    )
+    print(f"Saved extraction JSONL: {OUT_JSONL[e]}")
+
+for ns in llm_caches.values():
+    ns.flush_stats()
+    print(ns.stats_line())
+print(governor.stats_line())
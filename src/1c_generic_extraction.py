@@ -7,12 +7,10 @@ logging.getLogger("absl").setLevel(logging.ERROR)
 import os
 import json
 import argparse
-import urllib
 from pathlib import Path
 
 import pandas as pd
 import langextract as lx
-from sqlalchemy import create_engine
 
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -21,20 +19,28 @@ from config.generic_extraction_config import GENERIC_CONFIG, BASE_OUTPUT_DIR
 
 from utils.extraction_helpers import (
     text_hash,
-    load_cache,
-    save_cache,
     annotated_to_dict,
     safe_str,
     build_labeled_bilingual_input,
     jsonl_to_json_snapshot,
     jsonl_upsert_by_index,
+    compact_jsonl,
+    iter_sql_records,
 )
-
-try:
-    from utils.post_processing_helpers import normalize_class
-except Exception:
-    def normalize_class(x):
-        return str(x).strip() if x is not None else ""
+from utils.extraction_cache import open_run_cache, open_llm_cache
+from utils.extraction_planner import plan_extraction, print_plan, estimate_tokens, prompt_overhead_tokens
+from utils.rate_governor import get_governor
+from utils.batch_packing import PACKED_PROMPT_SUFFIX, extract_packed, packing_spec
+from utils.pipeline_runner import step_argv, shared_engine
+
+from utils.generic_extraction import (
+    MAIN_SOURCE_QUERY,
+    load_ids_txt,
+    load_processed_ids_from_jsonl,
+    build_text_from_row,
+    apply_post_extract_rules,
+)
+from utils.db import get_engine
 
 
 # =========================================================
@@ -58,13 +64,25 @@ parser.add_argument(
     action="store_true",
     help="If set, use built-in 1c source query instead of config source_query."
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Uncached projects packed into one model call. Defaults to the entity's batch_size (1 = no packing)."
+)
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="Dry run: report skips, cache hits, fresh calls, tokens, cost and wall time, then exit. No model calls."
+)
+args = parser.parse_args(step_argv())
 
 ENTITY = args.entity.strip()
 RUN_ID = args.run_id.strip()
 FORCE_REFRESH = args.force_refresh
 UPSTREAM_IDS_FILE = Path(args.upstream_ids_file) if args.upstream_ids_file else None
 USE_MAIN_SOURCE_QUERY = args.use_main_source_query
+PLAN_ONLY = args.plan
 
 if ENTITY not in GENERIC_CONFIG:
     raise ValueError(
@@ -73,6 +91,10 @@ if ENTITY not in GENERIC_CONFIG:
 
 CFG = GENERIC_CONFIG[ENTITY]["extraction"]
 
+BATCH_SIZE = max(1, args.batch_size if args.batch_size is not None else CFG.get("batch_size", 1))
+BATCH_MAX_CHARS = CFG.get("batch_max_chars", 6000)
+MIN_EXTRACTIONS_PER_DOC = CFG.get("min_extractions_per_doc", 1)
+
 
 # =========================================================
 # OUTPUT PATHS
@@ -85,128 +107,25 @@ OUT_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_{CFG['output_json_suffix']}"
 CACHE_PKL = RUN_OUTPUT_DIR / f"{RUN_ID}_{CFG['cache_suffix']}"
 
 
-# =========================================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =========================================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-engine = get_sql_server_engine()
-
-
-# =========================================================
-# HELPERS
-# =========================================================
-def load_ids_txt(path: Path) -> set[str]:
-    return {
-        line.strip()
-        for line in path.read_text(encoding="utf-8").splitlines()
-        if line.strip()
-    }
-
-
-def load_processed_ids_from_jsonl(path: Path, id_key: str) -> set[str]:
-    if not path.exists():
-        return set()
-
-    ids = set()
-    with open(path, "r", encoding="utf-8") as f:
-        for line_no, line in enumerate(f, start=1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                rec = json.loads(line)
-            except json.JSONDecodeError:
-                print(f"[WARN] Skipping invalid JSONL line {line_no}")
-                continue
-
-            val = safe_str(rec.get(id_key))
-            if val:
-                ids.add(val)
-
-    return ids
-
-
-def build_text_from_row(row: dict, text_builder_cfg: dict) -> str:
-    builder_type = text_builder_cfg.get("type", "bilingual_basic")
-
-    if builder_type == "bilingual_basic":
-        title_en = safe_str(row.get("project_title_en", "") or "")
-        desc_en = safe_str(row.get("project_description_en", "") or "")
-        title_ar = safe_str(row.get("project_title_ar", "") or "")
-        desc_ar = safe_str(row.get("project_description_ar", "") or "")
-
-        return build_labeled_bilingual_input(
-            title_en=title_en,
-            desc_en=desc_en,
-            title_ar=title_ar,
-            desc_ar=desc_ar,
-        )
-
-    raise ValueError(f"Unsupported text_builder type: {builder_type}")
-
-
-def normalize_null_extraction_text(x):
-    if x is None:
-        return "NULL"
-    s = str(x).strip()
-    return s if s else "NULL"
-
-
-def apply_post_extract_rules(extraction_dict: dict) -> dict:
-    rules = CFG.get("post_extract_rules", {})
-    exs = extraction_dict.get("extractions", []) or []
-
-    if rules.get("normalize_null_extraction_text"):
-        for e in exs:
-            e["extraction_text"] = normalize_null_extraction_text(e.get("extraction_text"))
-
-    if rules.get("asset_null_forces_category_null"):
-        asset_val = None
-        for e in exs:
-            if normalize_class(e.get("extraction_class")).lower() == "asset":
-                asset_val = str(e.get("extraction_text")).strip()
-                break
-
-        if asset_val == "NULL":
-            for e in exs:
-                if normalize_class(e.get("extraction_class")).lower() == "asset_category":
-                    e["extraction_text"] = "NULL"
-
-    extraction_dict["extractions"] = exs
-    return extraction_dict
+engine = shared_engine(get_engine)
 
 
 # =========================================================
 # LOAD SOURCE DATA
 # =========================================================
 if USE_MAIN_SOURCE_QUERY:
-    source_query = """
-    SELECT
-        cp.[index]
-        , cp.project_code
-        , cp.project_title_en
-        , cp.project_title_ar
-        , cp.project_description_en
-        , cp.project_description_ar
-    FROM silver.cleaned_project cp
-    """
+    source_query = MAIN_SOURCE_QUERY
     print("[INFO] Source query mode: main.py / built-in 1c query")
 else:
     source_query = CFG["source_query"]
     print("[INFO] Source query mode: config entity query")
 
-df_input = pd.read_sql(source_query, engine)
-print(f"[INFO] Source rows before upstream filtering: {len(df_input)}")
+SOURCE_CHUNKSIZE = CFG.get("source_chunksize", 2000)
 
+upstream_indexes = None
+upstream_filter_column = CFG.get("upstream_filter_column", "index")
+
+print(f"[INFO] Entity: {ENTITY}")
 if UPSTREAM_IDS_FILE:
     if not UPSTREAM_IDS_FILE.exists():
         raise FileNotFoundError(f"Missing upstream ids file: {UPSTREAM_IDS_FILE}")
@@ -216,35 +135,63 @@ if UPSTREAM_IDS_FILE:
         print(f"[INFO] Upstream indexes file is empty: {UPSTREAM_IDS_FILE}")
         raise SystemExit(0)
 
-    upstream_filter_column = CFG.get("upstream_filter_column", "index")
-    if upstream_filter_column not in df_input.columns:
-        raise ValueError(
-            f"upstream_filter_column='{upstream_filter_column}' not found in source query output for entity='{ENTITY}'. "
-            f"Available columns: {list(df_input.columns)}"
-        )
-
-    before_count = len(df_input)
-    df_input[upstream_filter_column] = df_input[upstream_filter_column].astype(str).str.strip()
-    df_input = df_input[df_input[upstream_filter_column].isin(upstream_indexes)].copy()
-
-    print(f"[INFO] Entity: {ENTITY}")
     print(f"[INFO] Upstream indexes file: {UPSTREAM_IDS_FILE}")
     print(f"[INFO] Upstream indexes count: {len(upstream_indexes)}")
-    print(f"[INFO] Rows after upstream filter on '{upstream_filter_column}': {len(df_input)} / {before_count}")
 else:
-    print(f"[INFO] Entity: {ENTITY}")
     print("[INFO] No upstream ids file provided. Processing full source query output.")
 
 processed_ids = load_processed_ids_from_jsonl(OUT_JSONL, CFG["index_key"])
 print(f"[INFO] Already in JSONL: {len(processed_ids)} {CFG['index_key']} values")
 print(f"[INFO] Force refresh mode: {FORCE_REFRESH}")
+print(f"[INFO] Batch size: {BATCH_SIZE} (max {BATCH_MAX_CHARS} chars per pack)")
 
+cache = open_run_cache(CACHE_PKL)
 if FORCE_REFRESH:
-    cache = {}
-    print("[INFO] Force refresh mode: ignoring existing cache")
+    print("[INFO] Force refresh mode: ignoring existing cache entries (fresh results overwrite them)")
 else:
-    cache = load_cache(CACHE_PKL)
-    print(f"[INFO] Loaded cache entries: {len(cache)} from {CACHE_PKL.name}")
+    print(f"[INFO] Opened cache entries: {len(cache)} from {cache.path.name}")
+
+MODEL_ID = CFG.get("model_id", "gpt-4.1-mini")
+PROMPT_OVERHEAD_TOKENS = prompt_overhead_tokens(CFG["prompt"], CFG["examples"])
+governor = get_governor("openai")
+
+# cross-run cache: one namespace per entity, so editing one entity's prompt
+# or examples only invalidates that entity's entries
+llm_cache = open_llm_cache(f"1c_{ENTITY}", CFG["prompt"], CFG["examples"], MODEL_ID)
+print(f"[INFO] Global LLM cache: {llm_cache.cache.path} | version={llm_cache.version[:12]}")
+
+# results of packed calls get their own namespace, versioned on the packing
+# format and batch size too: they are served to packed runs with the same
+# settings only, never as single-call results
+packed_cache = None
+if BATCH_SIZE > 1:
+    packed_cache = open_llm_cache(
+        f"1c_{ENTITY}_packed",
+        {"prompt": CFG["prompt"], "packing": packing_spec(BATCH_SIZE, BATCH_MAX_CHARS)},
+        CFG["examples"],
+        MODEL_ID,
+    )
+    print(f"[INFO] Packed-result cache version={packed_cache.version[:12]}")
+
+
+def packed_key(h: str) -> str:
+    """Run-cache key of a packed result (plain text_hash keys hold single-call results)."""
+    return f"packed:{packed_cache.version[:12]}:{h}"
+
+
+def cached_result(h: str):
+    result = cache.get(h)
+    if result is None:
+        result = llm_cache.get(h)
+        if result is not None:
+            cache[h] = result
+    if result is None and packed_cache is not None:
+        result = cache.get(packed_key(h))
+        if result is None:
+            result = packed_cache.get(h)
+            if result is not None:
+                cache[packed_key(h)] = result
+    return result
 
 CHECKPOINT_EVERY = CFG.get("checkpoint_every", 50)
 cache_hits = 0
@@ -252,10 +199,129 @@ fresh_calls = 0
 processed_this_run = set()
 
 
+# =========================================================
+# DRY RUN (--plan)
+# =========================================================
+if PLAN_ONLY:
+    plan_filters = []
+    if upstream_indexes is not None:
+        plan_filters.append({"column": upstream_filter_column, "keys": upstream_indexes, "mode": "include"})
+
+    def iter_plan_rows():
+        for row in iter_sql_records(engine, source_query, chunksize=SOURCE_CHUNKSIZE, key_filters=plan_filters):
+            record_id = safe_str(row.get(CFG["index_key"], ""))
+            text_input = build_text_from_row(row, CFG["text_builder"])
+            if record_id and text_input and text_input.strip():
+                yield record_id, text_input
+
+    plan = plan_extraction(
+        iter_plan_rows(),
+        prompt=CFG["prompt"],
+        examples=CFG["examples"],
+        caches=[c for c in (cache, llm_cache, packed_cache) if c is not None],
+        processed_keys=processed_ids,
+        force_refresh=FORCE_REFRESH,
+        label=f"1c {ENTITY} {RUN_ID}",
+    )
+    print_plan(plan)
+    raise SystemExit(0)
+
+
 # =========================================================
 # EXTRACTION LOOP
 # =========================================================
-for i, row in enumerate(df_input.to_dict("records"), start=1):
+# upstream ids and ids already in the JSONL are applied server-side via #temp key tables
+key_filters = []
+if upstream_indexes is not None:
+    key_filters.append({"column": upstream_filter_column, "keys": upstream_indexes, "mode": "include"})
+if not FORCE_REFRESH:
+    key_filters.append({"column": CFG["index_key"], "keys": processed_ids, "mode": "exclude"})
+
+def run_extract(text: str, packed: bool = False):
+    prompt = CFG["prompt"]
+    extra = {}
+    if packed:
+        prompt = prompt + PACKED_PROMPT_SUFFIX
+        # one call for the whole pack: don't let langextract chunk it
+        extra["max_char_buffer"] = len(text) + 1
+
+    return governor.call(
+        lx.extract,
+        est_tokens=PROMPT_OVERHEAD_TOKENS + estimate_tokens(text),
+        text_or_documents=text,
+        prompt_description=prompt,
+        examples=CFG["examples"],
+        model_id=MODEL_ID,
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        fence_output=True,
+        use_schema_constraints=CFG.get("use_schema_constraints", False),
+        **extra,
+    )
+
+
+def write_record(record_id: str, row_index, text_input: str, result):
+    d = annotated_to_dict(result)
+    d = apply_post_extract_rules(d, CFG)
+
+    out = {
+        CFG["index_key"]: record_id,
+        "text": text_input,
+        "extractions": d.get("extractions", []),
+    }
+
+    if row_index is not None:
+        out["index"] = row_index
+
+    if d.get("document_id"):
+        out["document_id"] = d.get("document_id")
+
+    jsonl_upsert_by_index(OUT_JSONL, out, index_key=CFG["index_key"])
+    processed_this_run.add(record_id)
+
+
+# batch mode: uncached texts wait here (one entry per text_hash) until a pack is full
+pending = {}
+pending_chars = 0
+batch_stats = {}
+
+
+def flush_pending():
+    global fresh_calls, pending_chars
+
+    if not pending:
+        return
+
+    groups = list(pending.values())
+    results = extract_packed(
+        run_extract,
+        [g["text"] for g in groups],
+        min_extractions_per_doc=MIN_EXTRACTIONS_PER_DOC,
+        stats=batch_stats,
+    )
+
+    for g, d in zip(groups, results):
+        # cached per document; results of a call of their own are plain single-call results
+        if d.pop("packed"):
+            cache[packed_key(g["hash"])] = d
+            packed_cache[g["hash"]] = d
+        else:
+            cache[g["hash"]] = d
+            llm_cache[g["hash"]] = d
+        fresh_calls += 1
+        for record_id, row_index in g["records"]:
+            write_record(record_id, row_index, g["text"], d)
+
+    pending.clear()
+    pending_chars = 0
+
+
+source_rows_seen = 0
+
+for i, row in enumerate(
+    iter_sql_records(engine, source_query, chunksize=SOURCE_CHUNKSIZE, key_filters=key_filters),
+    start=1,
+):
+    source_rows_seen = i
     record_id = safe_str(row.get(CFG["index_key"], ""))
 
     if not record_id:
@@ -269,60 +335,70 @@ for i, row in enumerate(df_input.to_dict("records"), start=1):
     if not text_input or not text_input.strip():
         continue
 
+    row_index = safe_str(row.get("index", "")) if ("index" in row and CFG["index_key"] != "index") else None
+
     h = text_hash(text_input)
 
-    if h in cache:
-        result = cache[h]
+    result = None if FORCE_REFRESH else cached_result(h)
+
+    if result is not None:
         cache_hits += 1
+        write_record(record_id, row_index, text_input, result)
+    elif BATCH_SIZE > 1:
+        if h not in pending:
+            pending[h] = {"hash": h, "text": text_input, "records": []}
+            pending_chars += len(text_input)
+        pending[h]["records"].append((record_id, row_index))
+
+        if len(pending) >= BATCH_SIZE or pending_chars >= BATCH_MAX_CHARS:
+            flush_pending()
     else:
-        result = lx.extract(
-            text_or_documents=text_input,
-            prompt_description=CFG["prompt"],
-            examples=CFG["examples"],
-            model_id=CFG.get("model_id", "gpt-4.1-mini"),
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            fence_output=True,
-            use_schema_constraints=CFG.get("use_schema_constraints", False),
-        )
+        result = run_extract(text_input)
         cache[h] = result
+        llm_cache[h] = result
         fresh_calls += 1
-
-    d = annotated_to_dict(result)
-    d = apply_post_extract_rules(d)
-
-    out = {
-        CFG["index_key"]: record_id,
-        "text": text_input,
-        "extractions": d.get("extractions", []),
-    }
-
-    if "index" in row and CFG["index_key"] != "index":
-        out["index"] = safe_str(row.get("index", ""))
-
-    if d.get("document_id"):
-        out["document_id"] = d.get("document_id")
-
-    jsonl_upsert_by_index(OUT_JSONL, out, index_key=CFG["index_key"])
-    processed_this_run.add(record_id)
+        write_record(record_id, row_index, text_input, result)
 
     if i % CHECKPOINT_EVERY == 0:
-        save_cache(cache, CACHE_PKL)
-        jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
         print(
             f"[checkpoint] rows_seen={i} | processed_this_run={len(processed_this_run)} "
             f"| cache_hits={cache_hits} | fresh_calls={fresh_calls} | cache_size={len(cache)}"
         )
+        llm_cache.flush_stats()
+        if packed_cache is not None:
+            packed_cache.flush_stats()
+        print(governor.stats_line())
+
+flush_pending()
 
 # =========================================================
 # FINAL SAVE
 # =========================================================
-jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
-save_cache(cache, CACHE_PKL)
-
+print(f"[INFO] Source rows still needing work (after SQL-side filters): {source_rows_seen}")
+
+dropped_lines = compact_jsonl(OUT_JSONL, index_key=CFG["index_key"])
+print(f"[INFO] Compacted JSONL: dropped {dropped_lines} superseded lines")
+
+jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON, index_key=CFG["index_key"])
+cache.flush()
+llm_cache.flush_stats()
+if packed_cache is not None:
+    packed_cache.flush_stats()
+
+print(llm_cache.stats_line())
+if packed_cache is not None:
+    print(packed_cache.stats_line())
+print(governor.stats_line())
+if BATCH_SIZE > 1:
+    print(
+        f"[batch] batch_size={BATCH_SIZE} | docs_extracted={fresh_calls} | model_calls={batch_stats.get('calls', 0)} "
+        f"| packed_calls={batch_stats.get('packed_calls', 0)} | splits={batch_stats.get('splits', 0)} "
+        f"| solo_retries={batch_stats.get('solo_retries', 0)}"
+    )
 print(
     f"[DONE] entity={ENTITY} | processed_this_run={len(processed_this_run)} "
     f"| cache_hits={cache_hits} | fresh_calls={fresh_calls}"
 )
 print(f"Saved debug JSON:       {OUT_JSON}")
 print(f"Saved extraction JSONL: {OUT_JSONL}")
-print(f"Saved cache:            {CACHE_PKL} (entries={len(cache)})")
\ No newline at end of file
+print(f"Saved cache:            {cache.path} (entries={len(cache)})")
\ No newline at end of file
@@ -1,12 +1,10 @@
-import json
 import re
 import argparse
-import urllib
 from pathlib import Path
 from datetime import datetime
 
 import pandas as pd
-from sqlalchemy import create_engine, text as sql_text
+from sqlalchemy import text as sql_text
 from sqlalchemy.types import NVARCHAR, Integer, Float, DateTime
 
 import sys
@@ -14,6 +12,11 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from config.generic_extraction_config import GENERIC_CONFIG, BASE_OUTPUT_DIR
 from utils.post_processing_helpers import normalize_class, _is_blank
+from utils.extraction_helpers import iter_jsonl_latest, stage_key_table
+from utils.post_processing_sql_queries import PROJECT_TYPE_REFRESH_QUERIES
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt
+from utils.sql_upsert import upsert_dataframe, format_counts
+from utils.db import get_engine
 
 
 # =========================================================
@@ -32,7 +35,7 @@ parser.add_argument(
     action="store_true",
     help="If set, post-process all rows in the entity JSONL instead of only upstream indexes."
 )
-args = parser.parse_args()
+args = parser.parse_args(step_argv())
 
 ENTITY = args.entity.strip()
 RUN_ID = args.run_id.strip()
@@ -55,23 +58,7 @@ INPUT_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_{CFG['input_jsonl_suffix']}"
 OUT_CSV = RUN_OUTPUT_DIR / f"{RUN_ID}_{CFG['output_csv_suffix']}"
 
 
-# =========================================================
-# SQL SERVER CONNECTION
-# =========================================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={params}",
-        fast_executemany=True
-    )
-
-engine = get_sql_server_engine()
+engine = shared_engine(get_engine)
 
 
 # =========================================================
@@ -84,26 +71,9 @@ def safe_text(x):
     return s if s else None
 
 
-def load_ids_txt(path: Path) -> set[str]:
-    return {
-        line.strip()
-        for line in path.read_text(encoding="utf-8").splitlines()
-        if line.strip()
-    }
-
-
 def parse_jsonl(path: Path):
-    rows = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line_no, line in enumerate(f, start=1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                rows.append(json.loads(line))
-            except json.JSONDecodeError as e:
-                print(f"[WARN] Skipping invalid JSONL line {line_no}: {e}")
-    return rows
+    # extraction JSONL is append-only; keep only the latest record per primary key
+    return list(iter_jsonl_latest(path, index_key=CFG["primary_key"]))
 
 
 def to_none_if_nullish(x):
@@ -203,40 +173,6 @@ def normalize_uom(uom: str):
     return s
 
 
-def ensure_target_table_exists(
-    df_sample: pd.DataFrame,
-    target_schema: str,
-    target_table: str,
-    dtype_map: dict
-) -> None:
-    full_name = f"{target_schema}.{target_table}"
-
-    with engine.begin() as conn:
-        exists = conn.execute(
-            sql_text(
-                f"""
-                SELECT 1
-                WHERE OBJECT_ID('{full_name}', 'U') IS NOT NULL
-                """
-            )
-        ).fetchone()
-
-    if exists:
-        return
-
-    print(f"[INFO] Target table does not exist. Creating: {full_name}")
-
-    df_sample.head(0).to_sql(
-        name=target_table,
-        schema=target_schema,
-        con=engine,
-        if_exists="append",
-        index=False,
-        dtype=dtype_map,
-        method=None,
-    )
-
-
 # =========================================================
 # ENTITY-SPECIFIC ROW BUILDERS
 # =========================================================
@@ -423,7 +359,7 @@ else:
             f"Missing upstream ids file: {UPSTREAM_IDS_FILE}"
         )
 
-    upstream_indexes = load_ids_txt(UPSTREAM_IDS_FILE)
+    upstream_indexes = read_ids_txt(UPSTREAM_IDS_FILE)
     print(f"[INFO] Mode: incremental")
     print(f"[INFO] Upstream index count: {len(upstream_indexes)}")
 
@@ -499,65 +435,27 @@ target_table = CFG["target_table"].split(".")[-1]
 
 dtype_map = get_dtype_map()
 
-ensure_target_table_exists(
-    df_sample=df,
-    target_schema=target_schema,
-    target_table=target_table,
-    dtype_map=dtype_map,
-)
-
 pk_values_to_upsert = sorted(set(df[pk].dropna().astype(str)))
 if not pk_values_to_upsert:
     print(f"[INFO] No {pk} values to upsert.")
     raise SystemExit(0)
 
 print(
-    f"[INFO] Upserting {len(pk_values_to_upsert)} {pk} values into {target_schema}.{target_table}"
+    f"[INFO] Upserting {len(pk_values_to_upsert)} {pk} values into {target_schema}.{target_table} (staged MERGE)"
 )
 
-df_pk = pd.DataFrame({pk: pk_values_to_upsert})
-
-with engine.begin() as conn:
-    conn.execute(sql_text("IF OBJECT_ID('tempdb..#pk_ids') IS NOT NULL DROP TABLE #pk_ids;"))
-    conn.execute(
-        sql_text(
-            f"""
-            CREATE TABLE #pk_ids (
-                [{pk}] NVARCHAR(255) NOT NULL PRIMARY KEY
-            );
-            """
-        )
-    )
-
-    df_pk.to_sql(
-        "#pk_ids",
-        conn,
-        if_exists="append",
-        index=False,
-        method=None,
-    )
-
-    conn.execute(
-        sql_text(
-            f"""
-            DELETE T
-            FROM {target_schema}.{target_table} AS T
-            INNER JOIN #pk_ids AS P
-                ON CAST(T.[{pk}] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
-                 = P.[{pk}] COLLATE DATABASE_DEFAULT;
-            """
-        )
-    )
-
-df.to_sql(
-    name=target_table,
-    schema=target_schema,
-    con=engine,
-    if_exists="append",
-    index=False,
+counts = upsert_dataframe(
+    engine,
+    df,
+    f"{target_schema}.{target_table}",
+    key_columns=[pk],
     dtype=dtype_map,
-    chunksize=2000,
-    method=None,
 )
+print(f"[INFO] MERGE {target_schema}.{target_table}: {format_counts(counts)}")
 
-print(f"[DONE] Upserted into SQL table: {target_schema}.{target_table}")
\ No newline at end of file
+if CFG.get("refresh_dependent_silver"):
+    with engine.begin() as conn:
+        stage_key_table(conn, "#codes", pk_values_to_upsert, column="project_code")
+        for q in PROJECT_TYPE_REFRESH_QUERIES:
+            conn.execute(sql_text(q))
+    print(f"[INFO] Refreshed project_type-joined silver rows for {len(pk_values_to_upsert)} {pk} values")
@@ -1,9 +1,12 @@
 import argparse
-import subprocess
 import sys
 from datetime import datetime
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.pipeline_runner import run_pipeline
+
 
 # =========================================================
 # HELPERS
@@ -12,22 +15,6 @@ def generate_run_id() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
-def run_step(step_name: str, cmd: list[str]) -> None:
-    print("\n" + "=" * 80)
-    print(f"[PIPELINE] Starting: {step_name}")
-    print("[PIPELINE] Command:", " ".join(cmd))
-    print("=" * 80)
-
-    result = subprocess.run(cmd, check=False)
-
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"Step failed: {step_name} | returncode={result.returncode}"
-        )
-
-    print(f"[PIPELINE] Completed: {step_name}")
-
-
 # =========================================================
 # ARGS
 # =========================================================
@@ -44,16 +31,22 @@ parser.add_argument(
     action="store_true",
     help="If set, pass --force-refresh to 2a subsector extraction.",
 )
+parser.add_argument(
+    "--subprocess",
+    action="store_true",
+    help="Run every step in its own Python process (old behaviour) instead of in-process.",
+)
 
 args = parser.parse_args()
 
 RUN_ID = args.run_id.strip() if args.run_id else generate_run_id()
 FORCE_REFRESH = args.force_refresh
+IN_PROCESS = not args.subprocess
 
 print(f"[PIPELINE] RUN_ID = {RUN_ID}")
 print(f"[PIPELINE] FORCE_REFRESH = {FORCE_REFRESH}")
+print(f"[PIPELINE] MODE = {'in-process' if IN_PROCESS else 'subprocess'}")
 
-PYTHON_EXE = sys.executable
 BASE_DIR = Path(__file__).resolve().parent
 
 STEP_2A = BASE_DIR / "2a_subsector_extraction.py"
@@ -66,24 +59,21 @@ for step_file in [STEP_2A, STEP_2B, STEP_2C]:
 
 RUN_OUTPUT_DIR = Path("data/outputs/project_attributes") / RUN_ID
 UPSTREAM_IDS_FILE = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
+TIMINGS_JSON = RUN_OUTPUT_DIR / f"{RUN_ID}_pipeline_timings.json"
 
 
-def build_2a_cmd() -> list[str]:
-    cmd = [
-        PYTHON_EXE,
-        str(STEP_2A),
+def build_2a_argv() -> list[str]:
+    argv = [
         "--run-id",
         RUN_ID,
     ]
     if FORCE_REFRESH:
-        cmd.append("--force-refresh")
-    return cmd
+        argv.append("--force-refresh")
+    return argv
 
 
-def build_2b_cmd() -> list[str]:
+def build_2b_argv() -> list[str]:
     return [
-        PYTHON_EXE,
-        str(STEP_2B),
         "--run-id",
         RUN_ID,
         "--upstream-ids-file",
@@ -91,10 +81,8 @@ def build_2b_cmd() -> list[str]:
     ]
 
 
-def build_2c_cmd() -> list[str]:
+def build_2c_argv() -> list[str]:
     return [
-        PYTHON_EXE,
-        str(STEP_2C),
         "--run-id",
         RUN_ID,
         "--upstream-ids-file",
@@ -105,30 +93,16 @@ def build_2c_cmd() -> list[str]:
 # =========================================================
 # PIPELINE
 # 2a -> 2b -> 2c
+# (2c reads the subsectors 2b writes to silver.cleaned_project_attributes)
 # =========================================================
-try:
-    # -------------------------
-    # 2a
-    # -------------------------
-    run_step("2a_subsector_extraction", build_2a_cmd())
+STEPS = [
+    {"name": "2a_subsector_extraction", "script": STEP_2A, "argv": build_2a_argv(), "deps": []},
+    {"name": "2b_subsector_post_processing", "script": STEP_2B, "argv": build_2b_argv(), "deps": ["2a_subsector_extraction"]},
+    {"name": "2c_sdgs_extraction", "script": STEP_2C, "argv": build_2c_argv(), "deps": ["2b_subsector_post_processing"]},
+]
 
-    # after 2a, processed_indexes for this run must exist
-    if not UPSTREAM_IDS_FILE.exists():
-        raise FileNotFoundError(
-            f"Missing processed indexes file created by 2a: {UPSTREAM_IDS_FILE}"
-        )
-
-    print(f"[PIPELINE] Processed indexes file from 2a = {UPSTREAM_IDS_FILE}")
-
-    # -------------------------
-    # 2b
-    # -------------------------
-    run_step("2b_subsector_post_processing", build_2b_cmd())
-
-    # -------------------------
-    # 2c
-    # -------------------------
-    run_step("2c_sdgs_extraction", build_2c_cmd())
+try:
+    run_pipeline(STEPS, in_process=IN_PROCESS, timings_path=TIMINGS_JSON)
 
     print("\n" + "=" * 80)
     print("[PIPELINE] ALL STEPS COMPLETED SUCCESSFULLY")
@@ -141,4 +115,4 @@ except Exception as e:
     print(f"[PIPELINE] RUN_ID: {RUN_ID}")
     print(f"[PIPELINE] ERROR: {e}")
     print("=" * 80)
-    sys.exit(1)
\ No newline at end of file
+    sys.exit(1)
@@ -9,8 +9,6 @@ import os
 import json
 import argparse
 from pathlib import Path
-from sqlalchemy import create_engine
-import urllib
 
 import pandas as pd
 import langextract as lx
@@ -27,15 +25,20 @@ from utils.project_attributes_list import (
 
 from utils.extraction_helpers import (
     text_hash,
-    load_cache,
-    save_cache,
     annotated_to_dict,
     jsonl_to_json_snapshot,
     safe_str,
     build_labeled_bilingual_input,
     jsonl_upsert_by_project_code,
-    normalize_text
+    compact_jsonl,
+    normalize_text,
 )
+from utils.master_snapshot import iter_source_records
+from utils.extraction_cache import open_run_cache, open_llm_cache
+from utils.extraction_planner import plan_extraction, print_plan, estimate_tokens, prompt_overhead_tokens
+from utils.rate_governor import get_governor
+from utils.pipeline_runner import step_argv, shared_engine, write_ids_txt
+from utils.db import get_engine
 
 # -----------------------
 # args + output paths
@@ -47,10 +50,16 @@ parser.add_argument(
     action="store_true",
     help="If set, bypass cache and re-extract even if project_code already exists in JSONL."
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="Dry run: report skips, cache hits, fresh calls, tokens, cost and wall time, then exit. No model calls."
+)
+args = parser.parse_args(step_argv())
 
 RUN_ID = args.run_id.strip()
 FORCE_REFRESH = args.force_refresh
+PLAN_ONLY = args.plan
 
 RUN_OUTPUT_DIR = Path("data/outputs/project_attributes") / RUN_ID
 RUN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -61,20 +70,7 @@ CACHE_PKL = RUN_OUTPUT_DIR / f"{RUN_ID}_lx_cache.pkl"
 PROCESSED_INDEXES_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
 
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-engine = get_sql_server_engine()
+engine = shared_engine(get_engine)
 
 
 # =====================================
@@ -103,18 +99,55 @@ def load_processed_project_codes_from_jsonl(path: Path) -> set[str]:
     return processed
 
 
+def build_attr_text(row: dict) -> str:
+    """Model input for one project row; "" when the row has no title/description."""
+    emergency_title = safe_str(row.get("emergency_title", None) or "")
+    year = safe_str(row.get("year", None) or "")
+
+    title_en = safe_str(row.get("project_title_en", "") or "")
+    description_en = safe_str(row.get("project_description_en", "") or "")
+    title_ar = safe_str(row.get("project_title_ar", "") or "")
+    description_ar = safe_str(row.get("project_description_ar", "") or "")
+
+    if not (title_en.strip() or description_en.strip() or title_ar.strip() or description_ar.strip()):
+        return ""
+
+    return f"""
+YEAR: {year}
+EMERGENCY_TITLE: {emergency_title}
+{build_labeled_bilingual_input(
+    title_en=title_en,
+    desc_en=description_en,
+    title_ar=title_ar,
+    desc_ar=description_ar,
+)}
+""".strip()
+
+
 # =====================================
 # SOURCE QUERY
 # 2a must process ALL indexes from this query
+# (only the columns the loop reads; streamed in chunks)
 # =====================================
 SOURCE_QUERY = """
 SELECT
-    a.*
+    a.[index]
+    , a.project_code
+    , a.project_title_en
+    , a.project_title_ar
+    , a.project_description_en
+    , a.project_description_ar
     , COALESCE(b.EmergencyTitle, b.EmergencyTitleAR) AS emergency_title
     , b.year
 FROM
 (
-    SELECT *
+    SELECT
+        cp.[index]
+        , cp.project_code
+        , cp.project_title_en
+        , cp.project_title_ar
+        , cp.project_description_en
+        , cp.project_description_ar
     FROM [silver].[cleaned_project] cp
     WHERE cp.master_project_code IN (
         SELECT master_project_code
@@ -128,8 +161,7 @@ LEFT JOIN [dbo].[MasterTableDenormalizedCleanedFinal] b
 --where a.[index] = 'DAR-2012-083'
 """
 
-df_input = pd.read_sql(SOURCE_QUERY, engine)
-print(f"[INFO] Source rows from SQL query: {len(df_input)}")
+SOURCE_CHUNKSIZE = 2000
 
 processed_project_codes = load_processed_project_codes_from_jsonl(OUT_JSONL)
 print(f"[INFO] Already in JSONL: {len(processed_project_codes)} project_code values")
@@ -151,23 +183,60 @@ ATTR_PROMPT = build_project_attr_prompt(allowed_subsectors)
 # -----------------------
 CHECKPOINT_EVERY = 50
 
+cache = open_run_cache(CACHE_PKL)
 if FORCE_REFRESH:
-    cache = {}
-    print("[INFO] Force refresh mode: ignoring existing cache")
+    print("[INFO] Force refresh mode: ignoring existing cache entries (fresh results overwrite them)")
 else:
-    cache = load_cache(CACHE_PKL)
-    print(f"[INFO] Loaded cache entries: {len(cache)} from {CACHE_PKL.name}")
+    print(f"[INFO] Opened cache entries: {len(cache)} from {cache.path.name}")
+
+MODEL_ID = "gpt-4.1-mini"
+PROMPT_OVERHEAD_TOKENS = prompt_overhead_tokens(ATTR_PROMPT, EXAMPLES)
+governor = get_governor("openai")
+
+# cross-run cache; ATTR_PROMPT embeds the allowed subsector list, so a
+# change to that list invalidates this namespace as well
+llm_cache = open_llm_cache("2a_project_attributes", ATTR_PROMPT, EXAMPLES, MODEL_ID)
+print(f"[INFO] Global LLM cache: {llm_cache.cache.path} | version={llm_cache.version[:12]}")
 
 processed_this_run = 0
 processed_this_run_indexes = set()
 cache_hits = 0
 fresh_calls = 0
 
-for i, row in enumerate(df_input.itertuples(index=False), start=1):
-    index = safe_str(getattr(row, "index", None) or "")
-    project_code = safe_str(getattr(row, "project_code", None) or "")
-    emergency_title = safe_str(getattr(row, "emergency_title", None) or "")
-    year = safe_str(getattr(row, "year", None) or "")
+source_rows_seen = 0
+
+if PLAN_ONLY:
+    # dry run: count skips / cache hits / fresh calls without calling the model
+    def iter_plan_rows():
+        for row in iter_source_records(engine, SOURCE_QUERY, chunksize=SOURCE_CHUNKSIZE):
+            project_code = safe_str(row.get("project_code", None) or "")
+            text_bilingual = build_attr_text(row)
+            if project_code and text_bilingual:
+                yield project_code, text_bilingual
+
+    plan = plan_extraction(
+        iter_plan_rows(),
+        prompt=ATTR_PROMPT,
+        examples=EXAMPLES,
+        caches=[cache, llm_cache],
+        processed_keys=processed_project_codes,
+        force_refresh=FORCE_REFRESH,
+        label=f"2a {RUN_ID}",
+    )
+    print_plan(plan)
+    raise SystemExit(0)
+
+key_filters = [] if FORCE_REFRESH else [
+    {"column": "project_code", "keys": processed_project_codes, "mode": "exclude"},
+]
+source_rows = iter_source_records(engine, SOURCE_QUERY, chunksize=SOURCE_CHUNKSIZE, key_filters=key_filters)
+
+for i, row in enumerate(source_rows, start=1):
+    source_rows_seen = i
+    index = safe_str(row.get("index", None) or "")
+    project_code = safe_str(row.get("project_code", None) or "")
+    emergency_title = safe_str(row.get("emergency_title", None) or "")
+    year = safe_str(row.get("year", None) or "")
 
     if not project_code:
         continue
@@ -175,44 +244,37 @@ for i, row in enumerate(df_input.itertuples(index=False), start=1):
     if (not FORCE_REFRESH) and project_code in processed_project_codes:
         continue
 
-    title_en = safe_str(getattr(row, "project_title_en", "") or "")
-    description_en = safe_str(getattr(row, "project_description_en", "") or "")
-    title_ar = safe_str(getattr(row, "project_title_ar", "") or "")
-    description_ar = safe_str(getattr(row, "project_description_ar", "") or "")
-
-    if not (title_en.strip() or description_en.strip() or title_ar.strip() or description_ar.strip()):
-        continue
-
-    text_bilingual = f"""
-YEAR: {year}
-EMERGENCY_TITLE: {emergency_title}
-{build_labeled_bilingual_input(
-    title_en=title_en,
-    desc_en=description_en,
-    title_ar=title_ar,
-    desc_ar=description_ar,
-)}
-""".strip()
+    text_bilingual = build_attr_text(row)
 
     if not text_bilingual:
         continue
 
     h = text_hash(text_bilingual)
 
-    if h in cache:
-        result = cache[h]
+    result = None
+    if not FORCE_REFRESH:
+        result = cache.get(h)
+        if result is None:
+            result = llm_cache.get(h)
+            if result is not None:
+                cache[h] = result
+
+    if result is not None:
         cache_hits += 1
     else:
-        result = lx.extract(
+        result = governor.call(
+            lx.extract,
+            est_tokens=PROMPT_OVERHEAD_TOKENS + estimate_tokens(text_bilingual),
             text_or_documents=normalize_text(text_bilingual),
             prompt_description=ATTR_PROMPT,
             examples=EXAMPLES,
-            model_id="gpt-4.1-mini",
+            model_id=MODEL_ID,
             api_key=os.environ.get("OPENAI_API_KEY"),
             fence_output=True,
             use_schema_constraints=False,
         )
         cache[h] = result
+        llm_cache[h] = result
         fresh_calls += 1
 
     d = annotated_to_dict(result)
@@ -236,28 +298,30 @@ EMERGENCY_TITLE: {emergency_title}
         processed_this_run_indexes.add(index)
 
     if i % CHECKPOINT_EVERY == 0:
-        jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
-        save_cache(cache, CACHE_PKL)
-        PROCESSED_INDEXES_TXT.write_text(
-            "\n".join(sorted(processed_this_run_indexes)),
-            encoding="utf-8"
-        )
+        write_ids_txt(PROCESSED_INDEXES_TXT, processed_this_run_indexes)
         print(
             f"[checkpoint] rows_seen={i} | upserted_this_run={processed_this_run} "
             f"| processed_indexes_this_run={len(processed_this_run_indexes)} "
             f"| cache_hits={cache_hits} | fresh_calls={fresh_calls} | cache_size={len(cache)}"
         )
+        llm_cache.flush_stats()
+        print(governor.stats_line())
 
-jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
-save_cache(cache, CACHE_PKL)
-PROCESSED_INDEXES_TXT.write_text(
-    "\n".join(sorted(processed_this_run_indexes)),
-    encoding="utf-8"
-)
+print(f"[INFO] Source rows from SQL query: {source_rows_seen}")
+
+dropped_lines = compact_jsonl(OUT_JSONL, index_key="project_code")
+print(f"[INFO] Compacted JSONL: dropped {dropped_lines} superseded lines")
+
+jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON, index_key="project_code")
+cache.flush()
+llm_cache.flush_stats()
+write_ids_txt(PROCESSED_INDEXES_TXT, processed_this_run_indexes)
 
 print(f"Saved extraction JSONL: {OUT_JSONL}")
 print(f"Saved debug JSON:      {OUT_JSON}")
-print(f"Saved cache:           {CACHE_PKL} (entries={len(cache)})")
+print(f"Saved cache:           {cache.path} (entries={len(cache)})")
+print(llm_cache.stats_line())
+print(governor.stats_line())
 print(f"Saved processed indexes txt: {PROCESSED_INDEXES_TXT}")
 print(
     f"[DONE] upserted_this_run={processed_this_run} "
@@ -1,15 +1,17 @@
 import json
-import pandas as pd
 from pathlib import Path
 import argparse
-from sqlalchemy import create_engine
-import urllib
 import sys
 from sqlalchemy import text as sql_text
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from utils.post_processing_helpers import json_to_csv
+from utils.extraction_helpers import iter_jsonl_latest
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt
+from utils.bulk_writer import bulk_write
+from utils.sql_upsert import stage_keys, create_typed_staging, merge_staged, format_counts
+from utils.db import get_engine
 
 # -----------------------
 # args + paths
@@ -21,7 +23,7 @@ parser.add_argument(
     required=False,
     help="Txt file containing processed indexes from 2a for this run."
 )
-args = parser.parse_args()
+args = parser.parse_args(step_argv())
 
 RUN_ID = args.run_id.strip()
 UPSTREAM_IDS_FILE = Path(args.upstream_ids_file) if args.upstream_ids_file else None
@@ -31,51 +33,22 @@ RUN_OUTPUT_DIR = Path("data/outputs/project_attributes") / RUN_ID
 INPUT_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_project_attributes.jsonl"
 OUT_CSV = RUN_OUTPUT_DIR / f"{RUN_ID}_project_attributes.csv"
 
-# -----------------------
-# SQL Server (Windows Auth)
-# -----------------------
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
 STG_TARGET_SCHEMA = "silver"
 STG_TARGET_TABLE = "stg_project_attributes"
 
 FINAL_SCHEMA = "silver"
 FINAL_TABLE = "cleaned_project_attributes"
 
-engine = get_sql_server_engine()
+engine = shared_engine(get_engine)
 
 # -----------------------
 # helpers
 # -----------------------
-def load_ids_txt(path: Path) -> set[str]:
-    return {
-        line.strip()
-        for line in path.read_text(encoding="utf-8").splitlines()
-        if line.strip()
-    }
-
-
 def filter_jsonl_by_indexes(input_jsonl: Path, output_jsonl: Path, allowed_indexes: set[str]) -> None:
     kept = 0
-    with open(input_jsonl, "r", encoding="utf-8") as fin, open(output_jsonl, "w", encoding="utf-8") as fout:
-        for line_no, line in enumerate(fin, start=1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                rec = json.loads(line)
-            except json.JSONDecodeError:
-                print(f"[WARN] Skipping invalid JSONL line {line_no}")
-                continue
-
+    # 2a's JSONL is append-only; read only the latest record per project_code
+    with open(output_jsonl, "w", encoding="utf-8") as fout:
+        for rec in iter_jsonl_latest(input_jsonl, index_key="project_code"):
             idx = str(rec.get("index", "")).strip()
             if idx and idx in allowed_indexes:
                 fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
@@ -97,7 +70,7 @@ if UPSTREAM_IDS_FILE:
     if not UPSTREAM_IDS_FILE.exists():
         raise FileNotFoundError(f"Missing upstream ids file: {UPSTREAM_IDS_FILE}")
 
-    upstream_indexes = load_ids_txt(UPSTREAM_IDS_FILE)
+    upstream_indexes = read_ids_txt(UPSTREAM_IDS_FILE)
     if not upstream_indexes:
         print(f"[INFO] Upstream indexes file is empty: {UPSTREAM_IDS_FILE}")
         raise SystemExit(0)
@@ -112,14 +85,12 @@ if df.empty:
     print("[INFO] No rows found after filtering / parsing.")
     raise SystemExit(0)
 
-df.to_sql(
+bulk_write(
+    df,
     STG_TARGET_TABLE,
     engine,
     schema=STG_TARGET_SCHEMA,
     if_exists="replace",
-    index=False,
-    chunksize=2000,
-    method=None
 )
 
 OUTPUT_QUERY = """
@@ -174,64 +145,57 @@ LEFT JOIN dbo.DevelopmentGoals g
     ON LOWER(t.Goal_ID) = LOWER(g.ID)
 """
 
+FINAL_COLUMNS = [
+    "index",
+    "project_code",
+    "project_title_en",
+    "project_title_ar",
+    "project_description_en",
+    "project_description_ar",
+    "emergency_title_en",
+    "emergency_title_ar",
+    "extracted_subsector_en",
+    "subsector_en",
+    "extracted_sector_en",
+    "sector_en",
+    "extracted_cluster_en",
+    "cluster_en",
+    "extracted_assistance_category_en",
+    "assistance_category_en",
+    "extracted_indicator_en",
+    "indicator_en",
+    "extracted_target_en",
+    "target_en",
+    "extracted_goal_en",
+    "goal_en",
+    "document_id",
+    "ts_inserted",
+]
+
 if upstream_indexes is not None:
+    # bring the rows of the run's indexes in line, paired per project:
+    # typed staging + one MERGE, one transaction
+    final_target = f"{FINAL_SCHEMA}.{FINAL_TABLE}"
+
     with engine.begin() as conn:
-        conn.execute(sql_text("""
-            IF OBJECT_ID('tempdb..#run_indexes') IS NOT NULL DROP TABLE #run_indexes;
-            CREATE TABLE #run_indexes ([index] NVARCHAR(255) NOT NULL PRIMARY KEY);
+        stage_keys(conn, final_target, "index", upstream_indexes, table="#run_indexes")
+        create_typed_staging(conn, final_target, FINAL_COLUMNS, "#stg_attributes")
+        conn.execute(sql_text(f"""
+            INSERT INTO #stg_attributes ({", ".join(f"[{c}]" for c in FINAL_COLUMNS)})
+            {OUTPUT_QUERY}
         """))
 
-        pd.DataFrame({"index": sorted(upstream_indexes)}).to_sql(
-            "#run_indexes",
+        counts = merge_staged(
             conn,
-            if_exists="append",
-            index=False,
-            method=None,
-        )
-
-        conn.execute(
-            sql_text(f"""
-                DELETE T
-                FROM {FINAL_SCHEMA}.{FINAL_TABLE} AS T
-                INNER JOIN #run_indexes AS R
-                    ON CAST(T.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
-                     = R.[index] COLLATE DATABASE_DEFAULT;
-            """)
-        )
-
-    with engine.begin() as conn:
-        conn.execute(
-            sql_text(f"""
-                INSERT INTO {FINAL_SCHEMA}.{FINAL_TABLE}
-                (
-                    [index],
-                    project_code,
-                    project_title_en,
-                    project_title_ar,
-                    project_description_en,
-                    project_description_ar,
-                    emergency_title_en,
-                    emergency_title_ar,
-                    extracted_subsector_en,
-                    subsector_en,
-                    extracted_sector_en,
-                    sector_en,
-                    extracted_cluster_en,
-                    cluster_en,
-                    extracted_assistance_category_en,
-                    assistance_category_en,
-                    extracted_indicator_en,
-                    indicator_en,
-                    extracted_target_en,
-                    target_en,
-                    extracted_goal_en,
-                    goal_en,
-                    document_id,
-                    ts_inserted
-                )
-                {OUTPUT_QUERY}
-            """)
+            "#stg_attributes",
+            final_target,
+            FINAL_COLUMNS,
+            scope_columns=["index"],
+            key_columns=["project_code"],
+            scope_table="#run_indexes",
+            ignore_columns=["ts_inserted"],
         )
+    print(f"[INFO] MERGE {final_target}: {format_counts(counts)}")
 else:
     with engine.begin() as conn:
         conn.execute(sql_text(f"""
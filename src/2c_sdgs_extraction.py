@@ -1,13 +1,21 @@
 import os
+import sys
 import json
 import argparse
 from pathlib import Path
 
 import pandas as pd
-import urllib.parse
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from openai import OpenAI
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_planner import estimate_tokens
+from utils.rate_governor import get_governor
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt
+from utils.db import get_engine
+from utils.master_snapshot import read_source_sql
+
 # --------------------------------------------------
 # ARGS
 # --------------------------------------------------
@@ -18,7 +26,7 @@ parser.add_argument(
     required=False,
     help="Txt file containing processed indexes from 2a for this run."
 )
-args = parser.parse_args()
+args = parser.parse_args(step_argv())
 
 RUN_ID = args.run_id.strip() if args.run_id else None
 UPSTREAM_IDS_FILE = Path(args.upstream_ids_file) if args.upstream_ids_file else None
@@ -32,6 +40,7 @@ if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is not set")
 
 client = OpenAI(api_key=OPENAI_API_KEY)
+governor = get_governor("openai")
 
 STORE_NAMES_IN_EXTRACTED_COLUMNS = True
 PRINT_SAMPLE_ROWS = 5
@@ -44,33 +53,12 @@ print(f"STORE_NAMES_IN_EXTRACTED_COLUMNS = {STORE_NAMES_IN_EXTRACTED_COLUMNS}")
 print(f"RUN_ID = {RUN_ID}")
 print("===================================================\n")
 
-# --------------------------------------------------
-# SQL SERVER CONNECTION
-# --------------------------------------------------
-def get_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-engine = get_engine()
+engine = shared_engine(get_engine)
 
 
 # --------------------------------------------------
 # HELPERS
 # --------------------------------------------------
-def load_ids_txt(path: Path) -> set[str]:
-    return {
-        line.strip()
-        for line in path.read_text(encoding="utf-8").splitlines()
-        if line.strip()
-    }
-
-
 # --------------------------------------------------
 # LLM PROMPT
 # --------------------------------------------------
@@ -141,13 +129,13 @@ WHERE a.subsector IS NOT NULL
   AND a.sdg_indicator IS NOT NULL
 """
 
-projects = pd.read_sql(PROJECT_SQL, engine)
+projects = read_source_sql(engine, PROJECT_SQL)
 
 if UPSTREAM_IDS_FILE:
     if not UPSTREAM_IDS_FILE.exists():
         raise FileNotFoundError(f"Missing upstream ids file: {UPSTREAM_IDS_FILE}")
 
-    upstream_indexes = load_ids_txt(UPSTREAM_IDS_FILE)
+    upstream_indexes = read_ids_txt(UPSTREAM_IDS_FILE)
     if not upstream_indexes:
         print(f"[INFO] Upstream indexes file is empty: {UPSTREAM_IDS_FILE}")
         raise SystemExit(0)
@@ -279,11 +267,14 @@ for n, (idx, data) in enumerate(grouped.items(), start=1):
 
         try:
             llm_calls += 1
-            resp = client.responses.create(
+            user_content = json.dumps(payload, ensure_ascii=False)
+            resp = governor.call(
+                client.responses.create,
+                est_tokens=estimate_tokens(SYSTEM_PROMPT + user_content),
                 model=MODEL,
                 input=[
                     {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+                    {"role": "user", "content": user_content}
                 ],
                 response_format={"type": "json_schema", "json_schema": JSON_SCHEMA},
                 temperature=0
@@ -318,9 +309,11 @@ for n, (idx, data) in enumerate(grouped.items(), start=1):
             f"Progress: {n:,}/{len(grouped):,} projects processed "
             f"(LLM calls={llm_calls:,}, fallbacks={fallbacks:,}, invalid={invalid_choices:,})"
         )
+        print(governor.stats_line())
 
 print(f"Total projects processed: {len(updates):,}")
 print(f"LLM calls made          : {llm_calls:,}")
+print(governor.stats_line())
 
 out_df = pd.DataFrame(updates)
 if out_df.empty:
@@ -3,8 +3,7 @@ import numpy as np
 from pathlib import Path
 import pandas as pd
 import json
-from sqlalchemy import create_engine, text
-import urllib
+from sqlalchemy import text
 import sys
 from sqlalchemy.types import NVARCHAR, UnicodeText, DateTime
 from datetime import datetime, timezone
@@ -12,6 +11,11 @@ import argparse
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from config.app_config import COMPUTE_EMB_CONFIG as CONFIG
+from utils.extraction_helpers import stage_key_table
+from utils.pipeline_runner import step_argv, shared_engine, read_ids_txt
+from utils.bulk_writer import bulk_write
+from utils.db import get_engine
+from utils.master_snapshot import read_source_sql, iter_source_records
 
 # =========================================================
 # Args
@@ -23,10 +27,16 @@ parser.add_argument(
     choices=["master projects", "projects"],
     help="db = compute embeddings from the master projects table; extracted = compute embeddings from the projects table"
 )
+parser.add_argument(
+    "--ids-file",
+    default=None,
+    help="Incremental refresh: only (re)compute embeddings for the indexes in this txt file and replace just those rows."
+)
 
-args = parser.parse_args()
+args = parser.parse_args(step_argv())
 
 SOURCE_MODE = args.source_mode
+IDS_FILE = Path(args.ids_file) if args.ids_file else None
 
 # -----------------------------
 # Config
@@ -57,26 +67,27 @@ def build_text_from_row(row) -> str:
             parts.append(v)
     return "\n".join(parts).strip()
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
-engine = get_sql_server_engine()
+engine = shared_engine(get_engine)
 
 # -----------------------------
 # Read from SQL Server
 # -----------------------------
 
-df_src = pd.read_sql_query(text(SOURCE_SQL), engine).fillna("").reset_index(drop=True)
+if IDS_FILE:
+    refresh_ids = read_ids_txt(IDS_FILE)
+    print(f"[INFO] Incremental refresh for {len(refresh_ids)} indexes from {IDS_FILE}")
+    if not refresh_ids:
+        raise SystemExit(0)
+    df_src = pd.DataFrame(list(iter_source_records(
+        engine,
+        SOURCE_SQL,
+        key_filters=[{"column": "index", "keys": refresh_ids, "mode": "include"}],
+    )))
+    if df_src.empty:
+        df_src = pd.DataFrame(columns=OUTPUT_COLS)
+    df_src = df_src.fillna("").reset_index(drop=True)
+else:
+    df_src = read_source_sql(engine, SOURCE_SQL).fillna("").reset_index(drop=True)
 
 # -----------------------------
 # Build texts + REMOVE empty ones (critical)
@@ -112,7 +123,8 @@ df_out["ts_inserted"] = datetime.now(timezone.utc)
 # -----------------------------
 # Save to CSV
 # -----------------------------
-csv_dir = Path("data/outputs/embeddings")
+# an incremental refresh only holds its own rows; keep it next to its ids file
+csv_dir = IDS_FILE.parent if IDS_FILE else Path("data/outputs/embeddings")
 csv_dir.mkdir(parents=True, exist_ok=True)
 out_csv = csv_dir / MODE_CFG["out_csv_name"]
 df_out.to_csv(out_csv, index=False)
@@ -137,15 +149,33 @@ dtype_map.update({
     "model_name": NVARCHAR(255),
 })
 
-df_out.to_sql(
-    name=TARGET_TABLE,
-    schema=TARGET_SCHEMA,
-    con=engine,
-    if_exists="replace",
-    index=False,
-    chunksize=200,
-    method=None,
-    dtype=dtype_map
-)
+if IDS_FILE:
+    # replace only the refreshed indexes (rows whose text became empty are dropped too)
+    with engine.begin() as conn:
+        stage_key_table(conn, "#idx", refresh_ids, column="index")
+        conn.execute(text(f"""
+            DELETE T
+            FROM {TARGET_SCHEMA}.{TARGET_TABLE} AS T
+            INNER JOIN #idx AS I
+                ON CAST(T.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
+                 = I.[index] COLLATE DATABASE_DEFAULT
+        """))
+        bulk_write(
+            df_out,
+            table=TARGET_TABLE,
+            schema=TARGET_SCHEMA,
+            con=conn,
+            if_exists="append",
+            dtype=dtype_map
+        )
+else:
+    bulk_write(
+        df_out,
+        table=TARGET_TABLE,
+        schema=TARGET_SCHEMA,
+        con=engine,
+        if_exists="replace",
+        dtype=dtype_map
+    )
 
 print(f"Saved to SQL Server: {TARGET_SCHEMA}.{TARGET_TABLE} (mode={SOURCE_MODE})")
\ No newline at end of file
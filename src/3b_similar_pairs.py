@@ -2,9 +2,7 @@ import numpy as np
 import pandas as pd
 import faiss
 from pathlib import Path
-from sqlalchemy import create_engine, text
 from sqlalchemy.types import NVARCHAR, UnicodeText, DateTime, Float, Boolean
-import urllib
 import ast
 from datetime import datetime, timezone
 from sqlalchemy import text as sql_text
@@ -12,6 +10,9 @@ import argparse
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from config.app_config import SEMANTIC_SIMILARITY_CONFIG as CONFIG
+from utils.bulk_writer import bulk_write
+from utils.db import get_engine
+from utils.master_snapshot import read_source_sql
 
 # =========================================================
 # Args
@@ -81,25 +82,12 @@ print(
 FILTER_COLS = ["country_name_en", "donor_name_en", "implementing_org_en"]
 SEASONAL_SUBSECTOR = "Seasonal programmes"
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
-engine = get_sql_server_engine()
+engine = get_engine()
 
 # -----------------------------
 # Load embeddings + join filter cols (DEDUPED)
 # -----------------------------
-df = pd.read_sql_query(text(SOURCE_SQL), engine).fillna("").reset_index(drop=True)
+df = read_source_sql(engine, SOURCE_SQL).fillna("").reset_index(drop=True)
 print(f"[LOAD] Loaded {len(df):,} rows from source table")
 
 # Parse embeddings (stored as NVARCHAR list)
@@ -366,15 +354,13 @@ dtype = {
     }
 
 print("[SQL] Writing similarity results to SQL Server...")
-df_out.to_sql(
-    name=TARGET_TABLE,
+bulk_write(
+    df_out,
+    table=TARGET_TABLE,
     schema=TARGET_SCHEMA,
     con=engine,
     if_exists="replace",
-    index=False,
-    chunksize=200,
-    method=None,
-    dtype = dtype
+    dtype=dtype
 )
 
 print(f"Saved to SQL Server: {TARGET_SCHEMA}.{TARGET_TABLE} (mode={SOURCE_MODE})")
@@ -3,12 +3,11 @@ import re
 from pathlib import Path
 
 import pandas as pd
-from sqlalchemy import create_engine
-import urllib
 import sys
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.db import get_engine
 
 # -----------------------------
 # Config
@@ -50,26 +49,13 @@ def clean_for_excel(df: pd.DataFrame) -> pd.DataFrame:
         )
     return df
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
 # -----------------------------
 # Main
 # -----------------------------
 def main():
     BASE_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    engine = get_sql_server_engine()
+    engine = get_engine()
 
     donors_sql = f"""
         SELECT DISTINCT {DONOR_COL}
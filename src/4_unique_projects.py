@@ -1,6 +1,6 @@
 import argparse
 import re
-import urllib
+import time
 from collections import defaultdict
 from datetime import datetime
 
@@ -8,7 +8,6 @@ import faiss
 import numpy as np
 import pandas as pd
 from sentence_transformers import SentenceTransformer
-from sqlalchemy import create_engine
 from sqlalchemy.types import DateTime, Integer, NVARCHAR
 import sys
 import os
@@ -16,6 +15,10 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from config.unique_projects_config import STEP_CONFIG
+from utils.run_manifest import RunManifest, fingerprint_parts, tables_exist
+from utils.bulk_writer import bulk_write
+from utils.db import get_engine
+from utils.master_snapshot import read_source_sql
 
 
 # =========================================================
@@ -25,22 +28,11 @@ SIM_THR = 0.75
 TOP_K = 30
 TARGET_SCHEMA = "silver"
 
+# input fingerprints of completed steps; unchanged steps are skipped on rerun
+MANIFEST_JSON = Path("data/outputs/unique_projects/run_manifest.json")
 
-# =========================================================
-# SQL Server connection
-# =========================================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
 
-
-engine = get_sql_server_engine()
+engine = get_engine()
 
 
 # =========================================================
@@ -70,6 +62,12 @@ def parse_args():
         type=int,
         help="Optional list of step numbers to run. Dependencies will be included automatically."
     )
+    parser.add_argument(
+        "--force-step",
+        nargs="+",
+        default=[],
+        help="Step numbers to rerun even if their inputs are unchanged, or 'all'."
+    )
     return parser.parse_args()
 
 
@@ -199,14 +197,13 @@ def write_index_helper_table(df: pd.DataFrame, base_table: str, schema: str, if_
     helper_table = f"{base_table}_indexes"
     index_df = extract_indexes_from_df(df)
 
-    index_df.to_sql(
-        name=helper_table,
+    bulk_write(
+        index_df,
+        table=helper_table,
         con=engine,
         schema=schema,
         if_exists=if_exists,
-        index=False,
         dtype={"index": NVARCHAR(255)},
-        chunksize=500,
     )
 
     print(f"[DONE] Helper index table written to {schema}.{helper_table} | rows={len(index_df)}")
@@ -231,16 +228,15 @@ def run_sql_to_table_step(step_no: int, cfg: dict):
     print(f"\n[STEP {step_no}] {cfg.get('description', '')}")
     print(f"[INFO] Running SQL and writing output to {schema}.{target_table}")
 
-    df = pd.read_sql(sql, engine)
+    df = read_source_sql(engine, sql)
 
     # Write SQL result to target table
-    df.to_sql(
-        name=target_table,
+    bulk_write(
+        df,
+        table=target_table,
         con=engine,
         schema=schema,
         if_exists=if_exists,
-        index=False,
-        chunksize=500,
     )
 
     print(f"[DONE] Step {step_no} output written to {schema}.{target_table} | rows={len(df)}")
@@ -270,15 +266,14 @@ def cluster_step(step_no: int, cfg: dict):
     print(f"\n[STEP {step_no}] {cfg.get('description', '')}")
     print(f"[INFO] Preparing raw input table {schema}.{input_table}")
 
-    df = pd.read_sql(source_sql, engine)
+    df = read_source_sql(engine, source_sql)
 
-    df.to_sql(
-        name=input_table,
+    bulk_write(
+        df,
+        table=input_table,
         con=engine,
         schema=schema,
         if_exists=if_exists,
-        index=False,
-        chunksize=500,
     )
 
     print(f"[DONE] Raw input written to {schema}.{input_table} | rows={len(df)}")
@@ -306,13 +301,12 @@ def cluster_step(step_no: int, cfg: dict):
 
         empty_out_df = pd.DataFrame(columns=empty_columns)
 
-        empty_out_df.to_sql(
-            name=target_table,
+        bulk_write(
+            empty_out_df,
+            table=target_table,
             con=engine,
             schema=schema,
             if_exists=if_exists,
-            index=False,
-            chunksize=500,
         )
 
         print(f"[DONE] Empty clustered output written to {schema}.{target_table}")
@@ -406,14 +400,13 @@ def cluster_step(step_no: int, cfg: dict):
 
     dtype_map = build_dtype_map(include_emergency=include_emergency)
 
-    out_df.to_sql(
-        name=target_table,
+    bulk_write(
+        out_df,
+        table=target_table,
         con=engine,
         schema=schema,
         if_exists=if_exists,
-        index=False,
         dtype=dtype_map,
-        chunksize=500,
     )
 
     print(f"[DONE] Clustered output written to {schema}.{target_table} | rows={len(out_df)}")
@@ -449,6 +442,37 @@ def resolve_steps(requested_steps):
     return resolved
 
 
+def step_fingerprint(step_no: int) -> dict:
+    """
+    Inputs of a step: its query's result checksum (which also covers the
+    tables earlier steps wrote), its config and the clustering settings.
+    """
+    cfg = STEP_CONFIG[step_no]
+    sql = cfg["sql"] if cfg["type"] == "sql_to_table" else cfg["source_sql"]
+
+    return fingerprint_parts(
+        engine=engine,
+        queries={"source": sql},
+        files=[Path(__file__)],
+        values={
+            "config": cfg,
+            "clustering": {"SIM_THR": SIM_THR, "TOP_K": TOP_K, "model": model},
+        },
+    )
+
+
+def step_output_tables(step_no: int) -> list[str]:
+    cfg = STEP_CONFIG[step_no]
+    schema = cfg.get("schema", TARGET_SCHEMA)
+
+    if cfg["type"] == "sql_to_table":
+        tables = [cfg["target_table"], f"{cfg['target_table']}_indexes"]
+    else:
+        tables = [cfg["input_table"], f"{cfg['input_table']}_indexes", cfg["target_table"]]
+
+    return [f"{schema}.{t}" for t in tables]
+
+
 def run_step(step_no: int):
     """
     Dispatch execution based on step type.
@@ -475,6 +499,7 @@ def main():
     python unique_projects.py
     python unique_projects.py --steps 5
     python unique_projects.py --steps 7 8
+    python unique_projects.py --force-step 5
     """
     args = parse_args()
 
@@ -495,9 +520,20 @@ def main():
     print(f"[INFO] Requested steps: {requested_steps}")
     print(f"[INFO] Steps to run with dependencies: {steps_to_run}")
 
-    # Execute steps in resolved order
+    manifest = RunManifest(MANIFEST_JSON, force_steps=args.force_step)
+
+    # Execute steps in resolved order, skipping steps whose inputs are unchanged
     for step_no in steps_to_run:
+        parts = step_fingerprint(step_no)
+        skip, reason = manifest.check(str(step_no), parts, tables_exist(engine, step_output_tables(step_no)))
+        if skip:
+            print(f"\n[STEP {step_no}] Skipped: {reason}")
+            continue
+
+        print(f"\n[STEP {step_no}] Running: {reason}")
+        t0 = time.perf_counter()
         run_step(step_no)
+        manifest.record(str(step_no), parts, time.perf_counter() - t0)
 
     print("\n[INFO] Pipeline completed successfully.")
 
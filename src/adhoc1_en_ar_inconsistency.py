@@ -1,16 +1,21 @@
 import os
+import sys
 import argparse
 from pathlib import Path
-import urllib.parse
 
 import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.types import NVARCHAR, Float, Boolean, DateTime
 from datetime import datetime, timezone
 
 from sentence_transformers import SentenceTransformer
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.bulk_writer import bulk_write
+from utils.db import get_engine
+from utils.master_snapshot import read_source_sql
+
 
 # -----------------------------
 # Config defaults
@@ -33,17 +38,7 @@ BASE_OUT_DIR = Path("data/outputs/semantic_check/")
 # =========================================================
 # HELPERS
 # =========================================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
-engine = get_sql_server_engine()
+engine = get_engine()
 
 
 def clean_text(x) -> str:
@@ -95,7 +90,7 @@ def main():
     )
     """
 
-    df = pd.read_sql(query, engine)
+    df = read_source_sql(engine, query)
 
     df["project_en"] = df.apply(lambda r: build_text(r.project_title_en, r.project_description_en), axis=1)
     df["project_ar"] = df.apply(lambda r: build_text(r.project_title_ar, r.project_description_ar), axis=1)
@@ -157,12 +152,12 @@ def main():
                 , "ts_inserted"
     ]].copy()
 
-    df_sql.to_sql(
+    bulk_write(
+        df_sql,
         OUTPUT_TABLE.split(".")[1],
         engine,
         schema=OUTPUT_TABLE.split(".")[0],
         if_exists="append",
-        index=False,
         dtype={
             "index": NVARCHAR(255),
             "project_title_en": NVARCHAR(None),
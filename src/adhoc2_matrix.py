@@ -1,23 +1,12 @@
-from sqlalchemy import create_engine, text
-import urllib
+import sys
+from pathlib import Path
 
-# ----------------------------------
-# SQL Server connection (Windows Auth)
-# ----------------------------------
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={params}",
-        fast_executemany=True
-    )
+from sqlalchemy import text
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.db import get_engine
 
-engine = get_sql_server_engine()
+engine = get_engine()
 
 # ----------------------------------
 # CREATE OR ALTER VIEW
@@ -2,23 +2,13 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-from sqlalchemy import create_engine
-import urllib
+import sys
+from pathlib import Path
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.db import get_engine
 
-engine = get_sql_server_engine()
+engine = get_engine()
 
 sns.set_theme(style="whitegrid")
 
@@ -8,8 +8,6 @@ import sys
 import os
 import argparse
 from pathlib import Path
-from sqlalchemy import create_engine
-import urllib
 
 import pandas as pd
 import langextract as lx
@@ -23,16 +21,19 @@ from config.prompt import OLLAMA_PROMPT
 
 from utils.extraction_helpers import (
     text_hash,
-    load_cache,
-    save_cache,
     annotated_to_dict,
     jsonl_upsert_by_index,
-    load_processed_indexes_from_jsonl,
+    get_jsonl_writer,
+    compact_jsonl,
     jsonl_to_json_snapshot, 
     safe_str,
     build_labeled_bilingual_input,
+    iter_sql_records,
     _jsonl_append
 )
+from utils.extraction_cache import open_run_cache, open_llm_cache
+from utils.rate_governor import get_governor
+from utils.db import get_engine
 
 # -----------------------
 # args + output paths
@@ -60,54 +61,69 @@ RUN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 OUT_JSONL = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.jsonl"
 OUT_JSON  = RUN_OUTPUT_DIR / f"{RUN_ID}_combined_extraction_results.json"
 
-processed_indexes = load_processed_indexes_from_jsonl(OUT_JSONL)
+processed_indexes = get_jsonl_writer(OUT_JSONL, index_key="index").keys()
 print(f"[INFO] Already in JSONL: {len(processed_indexes)} indexes")
 print(f"[INFO] Force refresh mode: {FORCE_REFRESH}")
 
-# Cache file (stores mapping: text_hash -> AnnotatedDocument)
+# Legacy cache file (text_hash -> AnnotatedDocument); imported into <run>_lx_cache.sqlite on first open
 CACHE_PKL = RUN_OUTPUT_DIR / f"{RUN_ID}_lx_cache.pkl"
 
-# =====================================
-# SQL SERVER CONNECTION (WINDOWS AUTH)
-# =====================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-engine = get_sql_server_engine()
+engine = get_engine()
 
 # =====================================
 # SOURCE QUERY
 # =====================================
 # Update the source query's WHERE condition depending on which indices are to be processed
 SOURCE_QUERY = """
-SELECT *
+SELECT
+    [index]
+    , ProjectTitleEnglish
+    , DescriptionEnglish
+    , ProjectTitleArabic
+    , DescriptionArabic
+    , Amount
+    , ODA_Amount
+    , GE_Amount
+    , OFF_Amount
 FROM dbo.MasterTableDenormalizedCleanedFinal
 WHERE [index] like '%ADFD%'
 """
-df_input = pd.read_sql(SOURCE_QUERY, engine)
+SOURCE_CHUNKSIZE = 2000
 
 EXAMPLES = INFRA_EXAMPLES + DIST_EXAMPLES + SERV_EXAMPLES
 
+#MODEL_ID = "gemma2:2b"
+# Qwen
+#MODEL_ID = "qwen2.5:7b"
+# llama
+MODEL_ID = "llama3.1:8b"
+
+# local server: no request budget, but timeouts back off and retry
+governor = get_governor("ollama")
+
 # -----------------------
 # extraction loop
 # -----------------------
 CHECKPOINT_EVERY = 5
 
-cache = load_cache(CACHE_PKL)
-print(f"[INFO] Loaded cache entries: {len(cache)} from {CACHE_PKL.name}")
+cache = open_run_cache(CACHE_PKL)
+print(f"[INFO] Opened cache entries: {len(cache)} from {cache.path.name}")
+
+# cross-run cache; the model_id is part of the version, so switching the
+# local model above never serves another model's results
+llm_cache = open_llm_cache("adhoc4_ollama", OLLAMA_PROMPT, EXAMPLES, MODEL_ID)
+print(f"[INFO] Global LLM cache: {llm_cache.cache.path} | version={llm_cache.version[:12]}")
 
 cache_hits = 0
 fresh_calls = 0
 processed_this_run_indexes = set()
 
-for i, row in enumerate(df_input.to_dict("records"), start=1):
+key_filters = [] if FORCE_REFRESH else [
+    {"column": "index", "keys": processed_indexes, "mode": "exclude"},
+]
+source_rows = iter_sql_records(engine, SOURCE_QUERY, chunksize=SOURCE_CHUNKSIZE, key_filters=key_filters)
+
+for i, row in enumerate(source_rows, start=1):
     index = row.get("index", None) or row.get("Index", None)
     index = safe_str(index)
 
@@ -152,41 +168,30 @@ for i, row in enumerate(df_input.to_dict("records"), start=1):
     # -----------------------
     if FORCE_REFRESH:
         # ALWAYS call LLM, NEVER read cache
-        result = lx.extract(
+        result = None
+    else:
+        result = cache.get(h)
+        if result is None:
+            result = llm_cache.get(h)
+            if result is not None:
+                cache[h] = result
+
+    if result is not None:
+        cache_hits += 1
+    else:
+        result = governor.call(
+            lx.extract,
             text_or_documents=text_bilingual,
             prompt_description=OLLAMA_PROMPT,
             examples=EXAMPLES,
-            #model_id="gemma2:2b",
-            # Qwen
-            #model_id="qwen2.5:7b",
-            # llama
-            model_id="llama3.1:8b",
+            model_id=MODEL_ID,
             model_url="http://localhost:11434",
             fence_output=False,
             use_schema_constraints=False,
         )
         cache[h] = result  # overwrite / update cache with fresh result
+        llm_cache[h] = result
         fresh_calls += 1
-    else:
-        if h in cache:
-            result = cache[h]
-            cache_hits += 1
-        else:
-            result = lx.extract(
-                text_or_documents=text_bilingual,
-                prompt_description=OLLAMA_PROMPT,
-                examples=EXAMPLES,
-                #model_id="gemma2:2b",
-                # Qwen
-                #model_id="qwen2.5:7b",
-                # llama
-                model_id="llama3.1:8b",
-                model_url="http://localhost:11434",
-                fence_output=False,
-                use_schema_constraints=False,
-            )
-            cache[h] = result
-            fresh_calls += 1
 
     # Convert result -> dict
     d = annotated_to_dict(result)
@@ -209,21 +214,27 @@ for i, row in enumerate(df_input.to_dict("records"), start=1):
     processed_this_run_indexes.add(index)
 
     if i % CHECKPOINT_EVERY == 0:
-        jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
-        save_cache(cache, CACHE_PKL)
         print(
             f"[checkpoint] rows_seen={i} | upserted_this_run={len(processed_this_run_indexes)} "
             f"| cache_hits={cache_hits} | fresh_calls={fresh_calls} | cache_size={len(cache)}"
         )
+        llm_cache.flush_stats()
+        print(governor.stats_line())
 
 # final save
-jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON)
+dropped_lines = compact_jsonl(OUT_JSONL, index_key="index")
+print(f"[INFO] Compacted JSONL: dropped {dropped_lines} superseded lines")
+
+jsonl_to_json_snapshot(OUT_JSONL, OUT_JSON, index_key="index")
 
-save_cache(cache, CACHE_PKL)
+cache.flush()
+llm_cache.flush_stats()
 
+print(llm_cache.stats_line())
+print(governor.stats_line())
 print(f"Saved extraction JSONL: {OUT_JSONL}")
 print(f"Saved debug JSON:      {OUT_JSON}")
-print(f"Saved cache:           {CACHE_PKL} (entries={len(cache)})")
+print(f"Saved cache:           {cache.path} (entries={len(cache)})")
 print(f"[DONE] upserted_this_run={len(processed_this_run_indexes)} | cache_hits={cache_hits} | fresh_calls={fresh_calls}")
 
 PROCESSED_TXT = RUN_OUTPUT_DIR / f"{RUN_ID}_processed_indexes.txt"
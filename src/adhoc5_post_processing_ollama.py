@@ -3,8 +3,6 @@ import re
 import pandas as pd
 from pathlib import Path
 import argparse
-from sqlalchemy import create_engine
-import urllib
 import sys
 from datetime import datetime, timezone
 from sqlalchemy import text as sql_text
@@ -18,13 +16,15 @@ from utils.post_processing_helpers import (
     to_int_or_none,
     to_float_or_none,
     is_missing_or_bad,
-    fmt_mp,
     fmt_prj,
     parse_langextract_grouped_pairs,
     _is_blank,
 )
 
 from utils.post_processing_sql_queries import OLLAMA_QUERIES
+from utils.code_allocator import CodeAllocator
+from utils.bulk_writer import bulk_write
+from utils.db import get_engine
 
 # -----------------------
 # args + paths
@@ -48,109 +48,26 @@ processed_run_indexes = set(
 )
 print(f"[INFO] Incremental mode: {len(processed_run_indexes)} indexes to post-process")
 
-# -----------------------
-# SQL Server (Windows Auth)
-# -----------------------
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
 TARGET_SCHEMA = "ollama"
 TARGET_TABLE = "MasterTable_extracted"
 
-# -----------------------
-# helpers
-# -----------------------
-def _trail_int(s: str):
-    if s is None:
-        return None
-    m = re.search(r"(\d+)\s*$", str(s))
-    return int(m.group(1)) if m else None
-
 # -----------------------
 # main parsing
 # -----------------------
 if not INPUT_JSONL.exists():
     raise FileNotFoundError(f"Input JSONL not found: {INPUT_JSONL}")
 
-engine = get_sql_server_engine()
-
-# Load existing mappings from target table (so codes don't restart)
-index_to_master_code = {}  # index -> master_project_code (1:1)
-index_title_to_prj_code = {}  # (index, project_title_en) -> project_code (stable reuse)
-
-max_master_num = 0
-master_to_max_prj = {}  # master_project_code -> max project suffix
-
-try:
-    existing_master = pd.read_sql(
-        sql_text(
-            f"""
-            SELECT [index], master_project_code
-            FROM {TARGET_SCHEMA}.{TARGET_TABLE}
-            WHERE [index] IS NOT NULL
-              AND master_project_code IS NOT NULL
-        """
-        ),
-        engine,
-    )
-
-    existing_master["index"] = existing_master["index"].astype(str)
-    existing_master = (
-        existing_master.sort_values(["index", "master_project_code"])
-        .drop_duplicates("index", keep="first")
-    )
-    index_to_master_code = dict(
-        zip(existing_master["index"], existing_master["master_project_code"])
-    )
+engine = get_engine()
 
-    master_nums = existing_master["master_project_code"].apply(_trail_int).dropna().tolist()
-    max_master_num = max(master_nums) if master_nums else 0
-
-    existing_project = pd.read_sql(
-        sql_text(
-            f"""
-            SELECT [index], project_title_en, project_code, master_project_code
-            FROM {TARGET_SCHEMA}.{TARGET_TABLE}
-            WHERE [index] IS NOT NULL
-              AND project_title_en IS NOT NULL
-              AND project_code IS NOT NULL
-              AND master_project_code IS NOT NULL
-        """
-        ),
-        engine,
-    )
+# Codes of this run's indexes only (ollama.master_code_map / master_code_seq);
+# new indexes get codes from the sequence, so codes don't restart
+code_allocator = CodeAllocator(engine, schema=TARGET_SCHEMA, target_table=TARGET_TABLE)
 
-    existing_project["index"] = existing_project["index"].astype(str)
-    existing_project = (
-        existing_project.sort_values(["index", "master_project_code", "project_code"])
-        .drop_duplicates(["index", "project_title_en"], keep="first")
-    )
-
-    index_title_to_prj_code = {
-        (r["index"], r["project_title_en"]): r["project_code"]
-        for _, r in existing_project.iterrows()
-    }
-
-    for _, r in existing_project.iterrows():
-        mc = r["master_project_code"]
-        pc = r["project_code"]
-        n = _trail_int(pc)
-        if n is None:
-            continue
-        master_to_max_prj[mc] = max(master_to_max_prj.get(mc, 0), n)
+index_to_master_code = code_allocator.master_codes(sorted(processed_run_indexes))  # index -> master_project_code (1:1)
 
-except Exception as e:
-    print("Warning: could not load existing mappings from target table. Starting fresh.")
-    print("Reason:", str(e))
+# (index, project_title_en) -> project_code (stable reuse), master_project_code -> max project suffix
+index_title_to_prj_code, master_to_max_prj = code_allocator.project_codes(processed_run_indexes)
 
-next_master_num = max_master_num
 master_to_next_prj = {}
 TS_INSERTED = datetime.now(timezone.utc)
 
@@ -197,13 +114,8 @@ with open(INPUT_JSONL, "r", encoding="utf-8") as f:
             elif x["cls"] == "master_project_title_ar" and master_project_title_ar is None:
                 master_project_title_ar = str(x["val"]).strip()
 
-        # Reuse master_project_code if exists; otherwise generate NEW
-        if index_key in index_to_master_code:
-            master_project_code = index_to_master_code[index_key]
-        else:
-            next_master_num += 1
-            master_project_code = fmt_mp(next_master_num)
-            index_to_master_code[index_key] = master_project_code
+        # allocated up front for every index of this run
+        master_project_code = index_to_master_code[index_key]
 
         if master_project_code not in master_to_next_prj:
             master_to_next_prj[master_project_code] = master_to_max_prj.get(master_project_code, 0)
@@ -741,7 +653,7 @@ if indexes_to_upsert:
         conn.execute(sql_text("CREATE TABLE #idx ([index] NVARCHAR(255) NOT NULL PRIMARY KEY);"))
 
         # Bulk insert indexes into temp table
-        df_idx.to_sql("#idx", conn, if_exists="append", index=False, method=None)
+        bulk_write(df_idx, "#idx", conn, if_exists="append")
 
         # Delete existing rows for those indexes
         conn.execute(
@@ -757,15 +669,13 @@ if indexes_to_upsert:
         )
 
     # Insert ONLY the newly produced rows (not the whole CSV)
-    df_new.to_sql(
+    bulk_write(
+        df_new,
         TARGET_TABLE,
         engine,
         schema=TARGET_SCHEMA,
         if_exists="append",
-        index=False,
-        chunksize=2000,
         dtype=dtype,
-        method=None,
     )
 
 print(f"Saved combined output: {OUT_CSV}")
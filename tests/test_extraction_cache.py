@@ -0,0 +1,25 @@
+import pickle
+
+from utils.extraction_cache import open_run_cache
+
+
+def test_pickle_is_imported_once_and_edits_stick(tmp_path):
+    pkl = tmp_path / "run_lx_cache.pkl"
+    pkl.write_bytes(pickle.dumps({"a": 1, "b": 2}))
+
+    cache = open_run_cache(pkl)
+    assert dict(cache.items()) == {"a": 1, "b": 2}
+    del cache["a"]
+    cache.close()
+
+    # the pickle still holds "a", but it is not imported a second time
+    cache = open_run_cache(pkl)
+    assert dict(cache.items()) == {"b": 2}
+
+
+def test_update_replace_swaps_every_entry(tmp_path):
+    cache = open_run_cache(tmp_path / "run_lx_cache.pkl")
+    cache.update({"old1": 1, "old2": 2})
+    cache.update({"new": 3}, replace=True)
+    assert dict(cache.items()) == {"new": 3}
+    assert len(cache) == 1
@@ -0,0 +1,133 @@
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils import rate_governor
+from utils.rate_governor import RateGovernor, TokenBucket, classify_error, make_stub
+
+
+@pytest.fixture
+def stub_url():
+    servers = []
+
+    def start(rpm, window_s=60.0):
+        server = make_stub(0, rpm, window_s=window_s)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(url):
+    with urllib.request.urlopen(url, data=b"{}", timeout=5) as resp:
+        return resp.status
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(600)  # 10 per second, one minute of burst
+    started = time.monotonic()
+    bucket.acquire(600)
+    assert time.monotonic() - started < 0.1
+
+    started = time.monotonic()
+    bucket.acquire(5)
+    assert time.monotonic() - started >= 0.45
+
+
+def test_request_budget_keeps_under_stub_limit(stub_url):
+    url = stub_url(rpm=10)
+    governor = RateGovernor("stub", rpm=10, max_retries=0)
+    for _ in range(10):
+        assert governor.call(post, url) == 200
+
+    assert governor.counts["rate_limited"] == 0
+    # the 11th request would have to wait for the next budget slot
+    assert governor.requests.tokens < 1
+
+
+def test_aimd_grows_on_success_and_halves_on_429(stub_url):
+    url = stub_url(rpm=3)
+    governor = RateGovernor(
+        "stub", initial_concurrency=4, max_retries=1, base_backoff_s=30.0, max_backoff_s=0.01,
+    )
+    for _ in range(3):
+        governor.call(post, url)
+    grown = governor.limit
+    assert grown > 4
+
+    started = time.monotonic()
+    with pytest.raises(urllib.error.HTTPError) as err:
+        governor.call(post, url)
+    assert err.value.code == 429
+    # Retry-After: 1 wins over the (tiny) jittered backoff
+    assert time.monotonic() - started >= 1.0
+    # a burst of 429s only halves the window once
+    assert governor.limit == pytest.approx(grown / 2)
+    assert governor.counts["rate_limited"] == 2
+    assert governor.counts["retries"] == 1
+    assert governor.counts["failed"] == 1
+
+
+class StatusError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(message)
+        self.status_code = status
+
+
+def test_backoff_doubles_up_to_cap(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_governor.time, "sleep", sleeps.append)
+    monkeypatch.setattr(rate_governor.random, "uniform", lambda low, high: high)
+
+    governor = RateGovernor("test", max_retries=5, base_backoff_s=1.0, max_backoff_s=10.0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) <= 5:
+            raise StatusError(503)
+        return "ok"
+
+    assert governor.call(flaky) == "ok"
+    assert sleeps == [1.0, 2.0, 4.0, 8.0, 10.0]
+    assert governor.counts["server_errors"] == 5
+
+
+def test_non_retryable_error_is_raised_at_once(monkeypatch):
+    monkeypatch.setattr(rate_governor.time, "sleep", lambda s: pytest.fail("slept"))
+    governor = RateGovernor("test")
+
+    def bad():
+        raise StatusError(400, "rate limit field is invalid")
+
+    with pytest.raises(StatusError):
+        governor.call(bad)
+    assert governor.counts["failed"] == 1
+
+
+def test_classify_prefers_status_and_type_over_message():
+    assert classify_error(StatusError(429)) == "rate_limit"
+    assert classify_error(StatusError(503)) == "server"
+    # the status decides even when the message reads like a retryable error
+    assert classify_error(StatusError(400, "Too Many Requests in prompt")) is None
+    assert classify_error(urllib.error.URLError(TimeoutError("timed out"))) == "timeout"
+    assert classify_error(TimeoutError()) == "timeout"
+
+    try:
+        try:
+            raise StatusError(502)
+        except StatusError as inner:
+            raise RuntimeError("extraction failed") from inner
+    except RuntimeError as wrapped:
+        assert classify_error(wrapped) == "server"
+
+    # no status, no telling type: the message is all there is
+    assert classify_error(RuntimeError("Error code: 429 - rate limit reached")) == "rate_limit"
+    assert classify_error(ValueError("bad input")) is None
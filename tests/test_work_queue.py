@@ -0,0 +1,97 @@
+import threading
+import time
+
+from utils.work_queue import WorkQueue, LeaseHeartbeat, DONE, FAILED, LEASED, PENDING
+
+
+def make_queue(tmp_path, n=10, max_attempts=3):
+    queue = WorkQueue(tmp_path / "queue.sqlite", max_attempts=max_attempts)
+    queue.enqueue((f"k{i}", {"i": i}) for i in range(n))
+    return queue
+
+
+def test_enqueue_ignores_known_keys(tmp_path):
+    queue = make_queue(tmp_path, n=3)
+    assert queue.enqueue([("k0", {}), ("k3", {})]) == 1
+    assert queue.counts()[PENDING] == 4
+
+
+def test_expired_lease_goes_to_another_worker(tmp_path):
+    queue = make_queue(tmp_path, n=1)
+    assert [k for k, _ in queue.lease("w1", 5, lease_s=0.2)] == ["k0"]
+    assert queue.lease("w2", 5, lease_s=0.2) == []
+
+    time.sleep(0.3)
+    assert [k for k, _ in queue.lease("w2", 5, lease_s=60)] == ["k0"]
+    # the first worker lost the item and cannot complete or renew it
+    assert not queue.complete("k0", "w1")
+    assert queue.extend(["k0"], "w1", 60) == 0
+    assert queue.complete("k0", "w2")
+    assert queue.drained()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    queue = make_queue(tmp_path, n=1)
+    queue.lease("w1", 1, lease_s=1.5)
+    with LeaseHeartbeat(queue, "w1", 1.5, lambda: ["k0"]):
+        time.sleep(2.5)
+        assert queue.lease("w2", 1, lease_s=60) == []
+    time.sleep(1.6)
+    assert [k for k, _ in queue.lease("w2", 1, lease_s=60)] == ["k0"]
+
+
+def test_fail_retries_then_parks(tmp_path):
+    queue = make_queue(tmp_path, n=1, max_attempts=2)
+
+    queue.lease("w1", 1, lease_s=60)
+    queue.fail("k0", "w1", "boom")
+    assert queue.counts()[PENDING] == 1
+
+    queue.lease("w1", 1, lease_s=60)
+    queue.fail("k0", "w1", "boom again")
+    assert queue.counts()[FAILED] == 1
+    assert queue.failed_keys() == ["k0"]
+    assert queue.lease("w1", 1, lease_s=60) == []
+    assert queue.drained()
+
+    assert queue.requeue_failed() == 1
+    assert [k for k, _ in queue.lease("w2", 1, lease_s=60)] == ["k0"]
+
+
+def test_expired_lease_without_attempts_left_is_parked(tmp_path):
+    queue = make_queue(tmp_path, n=1, max_attempts=1)
+    queue.lease("w1", 1, lease_s=0.1)
+    time.sleep(0.2)
+    assert queue.lease("w2", 1, lease_s=60) == []
+    assert queue.counts()[FAILED] == 1
+
+
+def test_concurrent_workers_never_share_an_item(tmp_path):
+    n_items, n_workers = 300, 8
+    make_queue(tmp_path, n=n_items)
+    seen = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        # own WorkQueue per worker, like separate processes
+        queue = WorkQueue(tmp_path / "queue.sqlite")
+        while True:
+            leased = queue.lease(worker_id, 7, lease_s=60)
+            if not leased:
+                if queue.drained():
+                    return
+                continue
+            for key, _ in leased:
+                with lock:
+                    seen.append(key)
+                assert queue.complete(key, worker_id)
+
+    threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(n_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(seen) == sorted(f"k{i}" for i in range(n_items))
+    counts = WorkQueue(tmp_path / "queue.sqlite").counts()
+    assert counts[DONE] == n_items and counts[LEASED] == 0
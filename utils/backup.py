@@ -1,15 +1,19 @@
-import pickle
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_cache import open_run_cache
+
+# the run's legacy pickle path; entries live in the .sqlite next to it
 PKL_PATH = Path("C:\\Users\\SREE\\data-cleansing-framework\\data\\outputs\\full-run\\full-run_lx_cache.pkl")
 
-with PKL_PATH.open("rb") as f:
-    cache = pickle.load(f)
+cache = open_run_cache(PKL_PATH)
 
 print("Cache entries:", len(cache))
 
 # Peek one object to see what fields exist
-any_doc = next(iter(cache.values()))
+_, any_doc = next(cache.items())
 print("Doc type:", type(any_doc))
 print("Has text:", hasattr(any_doc, "text"))
 print("Has _document_id:", hasattr(any_doc, "_document_id"))
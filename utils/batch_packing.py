@@ -0,0 +1,176 @@
+"""
+Pack several short documents into one model call and split the result back.
+
+Packed input looks like
+
+    === PROJECT 1 ===
+    <text of document 1>
+
+    === PROJECT 2 ===
+    <text of document 2>
+
+and PACKED_PROMPT_SUFFIX asks the model to tag every extraction with the
+project number. Each extraction is routed back to its document by its
+"project" attribute, else by its char_interval (rebased to the document's
+own text). A batch that raises or has an extraction that can't be routed
+is split in half and retried; a document that ends up with fewer than
+min_extractions_per_doc extractions is retried on its own.
+"""
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_helpers import annotated_to_dict
+
+
+DOC_HEADER = "=== PROJECT {n} ==="
+DOC_SEPARATOR = "\n\n"
+
+PACKED_PROMPT_SUFFIX = """
+
+BATCH INPUT:
+The input contains several independent projects, each introduced by a line
+"=== PROJECT <n> ===". Extract for every project separately, in input order,
+and never combine information across projects. Add the attribute
+"project": "<n>" to every extraction so it can be traced to its project.
+"""
+
+
+def packing_spec(batch_size: int, max_chars: int) -> dict:
+    """Everything besides prompt/examples that shapes a packed call (goes into the cache version of packed results)."""
+    return {
+        "suffix": PACKED_PROMPT_SUFFIX,
+        "header": DOC_HEADER,
+        "separator": DOC_SEPARATOR,
+        "batch_size": batch_size,
+        "batch_max_chars": max_chars,
+    }
+
+
+def pack_documents(texts: list[str]) -> tuple[str, list[tuple[int, int]]]:
+    """Return the packed text and the (start, end) span of each document's text inside it."""
+    parts = []
+    spans = []
+    pos = 0
+    for n, text in enumerate(texts, start=1):
+        header = DOC_HEADER.format(n=n) + "\n"
+        if parts:
+            parts.append(DOC_SEPARATOR)
+            pos += len(DOC_SEPARATOR)
+        parts.append(header)
+        pos += len(header)
+        parts.append(text)
+        spans.append((pos, pos + len(text)))
+        pos += len(text)
+    return "".join(parts), spans
+
+
+def _doc_from_attribute(e: dict, n_docs: int) -> int | None:
+    attrs = e.get("attributes") or {}
+    if not isinstance(attrs, dict):
+        return None
+    val = attrs.get("project")
+    if val is None:
+        return None
+    m = re.search(r"\d+", str(val))
+    if not m:
+        return None
+    n = int(m.group(0))
+    return n - 1 if 1 <= n <= n_docs else None
+
+
+def _doc_from_interval(e: dict, spans: list[tuple[int, int]]) -> int | None:
+    ci = e.get("char_interval") or {}
+    start = ci.get("start_pos") if isinstance(ci, dict) else None
+    if start is None:
+        return None
+    for i, (s, t) in enumerate(spans):
+        if s <= start < t:
+            return i
+    return None
+
+
+def demux_extractions(extractions: list[dict], spans: list[tuple[int, int]]) -> list[list[dict]] | None:
+    """
+    Route extractions (dicts) from a packed result to their documents.
+    Returns one list per document, or None if an extraction can't be placed.
+    """
+    n_docs = len(spans)
+    per_doc = [[] for _ in range(n_docs)]
+
+    for e in extractions:
+        e = dict(e)
+        doc = _doc_from_attribute(e, n_docs)
+        if doc is None:
+            doc = _doc_from_interval(e, spans)
+        if doc is None:
+            # no tag and no offset inside a document: guessing would misattribute it
+            return None
+
+        ci = e.get("char_interval")
+        if isinstance(ci, dict) and ci.get("start_pos") is not None:
+            s, t = spans[doc]
+            if s <= ci["start_pos"] and (ci.get("end_pos") or ci["start_pos"]) <= t:
+                e["char_interval"] = {
+                    "start_pos": ci["start_pos"] - s,
+                    "end_pos": (ci["end_pos"] - s) if ci.get("end_pos") is not None else None,
+                }
+            else:
+                # interval straddles a document boundary; keep the text, drop the offsets
+                e["char_interval"] = None
+
+        attrs = e.get("attributes")
+        if isinstance(attrs, dict) and "project" in attrs:
+            attrs = {k: v for k, v in attrs.items() if k != "project"}
+            e["attributes"] = attrs or None
+
+        per_doc[doc].append(e)
+
+    return per_doc
+
+
+def extract_packed(extract_fn, texts: list[str], min_extractions_per_doc: int = 1, stats: dict | None = None) -> list[dict]:
+    """
+    Run extract_fn over `texts` packed into as few calls as possible.
+
+    extract_fn(text, packed) -> langextract result (or dict); `packed` tells
+    it to add PACKED_PROMPT_SUFFIX and disable chunking. Returns one
+    {"text", "extractions", "packed"} dict per input text, in order;
+    "packed" is False for texts that ended up in a call of their own.
+    """
+    stats = stats if stats is not None else {}
+
+    if len(texts) == 1:
+        stats["calls"] = stats.get("calls", 0) + 1
+        d = annotated_to_dict(extract_fn(texts[0], False))
+        return [{"text": texts[0], "extractions": d.get("extractions", []) or [], "packed": False}]
+
+    packed, spans = pack_documents(texts)
+    per_doc = None
+    try:
+        stats["calls"] = stats.get("calls", 0) + 1
+        stats["packed_calls"] = stats.get("packed_calls", 0) + 1
+        d = annotated_to_dict(extract_fn(packed, True))
+        per_doc = demux_extractions(d.get("extractions", []) or [], spans)
+    except Exception as e:
+        print(f"[batch] packed call for {len(texts)} docs failed ({type(e).__name__}: {e}); splitting")
+
+    if per_doc is None:
+        stats["splits"] = stats.get("splits", 0) + 1
+        mid = len(texts) // 2
+        return (
+            extract_packed(extract_fn, texts[:mid], min_extractions_per_doc, stats)
+            + extract_packed(extract_fn, texts[mid:], min_extractions_per_doc, stats)
+        )
+
+    out = []
+    for text, exs in zip(texts, per_doc):
+        if len(exs) < min_extractions_per_doc:
+            # the model skipped or merged this one; ask again for it alone
+            stats["solo_retries"] = stats.get("solo_retries", 0) + 1
+            out.extend(extract_packed(extract_fn, [text], min_extractions_per_doc, stats))
+        else:
+            out.append({"text": text, "extractions": exs, "packed": True})
+    return out
@@ -0,0 +1,315 @@
+"""
+Bulk DataFrame writes to SQL (replaces direct DataFrame.to_sql calls).
+
+bulk_write(df, table, con, ...) creates / replaces / checks the target like
+to_sql (column types inferred from the whole frame, plus dtype) and then
+loads the rows with one of:
+
+  - "executemany": to_sql in batches of batch_rows with pyodbc
+    fast_executemany switched on for the engine (parameter arrays are sent
+    in one round trip per batch instead of one INSERT per row).
+  - "bcp": each partition is written to a UTF-8 delimited file and loaded
+    with the bcp CLI (bulk copy, TABLOCK). Needs bcp on PATH. NULLs load as
+    NULL and empty strings as '' (written as bcp's NUL marker), as with
+    to_sql; BULK_WRITE_CONFIG["bcp_empty_as_null"] loads '' as NULL instead.
+  - "auto" (default): bcp for large frames on SQL Server when available,
+    else executemany.
+
+workers > 1 splits the frame into partitions loaded concurrently over
+pooled connections. Partitions commit separately, so parallel loads are
+only used for appends through an Engine; a Connection (caller's
+transaction, #temp tables) always loads serially on that connection.
+
+Running this module benchmarks the methods against the local SQLite
+backend of utils/db.py (no SQL Server needed):
+    python utils/bulk_writer.py --rows 200000
+"""
+import argparse
+import csv
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas.io.sql import pandasSQL_builder
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Connection, Engine
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import BULK_WRITE_CONFIG
+from utils.db import sqlite_engine
+
+
+_FIELD_SEP = "\x1f"
+_ROW_SEP = "\x1e"
+_QUOTE = "\x1d"
+_CONTROL_RE = re.compile(f"[{_FIELD_SEP}{_ROW_SEP}{_QUOTE}\x00]")
+# bcp -c reads an empty field as NULL and a lone NUL as an empty string
+_BCP_EMPTY = "\x00"
+
+
+# -----------------------
+# engine helpers
+# -----------------------
+def _engine_of(con) -> Engine:
+    return con.engine if isinstance(con, Connection) else con
+
+
+def enable_fast_executemany(engine: Engine) -> None:
+    """Turn on pyodbc fast_executemany for executemany() calls of an mssql engine (idempotent)."""
+    if engine.dialect.name != "mssql" or getattr(engine.dialect, "fast_executemany", False):
+        return
+    if getattr(engine, "_bulk_writer_fast", False):
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _fast(conn, cursor, statement, parameters, context, executemany):
+        if executemany and hasattr(cursor, "fast_executemany"):
+            cursor.fast_executemany = True
+
+    engine._bulk_writer_fast = True
+
+
+# -----------------------
+# load methods
+# -----------------------
+def _load_executemany(df: pd.DataFrame, table: str, con, schema, dtype, batch_rows: int) -> None:
+    enable_fast_executemany(_engine_of(con))
+    df.to_sql(
+        table,
+        con,
+        schema=schema,
+        if_exists="append",
+        index=False,
+        dtype=dtype,
+        chunksize=batch_rows,
+        method=None,
+    )
+
+
+def _odbc_params(engine: Engine) -> dict:
+    raw = engine.url.query.get("odbc_connect", "")
+    params = {}
+    for part in str(raw).split(";"):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            params[k.strip().lower()] = v.strip().strip("{}")
+    return params
+
+
+def bcp_available() -> bool:
+    return shutil.which(BULK_WRITE_CONFIG["bcp_path"]) is not None
+
+
+def _bcp_frame(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """df in the table's column order, as text bcp can load."""
+    out = pd.DataFrame(index=df.index)
+    for c in columns:
+        if c not in df.columns:
+            out[c] = None
+            continue
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            s = s.dt.strftime("%Y-%m-%d %H:%M:%S.%f").str[:-3]
+        elif pd.api.types.is_bool_dtype(s):
+            s = s.map({True: "1", False: "0"})
+        elif pd.api.types.is_float_dtype(s) and (s.dropna() % 1 == 0).all():
+            # ints with NULLs come out of pandas as floats; "1.0" does not load into INT
+            s = s.astype("Int64")
+        elif s.dtype == object or pd.api.types.is_string_dtype(s):
+            empty = None if BULK_WRITE_CONFIG["bcp_empty_as_null"] else _BCP_EMPTY
+            s = s.map(lambda v: (_CONTROL_RE.sub(" ", v) or empty) if isinstance(v, str) else v)
+        out[c] = s
+    return out
+
+
+def _load_bcp(df: pd.DataFrame, table: str, engine: Engine, schema, batch_rows: int) -> None:
+    params = _odbc_params(engine)
+    server, database = params.get("server"), params.get("database")
+    if not server or not database:
+        raise RuntimeError("bcp needs SERVER and DATABASE in the engine's odbc_connect string")
+
+    columns = [c["name"] for c in inspect(engine).get_columns(table, schema=schema)]
+    tmp_dir = Path(BULK_WRITE_CONFIG["tmp_dir"])
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    data_file = tmp_dir / f"{table}_{uuid.uuid4().hex}.dat"
+    err_file = data_file.with_suffix(".err")
+
+    try:
+        _bcp_frame(df, columns).to_csv(
+            data_file,
+            sep=_FIELD_SEP,
+            lineterminator=_ROW_SEP,
+            header=False,
+            index=False,
+            na_rep="",
+            quoting=csv.QUOTE_NONE,
+            quotechar=_QUOTE,
+            encoding="utf-8",
+        )
+
+        auth = ["-T"] if params.get("trusted_connection", "").lower() == "yes" else [
+            "-U", params.get("uid", ""), "-P", params.get("pwd", ""),
+        ]
+        cmd = [
+            BULK_WRITE_CONFIG["bcp_path"], f"{schema}.{table}" if schema else table, "in", str(data_file),
+            "-S", server, "-d", database, *auth,
+            "-c", "-C", "65001", "-t", "0x1f", "-r", "0x1e", "-k",
+            "-b", str(batch_rows), "-h", "TABLOCK", "-m", "1", "-e", str(err_file),
+            *BULK_WRITE_CONFIG["bcp_extra_args"],
+        ]
+        res = subprocess.run(cmd, capture_output=True, text=True)
+
+        m = re.search(r"(\d+) rows copied", res.stdout)
+        copied = int(m.group(1)) if m else -1
+        if res.returncode != 0 or copied != len(df):
+            detail = (res.stdout + res.stderr).strip()[-2000:]
+            raise RuntimeError(f"bcp loaded {copied}/{len(df)} rows into {schema}.{table}: {detail}")
+    finally:
+        data_file.unlink(missing_ok=True)
+        if err_file.exists() and err_file.stat().st_size == 0:
+            err_file.unlink()
+
+
+def _partitions(df: pd.DataFrame, n: int) -> list[pd.DataFrame]:
+    if n <= 1 or len(df) < 2 * n:
+        return [df]
+    return [df.iloc[idx] for idx in np.array_split(np.arange(len(df)), n)]
+
+
+def resolve_method(df: pd.DataFrame, con, method: str | None = None) -> str:
+    method = method or BULK_WRITE_CONFIG["method"]
+    if method not in {"auto", "executemany", "bcp"}:
+        raise ValueError(f"Unknown bulk write method: {method}")
+
+    bcp_ok = isinstance(con, Engine) and con.dialect.name == "mssql" and bcp_available()
+    if method == "bcp" and not bcp_ok:
+        print("[WARN] bcp unavailable for this target (needs an mssql Engine and the bcp CLI); using executemany")
+        return "executemany"
+    if method == "auto":
+        return "bcp" if bcp_ok and len(df) >= BULK_WRITE_CONFIG["bcp_min_rows"] else "executemany"
+    return method
+
+
+def _prepare_table(df: pd.DataFrame, table: str, con, schema, if_exists: str, dtype) -> None:
+    """
+    Create / replace / check the target exactly as to_sql would. Types are
+    inferred from the whole frame: from df.head(0) every object column
+    would become TEXT, where to_sql finds DATE or BOOLEAN values.
+    """
+    with pandasSQL_builder(con, schema=schema, need_transaction=True) as db:
+        db.prep_table(df, table, if_exists=if_exists, index=False, schema=schema, dtype=dtype)
+
+
+# -----------------------
+# public API
+# -----------------------
+def bulk_write(
+    df: pd.DataFrame,
+    table: str,
+    con,
+    schema: str | None = None,
+    if_exists: str = "append",
+    dtype: dict | None = None,
+    method: str | None = None,
+    workers: int | None = None,
+    batch_rows: int | None = None,
+) -> int:
+    """
+    Drop-in for df.to_sql(table, con, schema=..., if_exists=..., index=False,
+    dtype=...). Returns the number of rows written.
+    """
+    batch_rows = int(batch_rows or BULK_WRITE_CONFIG["batch_rows"])
+    workers = int(workers or BULK_WRITE_CONFIG["workers"])
+    if isinstance(con, Connection) or con.dialect.name != "mssql":
+        workers = 1
+
+    _prepare_table(df, table, con, schema, if_exists, dtype)
+    if df.empty:
+        return 0
+
+    method = resolve_method(df, con, method)
+    parts = _partitions(df, workers)
+
+    def load(part: pd.DataFrame):
+        if method == "bcp":
+            _load_bcp(part, table, con, schema, batch_rows)
+        elif isinstance(con, Connection):
+            _load_executemany(part, table, con, schema, dtype, batch_rows)
+        else:
+            with con.begin() as conn:
+                _load_executemany(part, table, conn, schema, dtype, batch_rows)
+
+    if len(parts) == 1:
+        load(parts[0])
+    else:
+        with ThreadPoolExecutor(max_workers=len(parts)) as ex:
+            list(ex.map(load, parts))
+
+    return len(df)
+
+
+# -----------------------
+# offline benchmark
+# -----------------------
+def _synthetic_pairs(rows: int, text_len: int, seed: int = 7) -> pd.DataFrame:
+    """Rows shaped like the 3b similarity output (keys, score, wide text)."""
+    rng = np.random.default_rng(seed)
+    words = np.array(["project", "water", "school", "health", "relief", "food", "shelter", "مشروع", "مياه", "مدرسة"])
+    n_words = max(1, text_len // 7)
+    text = [" ".join(rng.choice(words, n_words)) for _ in range(min(rows, 1000))]
+    return pd.DataFrame({
+        "index_a": [f"IDX-{i:09d}" for i in range(rows)],
+        "index_b": [f"IDX-{i + 1:09d}" for i in range(rows)],
+        "similarity": rng.random(rows),
+        "title_a": [text[i % len(text)] for i in range(rows)],
+        "title_b": [text[(i + 1) % len(text)] for i in range(rows)],
+        "ts_inserted": pd.Timestamp.now(),
+    })
+
+
+def _benchmark(rows: int, text_len: int, workers: int, db_dir: str | None):
+    df = _synthetic_pairs(rows, text_len)
+    base = Path(db_dir or tempfile.mkdtemp(prefix="bulk_writer_bench_"))
+    print(f"[bench] rows={rows} | text_len={text_len} | backend=sqlite | dir={base}")
+
+    cases = {
+        "to_sql chunksize=200 (old call shape)": lambda eng: df.to_sql(
+            "bench_pairs", eng, schema="silver", if_exists="replace", index=False, chunksize=200, method=None
+        ),
+        "to_sql method=multi chunksize=200": lambda eng: df.to_sql(
+            "bench_pairs", eng, schema="silver", if_exists="replace", index=False, chunksize=200, method="multi"
+        ),
+        f"bulk_write executemany batch_rows={BULK_WRITE_CONFIG['batch_rows']}": lambda eng: bulk_write(
+            df, "bench_pairs", eng, schema="silver", if_exists="replace", method="executemany", workers=workers
+        ),
+    }
+
+    for i, (name, run) in enumerate(cases.items()):
+        engine = sqlite_engine(base / f"bench_{i}")
+        t0 = time.perf_counter()
+        run(engine)
+        elapsed = time.perf_counter() - t0
+        with engine.connect() as conn:
+            n = pd.read_sql("SELECT COUNT(*) AS n FROM silver.bench_pairs", conn)["n"].iloc[0]
+        engine.dispose()
+        print(f"[bench] {name:<45} {elapsed:8.2f}s | {rows / elapsed:>10,.0f} rows/s | rows={n}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bulk_write against a local SQLite stand-in")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--text-len", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--db-dir", default=None, help="Directory for the stand-in databases (default: temp dir)")
+    args = parser.parse_args()
+
+    _benchmark(args.rows, args.text_len, args.workers, args.db_dir)
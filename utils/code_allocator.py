@@ -0,0 +1,214 @@
+"""
+Master / project code allocation backed by SQL Server.
+
+Per target schema there is a mapping table <schema>.master_code_map
+([index] -> master_project_code) and a SEQUENCE <schema>.master_code_seq.
+Post-processing steps only look up the indexes they are processing (join
+on a #temp key table), so startup no longer reads the whole target table.
+New codes come from sys.sp_sequence_get_range in blocks kept in a local
+cache; the mapping insert is conditional (UPDLOCK, HOLDLOCK), so two
+post-processors running at once never give one index two codes or one
+code to two indexes. Codes stay unique and increasing but may have gaps
+(unused rest of a block, lost races).
+
+The first use in a schema creates both objects: the mapping is backfilled
+from the target table and the sequence starts after its highest MP- code.
+"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import text as sql_text
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_helpers import stage_key_table
+from utils.bulk_writer import bulk_write
+from utils.db import require_mssql
+from utils.post_processing_helpers import fmt_mp
+
+
+class CodeAllocator:
+    def __init__(self, engine, schema: str = "silver", target_table: str = "MasterTable_extracted", block_size: int = 1000):
+        require_mssql(engine, "CodeAllocator")
+        self.engine = engine
+        self.schema = schema
+        self.target = f"{schema}.{target_table}"
+        self.map_table = f"{schema}.master_code_map"
+        self.sequence = f"{schema}.master_code_seq"
+        self.block_size = max(1, block_size)
+
+        self._cache = {}
+        self._next = 1
+        self._last = 0
+        self._ready = False
+
+    # -----------------------
+    # setup
+    # -----------------------
+    def _ensure(self, conn):
+        if self._ready:
+            return
+        conn.execute(sql_text(f"""
+            DECLARE @lock INT;
+            EXEC @lock = sp_getapplock
+                @Resource = N'code_allocator:{self.schema}',
+                @LockMode = N'Exclusive',
+                @LockOwner = N'Transaction',
+                @LockTimeout = 60000;
+
+            IF OBJECT_ID(N'{self.map_table}', N'U') IS NULL
+            BEGIN
+                CREATE TABLE {self.map_table} (
+                    [index] NVARCHAR(255) NOT NULL PRIMARY KEY,
+                    master_project_code NVARCHAR(32) NOT NULL,
+                    created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+                );
+
+                IF OBJECT_ID(N'{self.target}', N'U') IS NOT NULL
+                    INSERT INTO {self.map_table} ([index], master_project_code)
+                    SELECT CAST([index] AS NVARCHAR(255)), MIN(master_project_code)
+                    FROM {self.target}
+                    WHERE [index] IS NOT NULL
+                      AND master_project_code IS NOT NULL
+                    GROUP BY CAST([index] AS NVARCHAR(255));
+            END
+
+            IF OBJECT_ID(N'{self.sequence}', N'SO') IS NULL
+            BEGIN
+                DECLARE @start BIGINT = 1 + COALESCE((
+                    SELECT MAX(TRY_CAST(SUBSTRING(master_project_code, 4, 32) AS BIGINT))
+                    FROM {self.map_table}
+                    WHERE master_project_code LIKE 'MP-%'
+                ), 0);
+                DECLARE @sql NVARCHAR(MAX) =
+                    N'CREATE SEQUENCE {self.sequence} AS BIGINT START WITH '
+                    + CAST(@start AS NVARCHAR(20)) + N' INCREMENT BY 1 NO CACHE;';
+                EXEC sp_executesql @sql;
+            END
+        """))
+        self._ready = True
+
+    # -----------------------
+    # master codes
+    # -----------------------
+    def _lookup(self, keys: list[str]) -> dict:
+        with self.engine.begin() as conn:
+            self._ensure(conn)
+            stage_key_table(conn, "#alloc_keys", keys, column="index")
+            rows = conn.execute(sql_text(f"""
+                SELECT M.[index], M.master_project_code
+                FROM {self.map_table} AS M
+                INNER JOIN #alloc_keys AS K
+                    ON M.[index] COLLATE DATABASE_DEFAULT = K.[index] COLLATE DATABASE_DEFAULT;
+            """)).fetchall()
+        return {str(index): code for index, code in rows}
+
+    def _get_range(self, size: int) -> int:
+        with self.engine.begin() as conn:
+            return int(conn.execute(sql_text(f"""
+                SET NOCOUNT ON;
+                DECLARE @first SQL_VARIANT;
+                EXEC sys.sp_sequence_get_range
+                    @sequence_name = N'{self.sequence}',
+                    @range_size = {int(size)},
+                    @range_first_value = @first OUTPUT;
+                SELECT CAST(@first AS BIGINT);
+            """)).scalar())
+
+    def _take_numbers(self, n: int) -> list[int]:
+        out = []
+        while len(out) < n:
+            if self._next > self._last:
+                size = max(self.block_size, n - len(out))
+                self._next = self._get_range(size)
+                self._last = self._next + size - 1
+            take = min(n - len(out), self._last - self._next + 1)
+            out.extend(range(self._next, self._next + take))
+            self._next += take
+        return out
+
+    def _claim(self, keys: list[str]) -> dict:
+        proposed = pd.DataFrame({
+            "index": keys,
+            "master_project_code": [fmt_mp(n) for n in self._take_numbers(len(keys))],
+        })
+
+        with self.engine.begin() as conn:
+            conn.execute(sql_text("IF OBJECT_ID('tempdb..#alloc_new') IS NOT NULL DROP TABLE #alloc_new;"))
+            conn.execute(sql_text(
+                "CREATE TABLE #alloc_new ([index] NVARCHAR(255) NOT NULL PRIMARY KEY, "
+                "master_project_code NVARCHAR(32) NOT NULL);"
+            ))
+            bulk_write(proposed, "#alloc_new", conn, if_exists="append")
+
+            # an index another process mapped in the meantime keeps that code
+            conn.execute(sql_text(f"""
+                INSERT INTO {self.map_table} ([index], master_project_code)
+                SELECT N.[index], N.master_project_code
+                FROM #alloc_new AS N
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM {self.map_table} AS M WITH (UPDLOCK, HOLDLOCK)
+                    WHERE M.[index] COLLATE DATABASE_DEFAULT = N.[index] COLLATE DATABASE_DEFAULT
+                );
+            """))
+            rows = conn.execute(sql_text(f"""
+                SELECT M.[index], M.master_project_code
+                FROM {self.map_table} AS M
+                INNER JOIN #alloc_new AS N
+                    ON M.[index] COLLATE DATABASE_DEFAULT = N.[index] COLLATE DATABASE_DEFAULT;
+            """)).fetchall()
+        return {str(index): code for index, code in rows}
+
+    def master_codes(self, indexes) -> dict[str, str]:
+        """master_project_code for every index: cached, else existing mapping, else a new code."""
+        keys = list(dict.fromkeys(str(k).strip() for k in indexes if k is not None and str(k).strip()))
+
+        missing = [k for k in keys if k not in self._cache]
+        if missing:
+            self._cache.update(self._lookup(missing))
+            new = [k for k in missing if k not in self._cache]
+            if new:
+                self._cache.update(self._claim(new))
+
+        return {k: self._cache[k] for k in keys}
+
+    # -----------------------
+    # project codes
+    # -----------------------
+    def project_codes(self, indexes) -> tuple[dict, dict]:
+        """
+        Existing project codes of `indexes` in the target table, for steps
+        that reuse them: ({(index, project_title_en): project_code},
+        {master_project_code: highest project suffix}). Project numbering
+        is per master code and a master code belongs to one index, so the
+        rows of `indexes` hold every code that matters.
+        """
+        with self.engine.begin() as conn:
+            if conn.execute(sql_text("SELECT OBJECT_ID(:t, N'U')"), {"t": self.target}).scalar() is None:
+                return {}, {}
+            stage_key_table(conn, "#alloc_keys", indexes, column="index")
+            existing = pd.read_sql(sql_text(f"""
+                SELECT CAST(T.[index] AS NVARCHAR(255)) AS [index], T.project_title_en, T.project_code, T.master_project_code
+                FROM {self.target} AS T
+                INNER JOIN #alloc_keys AS K
+                    ON CAST(T.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT = K.[index] COLLATE DATABASE_DEFAULT
+                WHERE T.project_title_en IS NOT NULL
+                  AND T.project_code IS NOT NULL
+                  AND T.master_project_code IS NOT NULL;
+            """), conn)
+
+        existing = (
+            existing.sort_values(["index", "master_project_code", "project_code"])
+            .drop_duplicates(["index", "project_title_en"], keep="first")
+        )
+        index_title_to_prj_code = dict(
+            zip(zip(existing["index"], existing["project_title_en"]), existing["project_code"])
+        )
+
+        suffix = pd.to_numeric(existing["project_code"].str.extract(r"(\d+)\s*$")[0], errors="coerce")
+        master_to_max_prj = (
+            suffix.groupby(existing["master_project_code"]).max().dropna().astype(int).to_dict()
+        )
+        return index_title_to_prj_code, master_to_max_prj
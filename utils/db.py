@@ -0,0 +1,148 @@
+"""
+Database engines for the pipeline scripts.
+
+get_engine() returns one pooled engine per process, built from DB_CONFIG
+(config/app_config.py); any key can be overridden with DB_<KEY> in the
+environment. Backends:
+
+  - "mssql" (default): SQL Server over pyodbc, QueuePool sized by
+    pool_size / max_overflow, pre-ping, recycle and fast_executemany.
+  - "sqlite": <path>.sqlite with one ATTACHed file per schema, so
+    schema-qualified names (silver.MasterTable_extracted) resolve unchanged.
+  - "duckdb": <path>.duckdb with the same schemas (needs duckdb_engine).
+
+The local backends are for reads and benchmarks only: they keep the table
+layout so source reads (read_source_sql without the snapshot) and the
+bulk_write benchmark run offline. The write paths of the pipeline issue T-SQL (#temp key tables,
+MERGE upserts, the code allocator's SEQUENCE, the silver refresh queries)
+and call require_mssql, which fails with a clear error on sqlite / duckdb.
+"""
+import os
+import sys
+import threading
+import urllib.parse
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import NoSuchModuleError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import DB_CONFIG
+
+
+_ENGINES: dict[tuple, Engine] = {}
+_LOCK = threading.Lock()
+
+
+def db_setting(key: str):
+    """DB_CONFIG[key], overridden by the environment variable DB_<KEY>."""
+    default = DB_CONFIG[key]
+    raw = os.environ.get(f"DB_{key.upper()}")
+    if raw is None:
+        return default
+    if isinstance(default, bool):
+        return raw.strip().lower() in {"1", "true", "yes"}
+    if isinstance(default, int):
+        return int(raw)
+    if isinstance(default, list):
+        return [p.strip() for p in raw.split(",") if p.strip()]
+    return raw
+
+
+# -----------------------
+# backends
+# -----------------------
+def odbc_connect_string() -> str:
+    parts = [
+        f"DRIVER={{{db_setting('driver')}}}",
+        f"SERVER={db_setting('server')}",
+        f"DATABASE={db_setting('database')}",
+    ]
+    if db_setting("uid"):
+        parts += [f"UID={db_setting('uid')}", f"PWD={db_setting('pwd')}"]
+    else:
+        parts.append(f"Trusted_Connection={db_setting('trusted_connection')}")
+    if str(db_setting("trust_server_certificate")).lower() == "yes":
+        parts.append("TrustServerCertificate=yes")
+    return ";".join(parts) + ";"
+
+
+def mssql_engine() -> Engine:
+    params = urllib.parse.quote_plus(odbc_connect_string())
+    return create_engine(
+        f"mssql+pyodbc:///?odbc_connect={params}",
+        fast_executemany=db_setting("fast_executemany"),
+        pool_size=db_setting("pool_size"),
+        max_overflow=db_setting("max_overflow"),
+        pool_recycle=db_setting("pool_recycle_s"),
+        pool_pre_ping=db_setting("pool_pre_ping"),
+    )
+
+
+def sqlite_engine(path: str | Path, schemas=None) -> Engine:
+    """<path>.sqlite with every schema ATTACHed from <path>.<schema>.sqlite."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    schemas = schemas if schemas is not None else db_setting("schemas")
+    engine = create_engine(f"sqlite:///{path}.sqlite", connect_args={"timeout": 60})
+
+    @event.listens_for(engine, "connect")
+    def _attach(dbapi_conn, _record):
+        for schema in schemas:
+            dbapi_conn.execute(f"ATTACH DATABASE '{path}.{schema}.sqlite' AS [{schema}]")
+
+    return engine
+
+
+def duckdb_engine(path: str | Path, schemas=None) -> Engine:
+    """<path>.duckdb with every schema created on connect."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    schemas = schemas if schemas is not None else db_setting("schemas")
+    try:
+        engine = create_engine(f"duckdb:///{path}.duckdb")
+    except NoSuchModuleError as e:
+        raise RuntimeError("DB backend 'duckdb' needs the duckdb and duckdb_engine packages") from e
+
+    @event.listens_for(engine, "connect")
+    def _schemas(dbapi_conn, _record):
+        for schema in schemas:
+            dbapi_conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+    return engine
+
+
+def build_engine(backend: str | None = None, path: str | Path | None = None) -> Engine:
+    backend = backend or db_setting("backend")
+    path = path or db_setting("path")
+    if backend == "mssql":
+        return mssql_engine()
+    if backend == "sqlite":
+        return sqlite_engine(path)
+    if backend == "duckdb":
+        return duckdb_engine(path)
+    raise ValueError(f"Unknown DB backend: {backend}")
+
+
+# -----------------------
+# public API
+# -----------------------
+def require_mssql(con, what: str) -> None:
+    """Fail early when a T-SQL helper gets a local (read / benchmark only) backend."""
+    if con.dialect.name != "mssql":
+        raise NotImplementedError(
+            f"{what} issues T-SQL and needs the mssql backend; "
+            f"the {con.dialect.name} backend covers reads and benchmarks only"
+        )
+
+
+def get_engine() -> Engine:
+    """The process's pooled engine, built on first use (again in forked children)."""
+    key = (os.getpid(), db_setting("backend"), str(db_setting("path")))
+    with _LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = _ENGINES[key] = build_engine()
+    return engine
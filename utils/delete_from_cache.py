@@ -1,11 +1,15 @@
-import pickle
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_cache import open_run_cache
+
+# the run's legacy pickle path; entries live in the .sqlite next to it
 PKL_PATH = Path("C:\\Users\\SREE\\data-cleansing-framework\\data\\outputs\\full-run\\full-run_lx_cache.pkl")
 DOC_ID_TO_DELETE = "doc_787fe011"
 
-with PKL_PATH.open("rb") as f:
-    cache = pickle.load(f)
+cache = open_run_cache(PKL_PATH)
 
 keys_to_delete = []
 for k, doc in cache.items():
@@ -16,8 +20,7 @@ for k, doc in cache.items():
 for k in keys_to_delete:
     del cache[k]
 
-with PKL_PATH.open("wb") as f:
-    pickle.dump(cache, f)
-
-print(f"Deleted {len(keys_to_delete)} cached entries for document_id={DOC_ID_TO_DELETE}")
+cache.flush()
+cache.close()
 
+print(f"Deleted {len(keys_to_delete)} cached entries for document_id={DOC_ID_TO_DELETE} from {cache.path}")
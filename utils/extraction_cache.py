@@ -0,0 +1,444 @@
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_helpers import load_cache
+
+
+# -----------------------
+# SQLite-backed extraction cache
+# -----------------------
+class SqliteCache:
+    """
+    Key-value extraction cache (text_hash -> pickled result) stored in SQLite.
+
+    Exposes the same mapping interface the extraction scripts used on the
+    pickle dict (`h in cache`, `cache[h]`, `cache[h] = result`, `len(cache)`),
+    but every put is its own small transaction: checkpoints cost nothing and
+    a crash loses at most the row being written. WAL mode lets other
+    processes read the cache while a run is writing to it.
+    """
+
+    def __init__(self, path: Path, table: str = "lx_cache"):
+        self.path = Path(path)
+        self.table = table
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            "  key TEXT PRIMARY KEY,"
+            "  value BLOB NOT NULL"
+            ")"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread; sqlite3 connections must not be shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    # -------- mapping interface --------
+    def get(self, key, default=None):
+        row = self._conn().execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def __contains__(self, key) -> bool:
+        row = self._conn().execute(
+            f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        row = self._conn().execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        conn = self._conn()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+            (key, sqlite3.Binary(pickle.dumps(value))),
+        )
+        conn.commit()
+
+    def __delitem__(self, key):
+        conn = self._conn()
+        cur = conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        conn.commit()
+        if cur.rowcount == 0:
+            raise KeyError(key)
+
+    def __len__(self) -> int:
+        return self._conn().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def items(self):
+        """Yield (key, value) for every entry, unpickled one row at a time."""
+        cur = self._conn().execute(f"SELECT key, value FROM {self.table}")
+        for key, value in cur:
+            yield key, pickle.loads(value)
+
+    def update(self, entries: dict, replace: bool = False):
+        """Write entries in one transaction; replace=True drops every other entry first."""
+        conn = self._conn()
+        with conn:
+            if replace:
+                conn.execute(f"DELETE FROM {self.table}")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                ((k, sqlite3.Binary(pickle.dumps(v))) for k, v in entries.items()),
+            )
+
+    # -------- maintenance --------
+    def import_pickle(self, pkl_path: Path) -> int:
+        """
+        Copy entries from a legacy whole-dict pickle cache.
+        Existing keys are kept; returns the number of entries read.
+        """
+        old = load_cache(Path(pkl_path))
+        if not old:
+            return 0
+
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table} (key, value) VALUES (?, ?)",
+                ((k, sqlite3.Binary(pickle.dumps(v))) for k, v in old.items()),
+            )
+        return len(old)
+
+    def get_meta(self, key: str):
+        row = self._conn().execute("SELECT value FROM cache_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES (?, ?)", (key, value))
+        conn.commit()
+
+    def flush(self):
+        """Entries are committed on write; this only folds the WAL back into the db file."""
+        self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._conns = []
+        self._local = threading.local()
+
+
+def open_run_cache(cache_pkl: Path) -> SqliteCache:
+    """
+    Open the per-run SQLite cache that replaces `<run>_..._cache.pkl`.
+    The db lives next to the old pickle (same name, .sqlite suffix); an
+    existing pickle is imported once on first open and never read again, so
+    maintenance tools (utils/delete_from_cache.py, utils/migrate_cache.py)
+    edit the SQLite cache through this function, not the pickle.
+    """
+    cache_pkl = Path(cache_pkl)
+    cache = SqliteCache(cache_pkl.with_suffix(".sqlite"))
+
+    import_key = f"pickle_imported:{cache_pkl.name}"
+    if cache_pkl.exists() and cache.get_meta(import_key) is None:
+        n = cache.import_pickle(cache_pkl)
+        cache.set_meta(import_key, str(n))
+        print(f"[INFO] Imported {n} entries from legacy pickle cache {cache_pkl.name}")
+
+    return cache
+
+
+# -----------------------
+# cross-run global LLM cache
+# -----------------------
+GLOBAL_CACHE_PATH = Path(os.environ.get("LLM_CACHE_PATH", "data/cache/llm_cache.sqlite"))
+GLOBAL_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "500000"))
+
+# how often (in puts) the size cap is checked
+_EVICT_CHECK_EVERY = 200
+# evict down to this fraction of the cap, so eviction doesn't run on every put
+_EVICT_LOW_WATER = 0.9
+
+
+def _to_plain(obj):
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if isinstance(obj, (list, tuple)):
+        return [_to_plain(x) for x in obj]
+    if isinstance(obj, dict):
+        return {str(k): _to_plain(v) for k, v in obj.items()}
+    return obj
+
+
+def fingerprint(obj) -> str:
+    """Stable sha256 of a prompt / examples list / config value."""
+    payload = json.dumps(_to_plain(obj), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GlobalLlmCache:
+    """
+    One SQLite file shared by every run ID.
+
+    Entries are keyed by (namespace, version, text_hash) where version hashes
+    the prompt, the few-shot examples and the model_id. Editing a prompt
+    therefore only misses for that namespace; entries of the old version
+    are never read again and age out through LRU eviction once the
+    configured size cap is reached.
+    """
+
+    def __init__(self, path: Path = GLOBAL_CACHE_PATH, max_entries: int = GLOBAL_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts_since_check = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "  namespace TEXT NOT NULL,"
+            "  version TEXT NOT NULL,"
+            "  text_hash TEXT NOT NULL,"
+            "  value BLOB NOT NULL,"
+            "  created_at REAL NOT NULL,"
+            "  last_used REAL NOT NULL,"
+            "  PRIMARY KEY (namespace, version, text_hash)"
+            ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache_stats ("
+            "  namespace TEXT PRIMARY KEY,"
+            "  hits INTEGER NOT NULL DEFAULT 0,"
+            "  misses INTEGER NOT NULL DEFAULT 0,"
+            "  puts INTEGER NOT NULL DEFAULT 0,"
+            "  evictions INTEGER NOT NULL DEFAULT 0"
+            ")"
+        )
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def namespace(self, name: str, prompt, examples, model_id: str) -> "LlmCacheNamespace":
+        version = fingerprint(
+            {
+                "prompt": fingerprint(prompt),
+                "examples": fingerprint(examples),
+                "model_id": model_id,
+            }
+        )
+        return LlmCacheNamespace(self, name, version)
+
+    def _get(self, namespace: str, version: str, key: str):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value FROM llm_cache WHERE namespace = ? AND version = ? AND text_hash = ?",
+            (namespace, version, key),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE llm_cache SET last_used = ? WHERE namespace = ? AND version = ? AND text_hash = ?",
+            (time.time(), namespace, version, key),
+        )
+        conn.commit()
+        return pickle.loads(row[0])
+
+    def _put(self, namespace: str, version: str, key: str, value) -> int:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (namespace, version, text_hash, value, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, version, key, sqlite3.Binary(pickle.dumps(value)), now, now),
+        )
+        conn.commit()
+
+        with self._lock:
+            self._puts_since_check += 1
+            if self._puts_since_check < _EVICT_CHECK_EVERY:
+                return 0
+            self._puts_since_check = 0
+        return self.evict()
+
+    def evict(self) -> int:
+        """Drop least-recently-used entries once the cache is over max_entries."""
+        if not self.max_entries or self.max_entries <= 0:
+            return 0
+
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if total <= self.max_entries:
+            return 0
+
+        n_drop = total - int(self.max_entries * _EVICT_LOW_WATER)
+        with conn:
+            conn.execute(
+                "DELETE FROM llm_cache WHERE rowid IN ("
+                "  SELECT rowid FROM llm_cache ORDER BY last_used LIMIT ?"
+                ")",
+                (n_drop,),
+            )
+        return n_drop
+
+    def record_stats(self, namespace: str, hits: int, misses: int, puts: int, evictions: int):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO llm_cache_stats (namespace, hits, misses, puts, evictions) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(namespace) DO UPDATE SET "
+            "  hits = hits + excluded.hits,"
+            "  misses = misses + excluded.misses,"
+            "  puts = puts + excluded.puts,"
+            "  evictions = evictions + excluded.evictions",
+            (namespace, hits, misses, puts, evictions),
+        )
+        conn.commit()
+
+    def stats(self) -> list[dict]:
+        conn = self._conn()
+        sizes = dict(
+            conn.execute("SELECT namespace, COUNT(*) FROM llm_cache GROUP BY namespace").fetchall()
+        )
+        rows = conn.execute(
+            "SELECT namespace, hits, misses, puts, evictions FROM llm_cache_stats ORDER BY namespace"
+        ).fetchall()
+        out = []
+        for namespace, hits, misses, puts, evictions in rows:
+            lookups = hits + misses
+            out.append(
+                {
+                    "namespace": namespace,
+                    "entries": sizes.get(namespace, 0),
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": round(hits / lookups, 4) if lookups else None,
+                    "puts": puts,
+                    "evictions": evictions,
+                }
+            )
+        return out
+
+
+class LlmCacheNamespace:
+    """
+    View of the global cache for one (namespace, prompt/examples/model version).
+    get() returns None on a miss; hits and misses are counted for this run
+    and added to the persistent per-namespace stats by flush_stats().
+    """
+
+    def __init__(self, cache: GlobalLlmCache, name: str, version: str):
+        self.cache = cache
+        self.name = name
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+        self._flushed = (0, 0, 0, 0)
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        value = self.cache._get(self.name, self.version, key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        """Presence check only: no hit/miss accounting and no LRU touch (used by --plan)."""
+        row = self.cache._conn().execute(
+            "SELECT 1 FROM llm_cache WHERE namespace = ? AND version = ? AND text_hash = ?",
+            (self.name, self.version, key),
+        ).fetchone()
+        return row is not None
+
+    def __setitem__(self, key: str, value):
+        evicted = self.cache._put(self.name, self.version, key, value)
+        with self._lock:
+            self.puts += 1
+            self.evictions += evicted
+
+    def stats_line(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f"{self.hits / lookups:.1%}" if lookups else "n/a"
+        return (
+            f"[llm-cache] namespace={self.name} | version={self.version[:12]} "
+            f"| hits={self.hits} | misses={self.misses} | hit_rate={rate} "
+            f"| puts={self.puts} | evictions={self.evictions}"
+        )
+
+    def flush_stats(self):
+        """Add this run's counts (since the last flush) to the persistent stats table."""
+        with self._lock:
+            current = (self.hits, self.misses, self.puts, self.evictions)
+            delta = [c - f for c, f in zip(current, self._flushed)]
+            self._flushed = current
+        if any(delta):
+            self.cache.record_stats(self.name, *delta)
+
+
+_GLOBAL_CACHE = None
+_GLOBAL_CACHE_LOCK = threading.Lock()
+
+
+def get_global_cache() -> GlobalLlmCache:
+    """Process-wide GlobalLlmCache (path / size cap from LLM_CACHE_PATH / LLM_CACHE_MAX_ENTRIES)."""
+    global _GLOBAL_CACHE
+    with _GLOBAL_CACHE_LOCK:
+        if _GLOBAL_CACHE is None:
+            _GLOBAL_CACHE = GlobalLlmCache()
+        return _GLOBAL_CACHE
+
+
+def open_llm_cache(namespace: str, prompt, examples, model_id: str) -> LlmCacheNamespace:
+    return get_global_cache().namespace(namespace, prompt, examples, model_id)
+
+
+if __name__ == "__main__":
+    # python utils/extraction_cache.py  -> per-namespace size / hit-rate report
+    for row in get_global_cache().stats():
+        print(
+            f"{row['namespace']:<32} entries={row['entries']:<8} hits={row['hits']:<8} "
+            f"misses={row['misses']:<8} hit_rate={row['hit_rate']} evictions={row['evictions']}"
+        )
@@ -3,9 +3,16 @@ import json
 import hashlib
 import pickle
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas as pd
+from sqlalchemy import text as sql_text
+
+from utils.bulk_writer import bulk_write
+from utils.db import require_mssql
 
 
 # -----------------------
@@ -31,102 +38,253 @@ def load_processed_indexes_from_jsonl(path: Path) -> set:
     return done
 
 
-def _jsonl_remove_index(jsonl_path: Path, idx, index_key: str = "index") -> bool:
-    """
-    Rewrite JSONL excluding records where record[index_key] == idx.
-    Returns True if any record was removed.
-    """
-    if not jsonl_path.exists():
-        return False
+def _jsonl_append(jsonl_path: Path, record: dict):
+    jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+    with jsonl_path.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-    tmp_path = jsonl_path.with_suffix(jsonl_path.suffix + ".tmp")
-    removed = False
 
-    with jsonl_path.open("r", encoding="utf-8") as src, tmp_path.open("w", encoding="utf-8") as dst:
-        for line in src:
-            s = line.strip()
-            if not s:
-                continue
-            try:
-                obj = json.loads(s)
-            except Exception:
-                dst.write(line)
-                continue
+class JsonlIndexWriter:
+    """
+    Append-only JSONL writer keyed by record[index_key].
 
-            if obj.get(index_key) == idx:
-                removed = True
-                continue
+    Every upsert is one append. An in-memory key -> byte offset index tracks
+    the latest line per key, so the last write for a key wins. Older lines
+    for the same key stay in the file until compact() rewrites it once.
+    """
 
-            dst.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    def __init__(self, path: Path, index_key: str = "index"):
+        self.path = Path(path)
+        self.index_key = index_key
+        self.offsets = {}
+        self.stale_lines = 0
+        self._fh = None
+        self._needs_newline = False
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _scan(self):
+        self.offsets = {}
+        self.stale_lines = 0
+        self._needs_newline = False
+        if not self.path.exists():
+            return
+
+        with self.path.open("rb") as f:
+            offset = 0
+            for raw in f:
+                line_offset = offset
+                offset += len(raw)
+                self._needs_newline = not raw.endswith(b"\n")
+                s = raw.strip()
+                if not s:
+                    continue
+                try:
+                    obj = json.loads(s)
+                except Exception:
+                    continue
+                key = obj.get(self.index_key) if isinstance(obj, dict) else None
+                if key is None:
+                    continue
+                if key in self.offsets:
+                    self.stale_lines += 1
+                self.offsets[key] = line_offset
+
+    def keys(self) -> set:
+        return set(self.offsets)
+
+    def __contains__(self, key) -> bool:
+        return key in self.offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def upsert(self, record: dict):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        key = record.get(self.index_key)
+
+        with self._lock:
+            if self._fh is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fh = self.path.open("ab")
+                if self._needs_newline:
+                    # previous run died mid-line; don't glue a record onto it
+                    self._fh.write(b"\n")
+                    self._needs_newline = False
+
+            offset = self._fh.tell()
+            self._fh.write(line)
+            self._fh.flush()
+
+            if key is not None:
+                if key in self.offsets:
+                    self.stale_lines += 1
+                self.offsets[key] = offset
+
+    def iter_latest_lines(self):
+        """Yield raw lines that are the winning write for their key (plus unkeyed lines)."""
+        if not self.path.exists():
+            return
+
+        with self.path.open("rb") as f:
+            offset = 0
+            for raw in f:
+                line_offset = offset
+                offset += len(raw)
+                s = raw.strip()
+                if not s:
+                    continue
+                try:
+                    obj = json.loads(s)
+                except Exception:
+                    yield raw
+                    continue
+                key = obj.get(self.index_key) if isinstance(obj, dict) else None
+                if key is None or self.offsets.get(key) == line_offset:
+                    yield raw
+
+    def compact(self) -> int:
+        """
+        Rewrite the file keeping only the latest line per key.
+        Returns the number of stale lines dropped.
+        """
+        with self._lock:
+            self.close()
+            if self.stale_lines == 0:
+                return 0
+
+            dropped = self.stale_lines
+            tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+            with tmp_path.open("wb") as dst:
+                for raw in self.iter_latest_lines():
+                    dst.write(raw if raw.endswith(b"\n") else raw + b"\n")
+            os.replace(tmp_path, self.path)
+            self._scan()
+            return dropped
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+_JSONL_WRITERS = {}
+_JSONL_WRITERS_LOCK = threading.Lock()
+
+
+def get_jsonl_writer(path: Path, index_key: str = "index") -> JsonlIndexWriter:
+    """Return the shared (per path + key) append-only writer for this process."""
+    reg_key = (str(Path(path).resolve()), index_key)
+    with _JSONL_WRITERS_LOCK:
+        writer = _JSONL_WRITERS.get(reg_key)
+        if writer is None:
+            writer = JsonlIndexWriter(path, index_key=index_key)
+            _JSONL_WRITERS[reg_key] = writer
+        return writer
+
+
+def compact_jsonl(path: Path, index_key: str = "index") -> int:
+    """Drop superseded lines so the JSONL holds exactly one record per key."""
+    return get_jsonl_writer(path, index_key=index_key).compact()
+
+
+def merge_jsonl_shards(path: Path, shard_paths, index_key: str = "index") -> set[str]:
+    """
+    Upsert every record of the worker shard files into `path` (last write
+    wins per key), then delete the shards. Returns the merged keys.
+    """
+    writer = get_jsonl_writer(path, index_key=index_key)
+    keys = set()
+    for shard in shard_paths:
+        for rec in iter_jsonl_latest(shard, index_key=index_key):
+            writer.upsert(rec)
+            key = safe_str(rec.get(index_key))
+            if key:
+                keys.add(key)
+        Path(shard).unlink()
+    return keys
+
+
+def iter_jsonl_latest(path: Path, index_key: str = "index"):
+    """
+    Yield parsed JSONL records, one per key (last write wins).
+    Safe to use on files that have not been compacted yet.
+    """
+    path = Path(path)
+    if not path.exists():
+        return
 
-    if removed:
-        os.replace(tmp_path, jsonl_path)
-    else:
+    reader = JsonlIndexWriter(path, index_key=index_key)
+    for raw in reader.iter_latest_lines():
         try:
-            tmp_path.unlink(missing_ok=True)
+            yield json.loads(raw)
         except Exception:
-            pass
-
-    return removed
-
-
-def _jsonl_append(jsonl_path: Path, record: dict):
-    jsonl_path.parent.mkdir(parents=True, exist_ok=True)
-    with jsonl_path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            continue
 
 
 def jsonl_upsert_by_index(path: Path, record: dict, index_key: str = "index"):
     """
     Upsert a record into JSONL:
-      - if index doesn't exist -> append
-      - if index exists -> rewrite file excluding that index, then append record
+      - append only; the latest line for an index wins
+      - superseded lines are dropped by compact_jsonl() at the end of the run
     """
-    idx = record.get(index_key)
-    if idx is None:
-        _jsonl_append(path, record)
-        return
-
-    # Remove existing occurrences (only does real rewrite if found)
-    _jsonl_remove_index(path, idx, index_key=index_key)
-    _jsonl_append(path, record)
+    get_jsonl_writer(path, index_key=index_key).upsert(record)
 
 def jsonl_upsert_by_project_code(path: Path, record: dict, index_key: str = "project_code"):
     """
     Upsert a record into JSONL:
-      - if project_code doesn't exist -> append
-      - if project_code exists -> rewrite file excluding that project_code, then append record
+      - append only; the latest line for a project_code wins
+      - superseded lines are dropped by compact_jsonl() at the end of the run
     """
-    idx = record.get(index_key)
-    if idx is None:
-        _jsonl_append(path, record)
-        return
+    get_jsonl_writer(path, index_key=index_key).upsert(record)
+
 
-    # Remove existing occurrences (only does real rewrite if found)
-    _jsonl_remove_index(path, idx, index_key=index_key)
-    _jsonl_append(path, record)
+def _iter_jsonl_records(jsonl_path: Path):
+    """Yield every parseable record of a JSONL file (no dedupe)."""
+    if not jsonl_path.exists():
+        return
+    with jsonl_path.open("r", encoding="utf-8") as f:
+        for line in f:
+            s = line.strip()
+            if not s:
+                continue
+            try:
+                yield json.loads(s)
+            except Exception:
+                continue
 
 
-def jsonl_to_json_snapshot(jsonl_path: Path, json_path: Path):
+def jsonl_to_json_snapshot(jsonl_path: Path, json_path: Path, index_key: str | None = None) -> int:
     """
     Build a VALID JSON array file from JSONL. This overwrites json_path.
-    JSON cannot be safely appended as an array without loading.
+    If index_key is given, only the latest record per key is included.
+
+    Documents are streamed one at a time into a temp file (same layout as
+    json.dump(..., indent=2)) which then replaces json_path, so memory stays
+    flat and readers never see a half-written file. Returns the number of
+    documents written.
     """
-    docs = []
-    if jsonl_path.exists():
-        with jsonl_path.open("r", encoding="utf-8") as f:
-            for line in f:
-                s = line.strip()
-                if not s:
-                    continue
-                try:
-                    docs.append(json.loads(s))
-                except Exception:
-                    continue
+    jsonl_path = Path(jsonl_path)
+    json_path = Path(json_path)
+
+    if index_key is not None:
+        docs = iter_jsonl_latest(jsonl_path, index_key=index_key)
+    else:
+        docs = _iter_jsonl_records(jsonl_path)
 
     json_path.parent.mkdir(parents=True, exist_ok=True)
-    with json_path.open("w", encoding="utf-8") as f:
-        json.dump(docs, f, ensure_ascii=False, indent=2)
+    tmp_path = json_path.with_name(json_path.name + ".tmp")
+
+    n = 0
+    with tmp_path.open("w", encoding="utf-8") as f:
+        for doc in docs:
+            body = json.dumps(doc, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            f.write(("[\n  " if n == 0 else ",\n  ") + body)
+            n += 1
+        f.write("\n]" if n else "[]")
+
+    os.replace(tmp_path, json_path)
+    return n
 
 
 # -----------------------
@@ -288,7 +446,7 @@ def annotated_to_dict(res):
 def save_results_with_master_project_amount(results_with_amount, jsonl_path: Path, json_path: Path):
     """
     Incremental-safe writing:
-      - JSONL: upsert by index (rewrite only if same index appears again)
+      - JSONL: upsert by index (append-only, latest line per index wins)
       - JSON: valid snapshot rebuilt from JSONL (overwrites json_path)
 
     NOTE: JSON cannot be safely appended as an array; rebuilding is the simplest reliable option.
@@ -323,7 +481,113 @@ def save_results_with_master_project_amount(results_with_amount, jsonl_path: Pat
         jsonl_upsert_by_index(jsonl_path, out, index_key="index")
 
     # rebuild JSON snapshot after the batch
-    jsonl_to_json_snapshot(jsonl_path, json_path)
+    jsonl_to_json_snapshot(jsonl_path, json_path, index_key="index")
+
+
+# -----------------------
+# source read helpers
+# -----------------------
+def stage_key_table(conn, table: str, keys, column: str = "key"):
+    """
+    (Re)create a session temp table (#name) holding `keys` as NVARCHAR(255),
+    same pattern as the #idx / #pk_ids tables in 1b / 1d. Must run on the
+    connection that later reads against it.
+    """
+    require_mssql(conn, "stage_key_table")
+    conn.execute(sql_text(f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table};"))
+    conn.execute(sql_text(f"CREATE TABLE {table} ([{column}] NVARCHAR(255) NOT NULL);"))
+
+    values = sorted({safe_str(k).strip() for k in keys if safe_str(k).strip()})
+    if values:
+        bulk_write(pd.DataFrame({column: values}), table, conn, if_exists="append")
+
+    conn.execute(sql_text(f"CREATE CLUSTERED INDEX ix_{table.lstrip('#')} ON {table} ([{column}]);"))
+
+
+def _apply_key_filters(query: str, key_filters: list[dict]) -> str:
+    """Wrap `query` so rows are kept/dropped by EXISTS against the staged key tables."""
+    conditions = []
+    for i, flt in enumerate(key_filters):
+        op = "EXISTS" if flt["mode"] == "include" else "NOT EXISTS"
+        conditions.append(
+            f"""{op} (
+                SELECT 1 FROM #keys_{i} AS K{i}
+                WHERE K{i}.[key] COLLATE DATABASE_DEFAULT
+                    = CAST(src.[{flt['column']}] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
+            )"""
+        )
+
+    return (
+        "SELECT src.*\n"
+        f"FROM (\n{query}\n) AS src\n"
+        "WHERE " + "\n  AND ".join(conditions)
+    )
+
+
+def iter_sql_records(engine, query: str, chunksize: int = 2000, params=None, key_filters: list[dict] | None = None):
+    """
+    Stream a query's rows as dicts, `chunksize` rows at a time.
+
+    Uses a server-side cursor (stream_results) so only one chunk is held in
+    memory; the connection stays open until the generator is exhausted or
+    closed.
+
+    key_filters pushes key-set filtering down to SQL Server, e.g.
+        [{"column": "index", "keys": processed_indexes, "mode": "exclude"},
+         {"column": "index", "keys": upstream_indexes, "mode": "include"}]
+    Each key set is staged into a temp table on the same connection and the
+    query is wrapped in an EXISTS / NOT EXISTS anti-join, so only rows that
+    still need work leave the server. An "exclude" filter with no keys is
+    dropped; an "include" filter with no keys yields nothing.
+    """
+    key_filters = [
+        flt for flt in (key_filters or [])
+        if flt["mode"] == "include" or flt["keys"]
+    ]
+
+    with engine.connect().execution_options(stream_results=True) as conn:
+        if key_filters:
+            for i, flt in enumerate(key_filters):
+                if flt["mode"] not in ("include", "exclude"):
+                    raise ValueError(f"Unsupported key filter mode: {flt['mode']}")
+                stage_key_table(conn, f"#keys_{i}", flt["keys"])
+            query = _apply_key_filters(query, key_filters)
+
+        for chunk in pd.read_sql(query, conn, params=params, chunksize=chunksize):
+            yield from chunk.to_dict("records")
+
+
+# -----------------------
+# concurrency helpers
+# -----------------------
+def bounded_ordered_map(fn, items, max_in_flight: int = 1):
+    """
+    Apply fn to each item with at most max_in_flight calls outstanding.
+    Yields (item, result) pairs in input order, so callers can write outputs
+    deterministically while slower calls are still running.
+
+    max_in_flight <= 1 runs inline (no threads).
+    """
+    if max_in_flight <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= max_in_flight:
+                head_item, head_future = pending.popleft()
+                yield head_item, head_future.result()
+
+        while pending:
+            head_item, head_future = pending.popleft()
+            yield head_item, head_future.result()
+    finally:
+        # on error / early exit: drop queued work, let running calls finish
+        pool.shutdown(wait=True, cancel_futures=True)
 
 
 # -----------------------
@@ -0,0 +1,167 @@
+import json
+import math
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import EXTRACTION_PLAN_CONFIG
+from utils.extraction_cache import fingerprint, _to_plain
+from utils.extraction_helpers import text_hash
+from utils.process_pool import process_pool
+
+
+# -----------------------
+# bulk hashing
+# -----------------------
+def _hash_chunk(texts: list[str]) -> list[str]:
+    return [text_hash(t) for t in texts]
+
+
+def hash_texts_parallel(texts: list[str], workers: int | None = None, chunk_size: int = 2000) -> list[str]:
+    """
+    text_hash for every text, in order, spread over spawned worker
+    processes (utils/process_pool.py).
+    """
+    if not texts:
+        return []
+
+    workers = workers or os.cpu_count() or 1
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    if workers <= 1 or len(chunks) == 1:
+        return _hash_chunk(texts)
+
+    out = []
+    with process_pool(min(workers, len(chunks))) as pool:
+        for hashes in pool.map(_hash_chunk, chunks):
+            out.extend(hashes)
+    return out
+
+
+# -----------------------
+# estimates
+# -----------------------
+def estimate_tokens(text: str, chars_per_token: int = EXTRACTION_PLAN_CONFIG["chars_per_token"]) -> int:
+    return math.ceil(len(text or "") / chars_per_token)
+
+
+def _examples_text(examples) -> str:
+    # rough stand-in for the few-shot block langextract renders into the prompt
+    return json.dumps(_to_plain(examples), ensure_ascii=False, default=str)
+
+
+def prompt_overhead_tokens(prompt: str, examples, chars_per_token: int = EXTRACTION_PLAN_CONFIG["chars_per_token"]) -> int:
+    """Estimated tokens every call spends on the prompt description + few-shot examples."""
+    return estimate_tokens(prompt, chars_per_token) + estimate_tokens(_examples_text(examples), chars_per_token)
+
+
+def plan_extraction(
+    rows,
+    *,
+    prompt: str,
+    examples,
+    caches: list,
+    processed_keys=None,
+    force_refresh: bool = False,
+    max_in_flight: int = 1,
+    label: str = "",
+    cfg: dict | None = None,
+) -> dict:
+    """
+    Dry run of an extraction stage. Never calls a model.
+
+    rows:           iterable of (key, text) for every source row with text
+    caches:         mappings checked for `text_hash in cache` (run cache, global cache, ...)
+    processed_keys: keys already in the run JSONL (skipped unless force_refresh)
+
+    Returns a dict with row / cache / call counts, token and cost estimates
+    and projected wall time per concurrency level.
+    """
+    cfg = {**EXTRACTION_PLAN_CONFIG, **(cfg or {})}
+    processed_keys = processed_keys or set()
+
+    total_rows = 0
+    rows_skipped = 0
+    pending_texts = []
+    for key, text in rows:
+        total_rows += 1
+        if (not force_refresh) and (key in processed_keys):
+            rows_skipped += 1
+            continue
+        pending_texts.append(text)
+
+    hashes = hash_texts_parallel(pending_texts, workers=cfg["hash_workers"])
+
+    # first text per hash; fan-out rows share the call
+    unique = {}
+    for h, t in zip(hashes, pending_texts):
+        unique.setdefault(h, t)
+
+    cache_hits = 0
+    fresh = []
+    for h, t in unique.items():
+        if (not force_refresh) and any(h in c for c in caches):
+            cache_hits += 1
+        else:
+            fresh.append(t)
+
+    base_prompt_tokens = prompt_overhead_tokens(prompt, examples, cfg["chars_per_token"])
+
+    model_calls = 0
+    prompt_tokens = 0
+    for t in fresh:
+        n_chunks = max(1, math.ceil(len(t) / cfg["max_char_buffer"]))
+        model_calls += n_chunks
+        prompt_tokens += n_chunks * base_prompt_tokens + estimate_tokens(t, cfg["chars_per_token"])
+
+    completion_tokens = model_calls * cfg["completion_tokens_per_call"]
+    cost = (
+        prompt_tokens / 1_000_000 * cfg["price_per_1m_input_tokens"]
+        + completion_tokens / 1_000_000 * cfg["price_per_1m_output_tokens"]
+    )
+
+    levels = sorted(set(cfg["concurrency_levels"]) | {max(1, max_in_flight)})
+    wall_time_s = {c: model_calls * cfg["avg_latency_s"] / c for c in levels}
+
+    return {
+        "label": label,
+        "prompt_fingerprint": fingerprint(prompt)[:12],
+        "total_rows": total_rows,
+        "rows_skipped": rows_skipped,
+        "rows_pending": len(pending_texts),
+        "unique_texts": len(unique),
+        "cache_hits": cache_hits,
+        "unique_fresh_texts": len(fresh),
+        "model_calls": model_calls,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "estimated_cost_usd": round(cost, 4),
+        "max_in_flight": max_in_flight,
+        "wall_time_s": wall_time_s,
+    }
+
+
+def _fmt_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}h{m:02d}m{s:02d}s" if h else f"{m}m{s:02d}s"
+
+
+def print_plan(plan: dict):
+    print(f"[plan] ===== {plan['label']} (prompt {plan['prompt_fingerprint']}) =====")
+    print(f"[plan] source rows with text:   {plan['total_rows']}")
+    print(f"[plan] rows to skip (in JSONL): {plan['rows_skipped']}")
+    print(f"[plan] rows pending:            {plan['rows_pending']} ({plan['unique_texts']} unique texts)")
+    print(f"[plan] cache hits:              {plan['cache_hits']}")
+    print(f"[plan] unique fresh texts:      {plan['unique_fresh_texts']} -> {plan['model_calls']} model calls")
+    print(
+        f"[plan] est. tokens:             prompt={plan['prompt_tokens']:,} "
+        f"| completion={plan['completion_tokens']:,}"
+    )
+    print(f"[plan] est. cost (USD):         {plan['estimated_cost_usd']}")
+    for c, secs in plan["wall_time_s"].items():
+        marker = "  <- --max-in-flight" if c == plan["max_in_flight"] else ""
+        print(f"[plan] wall time @ {c:>3} in flight: {_fmt_duration(secs)}{marker}")
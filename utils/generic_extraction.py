@@ -0,0 +1,173 @@
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.generic_extraction_config import GENERIC_CONFIG
+from utils.extraction_helpers import safe_str, build_labeled_bilingual_input
+from utils.pipeline_runner import read_ids_txt
+
+try:
+    from utils.post_processing_helpers import normalize_class
+except Exception:
+    def normalize_class(x):
+        return str(x).strip() if x is not None else ""
+
+
+# =========================================================
+# SOURCE
+# =========================================================
+# built-in source query used by 1_main.py (--use-main-source-query / combined mode)
+MAIN_SOURCE_QUERY = """
+    SELECT
+        cp.[index]
+        , cp.project_code
+        , cp.project_title_en
+        , cp.project_title_ar
+        , cp.project_description_en
+        , cp.project_description_ar
+    FROM silver.cleaned_project cp
+    """
+
+
+def load_ids_txt(path: Path) -> set[str]:
+    # in-process pipeline runs hand the upstream ids over in memory
+    return read_ids_txt(path)
+
+
+def load_processed_ids_from_jsonl(path: Path, id_key: str) -> set[str]:
+    if not path.exists():
+        return set()
+
+    ids = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"[WARN] Skipping invalid JSONL line {line_no}")
+                continue
+
+            val = safe_str(rec.get(id_key))
+            if val:
+                ids.add(val)
+
+    return ids
+
+
+def build_text_from_row(row: dict, text_builder_cfg: dict) -> str:
+    builder_type = text_builder_cfg.get("type", "bilingual_basic")
+
+    if builder_type == "bilingual_basic":
+        title_en = safe_str(row.get("project_title_en", "") or "")
+        desc_en = safe_str(row.get("project_description_en", "") or "")
+        title_ar = safe_str(row.get("project_title_ar", "") or "")
+        desc_ar = safe_str(row.get("project_description_ar", "") or "")
+
+        return build_labeled_bilingual_input(
+            title_en=title_en,
+            desc_en=desc_en,
+            title_ar=title_ar,
+            desc_ar=desc_ar,
+        )
+
+    raise ValueError(f"Unsupported text_builder type: {builder_type}")
+
+
+# =========================================================
+# POST-EXTRACT RULES
+# =========================================================
+def normalize_null_extraction_text(x):
+    if x is None:
+        return "NULL"
+    s = str(x).strip()
+    return s if s else "NULL"
+
+
+def apply_post_extract_rules(extraction_dict: dict, cfg: dict) -> dict:
+    rules = cfg.get("post_extract_rules", {})
+    exs = extraction_dict.get("extractions", []) or []
+
+    if rules.get("normalize_null_extraction_text"):
+        for e in exs:
+            e["extraction_text"] = normalize_null_extraction_text(e.get("extraction_text"))
+
+    if rules.get("asset_null_forces_category_null"):
+        asset_val = None
+        for e in exs:
+            if normalize_class(e.get("extraction_class")).lower() == "asset":
+                asset_val = str(e.get("extraction_text")).strip()
+                break
+
+        if asset_val == "NULL":
+            for e in exs:
+                if normalize_class(e.get("extraction_class")).lower() == "asset_category":
+                    e["extraction_text"] = "NULL"
+
+    extraction_dict["extractions"] = exs
+    return extraction_dict
+
+
+# =========================================================
+# COMBINED (MULTI-ENTITY) MODE
+# =========================================================
+COMBINED_PROMPT_HEADER = """
+The input is ONE project. Complete EVERY task below on that same input.
+Each task has its own fields, rules and output format; apply a task's rules
+only to that task's fields and never let one task's answer change another's.
+""".strip()
+
+COMBINED_PROMPT_FOOTER = """
+OUTPUT FORMAT (ALL TASKS):
+Return the extractions of every task above, task by task in the order listed,
+each task following its own OUTPUT FORMAT.
+""".strip()
+
+
+def build_combined_prompt(entities: list[str]) -> str:
+    """One prompt asking for all `entities`; a single entity gets its own prompt unchanged."""
+    if len(entities) == 1:
+        return GENERIC_CONFIG[entities[0]]["extraction"]["prompt"]
+
+    sections = [
+        f"### TASK {n}: {entity}\n{GENERIC_CONFIG[entity]['extraction']['prompt']}"
+        for n, entity in enumerate(entities, start=1)
+    ]
+    return "\n\n".join([COMBINED_PROMPT_HEADER, *sections, COMBINED_PROMPT_FOOTER])
+
+
+def build_combined_examples(entities: list[str]) -> list:
+    """Few-shot examples of every entity, in entity order."""
+    examples = []
+    for entity in entities:
+        examples.extend(GENERIC_CONFIG[entity]["extraction"]["examples"])
+    return examples
+
+
+def entity_class_map(entities: list[str]) -> dict[str, str]:
+    """extraction_class (lowercased) -> entity, from each entity's post_processing class_map."""
+    out = {}
+    for entity in entities:
+        for cls in GENERIC_CONFIG[entity]["post_processing"]["class_map"]:
+            key = normalize_class(cls).lower()
+            if key in out and out[key] != entity:
+                raise ValueError(
+                    f"extraction_class '{cls}' is mapped by both '{out[key]}' and '{entity}'; "
+                    "these entities can't be combined"
+                )
+            out[key] = entity
+    return out
+
+
+def split_extractions_by_entity(extractions: list[dict], class_to_entity: dict[str, str]) -> dict[str, list[dict]]:
+    """Route a combined result's extractions to their entities; unknown classes are dropped."""
+    out = {entity: [] for entity in set(class_to_entity.values())}
+    for e in extractions or []:
+        entity = class_to_entity.get(normalize_class(e.get("extraction_class")).lower())
+        if entity is not None:
+            out[entity].append(e)
+    return out
@@ -0,0 +1,56 @@
+"""
+Maintenance commands for the extraction JSONL outputs.
+
+    python utils/jsonl_tools.py snapshot --jsonl <run>.jsonl --json <run>.json --index-key index
+    python utils/jsonl_tools.py compact  --jsonl <run>.jsonl --index-key project_code
+
+`snapshot` rebuilds the debug JSON array on demand (the extraction scripts
+only write it at the end of a run); `compact` drops superseded lines.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.extraction_helpers import compact_jsonl, jsonl_to_json_snapshot
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="JSONL output maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    snap = sub.add_parser("snapshot", help="Stream the JSONL into a debug JSON array")
+    snap.add_argument("--jsonl", required=True, type=Path)
+    snap.add_argument("--json", type=Path, default=None, help="Defaults to the JSONL path with a .json suffix")
+    snap.add_argument(
+        "--index-key",
+        default="index",
+        help="Keep only the latest record per key (pass '' to keep every line)",
+    )
+
+    comp = sub.add_parser("compact", help="Rewrite the JSONL keeping only the latest line per key")
+    comp.add_argument("--jsonl", required=True, type=Path)
+    comp.add_argument("--index-key", default="index")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if not args.jsonl.exists():
+        raise FileNotFoundError(f"JSONL not found: {args.jsonl}")
+
+    if args.command == "snapshot":
+        json_path = args.json or args.jsonl.with_suffix(".json")
+        n = jsonl_to_json_snapshot(args.jsonl, json_path, index_key=args.index_key or None)
+        print(f"[DONE] Wrote {n} documents to {json_path}")
+
+    elif args.command == "compact":
+        dropped = compact_jsonl(args.jsonl, index_key=args.index_key)
+        print(f"[DONE] Compacted {args.jsonl}: dropped {dropped} superseded lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+"""
+Parsing of 1a extraction documents into silver.MasterTable_extracted rows.
+
+parse_master_doc turns one JSONL document (its ordered extractions) into
+one row per item, or one row per project without items, under a master
+project code allocated by the caller. It only depends on the document,
+so 1b can run it per micro-batch (--stream) or over the whole run.
+build_master_frame applies the per-master-project amount split and the
+final column order and dtypes.
+
+1b allocates the master codes of a whole batch up front
+(utils/code_allocator.py); after that documents are independent and
+parse_master_docs_parallel spreads them over worker processes in chunks.
+"""
+import os
+import re
+import sys
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy.types import NVARCHAR, DateTime, UnicodeText
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.process_pool import process_pool
+from utils.post_processing_helpers import (
+    smart_title_case,
+    normalize_class,
+    to_int_or_none,
+    to_float_or_none,
+    is_missing_or_bad,
+    fmt_mp,
+    fmt_prj,
+    _is_blank,
+)
+
+
+FINAL_COLUMNS = [
+    "document_id",
+    "ts_inserted",
+    "index",
+    "master_project_code",
+    "master_project_title_en",
+    "master_project_title_ar",
+    "master_project_description_en",
+    "master_project_description_ar",
+    "project_code",
+    "project_title_en",
+    "project_title_ar",
+    "project_description_en",
+    "project_description_ar",
+    "beneficiary_count",
+    "beneficiary_group_name",
+    "asset",
+    "asset_category",
+    "asset_quantity",
+    "asset_quantity_uom",
+    "asset_capacity",
+    "asset_capacity_uom",
+    "item",
+    "item_category",
+    "item_quantity",
+    "item_quantity_uom",
+    "input_text",
+    "master_project_amount_actual",
+    "master_project_oda_amount",
+    "master_project_ge_amount",
+    "master_project_off_amount",
+    "project_amount_actual",
+    "project_amount_extracted",
+    "project_oda_amount",
+    "project_ge_amount",
+    "project_off_amount",
+]
+
+# pandas dtypes of the final frame; every chunk comes out with the same ones,
+# so concatenating worker results never falls back to object columns
+MASTER_PANDAS_DTYPES = {
+    **{c: "string" for c in FINAL_COLUMNS},
+    "ts_inserted": "datetime64[ns, UTC]",
+    "beneficiary_count": "Int64",
+    "asset_quantity": "Int64",
+    "item_quantity": "Int64",
+    "asset_capacity": "float64",
+    "master_project_amount_actual": "float64",
+    "master_project_oda_amount": "float64",
+    "master_project_ge_amount": "float64",
+    "master_project_off_amount": "float64",
+    "project_amount_actual": "float64",
+    "project_amount_extracted": "float64",
+    "project_oda_amount": "float64",
+    "project_ge_amount": "float64",
+    "project_off_amount": "float64",
+}
+
+# to_sql dtypes for the text/time columns of MasterTable_extracted
+MASTER_SQL_DTYPE = {
+    "master_project_title_en": UnicodeText(),
+    "master_project_description_en": UnicodeText(),
+    "project_title_en": UnicodeText(),
+    "project_description_en": UnicodeText(),
+    "master_project_title_ar": UnicodeText(),
+    "master_project_description_ar": UnicodeText(),
+    "project_title_ar": UnicodeText(),
+    "project_description_ar": UnicodeText(),
+    "ts_inserted": DateTime(),
+    "document_id": NVARCHAR(length=128),
+}
+
+
+def parse_master_doc(doc: dict, master_project_code: str, ts_inserted) -> list[dict]:
+    """Rows of one extraction document, in extraction order."""
+    rows = []
+
+    text = doc.get("text")
+    index = doc.get("index")
+
+    document_id = doc.get("document_id") or doc.get("_document_id") or doc.get("doc_id")
+
+    master_project_amount_actual = to_float_or_none(doc.get("master_project_amount_actual"))
+    master_project_oda_amount = to_float_or_none(doc.get("master_project_oda_amount"))
+    master_project_ge_amount = to_float_or_none(doc.get("master_project_ge_amount"))
+    master_project_off_amount = to_float_or_none(doc.get("master_project_off_amount"))
+
+    raw_extractions = doc.get("extractions", [])
+
+    exs = []
+    for e in raw_extractions:
+        cls = normalize_class(e.get("extraction_class"))
+        val = e.get("extraction_text")
+        if val is None or str(val).strip() == "":
+            continue
+        exs.append(
+            {
+                "cls": cls,
+                "val": val,
+                "idx": e.get("extraction_index", 10**9),
+            }
+        )
+
+    exs.sort(key=lambda x: x["idx"])
+
+    master_project_title_en = None
+    master_project_title_ar = None
+    master_project_description_en = None
+    master_project_description_ar = None
+
+    for x in exs:
+        if x["cls"] == "master_project_title_en" and master_project_title_en is None:
+            master_project_title_en = smart_title_case(x["val"])
+        elif x["cls"] == "master_project_title_ar" and master_project_title_ar is None:
+            master_project_title_ar = str(x["val"]).strip()
+        elif x["cls"] == "master_project_description_en" and master_project_description_en is None:
+            master_project_description_en = str(x["val"]).strip()
+        elif x["cls"] == "master_project_description_ar" and master_project_description_ar is None:
+            master_project_description_ar = str(x["val"]).strip()
+
+    current_project_code = None
+    current_project_title_en = None
+    current_project_title_ar = None
+    current_project_description_en = None
+    current_project_description_ar = None
+
+    current_item = None
+    pending_item_qty = None
+    pending_item_category = None
+    pending_item_uom = None
+
+    project_amount_extracted_map = {}
+    project_description_en_map = {}
+    project_description_ar_map = {}
+    project_title_ar_map = {}
+
+    seen_projects_in_doc = []
+    projects_with_items = set()
+    row_indices_by_project = {}
+    index_to_next_prj = 0
+
+    def append_row(r: dict):
+        rows.append(r)
+        prj = r.get("project_code")
+        if prj:
+            row_indices_by_project.setdefault(prj, []).append(len(rows) - 1)
+
+    def backfill_project_amount_extracted(prj_code: str, amt: float):
+        for ridx in row_indices_by_project.get(prj_code, []):
+            if rows[ridx].get("project_amount_extracted") is None or pd.isna(
+                rows[ridx].get("project_amount_extracted")
+            ):
+                rows[ridx]["project_amount_extracted"] = amt
+
+    for x in exs:
+        cls, val = x["cls"], x["val"]
+
+        if cls == "project_title_en":
+            if current_item is not None:
+                append_row(current_item)
+                projects_with_items.add(current_item["project_code"])
+                current_item = None
+
+            current_project_title_en = smart_title_case(val)
+            index_to_next_prj += 1
+            current_project_code = fmt_prj(master_project_code, index_to_next_prj)
+
+            seen_projects_in_doc.append((current_project_code, current_project_title_en))
+            project_amount_extracted_map.setdefault(current_project_code, None)
+
+            current_project_description_en = None
+            current_project_description_ar = None
+            current_project_title_ar = None
+
+            project_description_en_map.setdefault(current_project_code, None)
+            project_description_ar_map.setdefault(current_project_code, None)
+            project_title_ar_map.setdefault(current_project_code, None)
+
+            pending_item_qty = None
+            pending_item_category = None
+            pending_item_uom = None
+            continue
+
+        if cls == "project_title_ar":
+            if current_project_code is None:
+                continue
+            ar_title = str(val).strip()
+            if _is_blank(project_title_ar_map.get(current_project_code)):
+                project_title_ar_map[current_project_code] = ar_title
+            current_project_title_ar = project_title_ar_map[current_project_code]
+            if current_item is not None and current_item.get("project_code") == current_project_code:
+                current_item["project_title_ar"] = current_project_title_ar
+            continue
+
+        if cls == "project_description_en":
+            if current_project_code is None:
+                continue
+            desc = re.sub(r"\s+", " ", str(val).strip())
+            if _is_blank(project_description_en_map.get(current_project_code)):
+                project_description_en_map[current_project_code] = desc
+            current_project_description_en = project_description_en_map[current_project_code]
+            if current_item is not None and current_item.get("project_code") == current_project_code:
+                current_item["project_description_en"] = current_project_description_en
+            continue
+
+        if cls == "project_description_ar":
+            if current_project_code is None:
+                continue
+            desc_ar = re.sub(r"\s+", " ", str(val).strip())
+            if _is_blank(project_description_ar_map.get(current_project_code)):
+                project_description_ar_map[current_project_code] = desc_ar
+            current_project_description_ar = project_description_ar_map[current_project_code]
+            if current_item is not None and current_item.get("project_code") == current_project_code:
+                current_item["project_description_ar"] = current_project_description_ar
+            continue
+
+        if cls == "project_amount_extracted":
+            a = to_float_or_none(val)
+            if current_project_code is not None and a is not None:
+                if project_amount_extracted_map.get(current_project_code) is None:
+                    project_amount_extracted_map[current_project_code] = a
+                backfill_project_amount_extracted(current_project_code, a)
+                if (
+                    current_item is not None
+                    and current_item.get("project_code") == current_project_code
+                    and is_missing_or_bad(current_item.get("project_amount_extracted"))
+                ):
+                    current_item["project_amount_extracted"] = a
+            continue
+
+        if cls in ("item", "items"):
+            if current_item is not None:
+                append_row(current_item)
+                projects_with_items.add(current_item["project_code"])
+                current_item = None
+
+            amt_extr = project_amount_extracted_map.get(current_project_code)
+
+            current_item = {
+                "document_id": document_id,
+                "ts_inserted": ts_inserted,
+                "index": index,
+                "master_project_code": master_project_code,
+                "master_project_title_en": master_project_title_en,
+                "master_project_title_ar": master_project_title_ar,
+                "master_project_description_en": master_project_description_en,
+                "master_project_description_ar": master_project_description_ar,
+                "master_project_amount_actual": master_project_amount_actual,
+                "master_project_oda_amount": master_project_oda_amount,
+                "master_project_ge_amount": master_project_ge_amount,
+                "master_project_off_amount": master_project_off_amount,
+                "project_code": current_project_code,
+                "project_title_en": current_project_title_en,
+                "project_title_ar": current_project_title_ar,
+                "project_description_en": current_project_description_en,
+                "project_description_ar": current_project_description_ar,
+                "beneficiary_count": None,
+                "beneficiary_group_name": None,
+                "asset": None,
+                "asset_category": None,
+                "asset_quantity": None,
+                "asset_quantity_uom": None,
+                "asset_capacity": None,
+                "asset_capacity_uom": None,
+                "item": smart_title_case(val),
+                "item_category": None,
+                "item_quantity": None,
+                "item_quantity_uom": None,
+                "project_amount_extracted": amt_extr,
+                "input_text": text,
+            }
+
+            if pending_item_qty is not None:
+                current_item["item_quantity"] = pending_item_qty
+                pending_item_qty = None
+            if pending_item_category is not None:
+                current_item["item_category"] = pending_item_category
+                pending_item_category = None
+            if pending_item_uom is not None:
+                current_item["item_quantity_uom"] = pending_item_uom
+                pending_item_uom = None
+            continue
+
+        if cls == "item_quantity":
+            qty = to_int_or_none(val)
+            if current_item is not None:
+                current_item["item_quantity"] = qty
+            else:
+                pending_item_qty = qty
+            continue
+
+        if cls == "item_category":
+            category = smart_title_case(val)
+            if current_item is not None:
+                current_item["item_category"] = category
+            else:
+                pending_item_category = category
+            continue
+
+        if cls == "item_quantity_uom":
+            uom = str(val).strip()
+            if current_item is not None:
+                current_item["item_quantity_uom"] = uom
+            else:
+                pending_item_uom = uom
+            continue
+
+    if current_item is not None:
+        append_row(current_item)
+        projects_with_items.add(current_item["project_code"])
+        current_item = None
+
+    for prj_code, amt in project_amount_extracted_map.items():
+        if amt is not None:
+            backfill_project_amount_extracted(prj_code, amt)
+
+    if not seen_projects_in_doc:
+        index_to_next_prj += 1
+        current_project_code = fmt_prj(master_project_code, index_to_next_prj)
+        seen_projects_in_doc.append((current_project_code, None))
+        project_amount_extracted_map[current_project_code] = None
+        project_description_en_map[current_project_code] = None
+        project_description_ar_map[current_project_code] = None
+        project_title_ar_map[current_project_code] = None
+
+    for prj_code, prj_title in seen_projects_in_doc:
+        if prj_code not in projects_with_items:
+            append_row(
+                {
+                    "document_id": document_id,
+                    "ts_inserted": ts_inserted,
+                    "index": index,
+                    "master_project_code": master_project_code,
+                    "master_project_title_en": master_project_title_en,
+                    "master_project_title_ar": master_project_title_ar,
+                    "master_project_description_en": master_project_description_en,
+                    "master_project_description_ar": master_project_description_ar,
+                    "master_project_amount_actual": master_project_amount_actual,
+                    "master_project_oda_amount": master_project_oda_amount,
+                    "master_project_ge_amount": master_project_ge_amount,
+                    "master_project_off_amount": master_project_off_amount,
+                    "project_code": prj_code,
+                    "project_title_en": prj_title,
+                    "project_title_ar": project_title_ar_map.get(prj_code),
+                    "project_description_en": project_description_en_map.get(prj_code),
+                    "project_description_ar": project_description_ar_map.get(prj_code),
+                    "beneficiary_count": None,
+                    "beneficiary_group_name": None,
+                    "asset": None,
+                    "asset_category": None,
+                    "asset_quantity": None,
+                    "asset_quantity_uom": None,
+                    "asset_capacity": None,
+                    "asset_capacity_uom": None,
+                    "item": None,
+                    "item_category": None,
+                    "item_quantity": None,
+                    "item_quantity_uom": None,
+                    "project_amount_extracted": project_amount_extracted_map.get(prj_code),
+                    "input_text": text,
+                }
+            )
+
+    return rows
+
+
+def build_master_frame(rows: list[dict]) -> pd.DataFrame:
+    """
+    DataFrame of parsed rows in FINAL_COLUMNS order, with the master amounts
+    split evenly over the projects of each master project. Rows of a master
+    project must all be in `rows` (true per document, so per batch too).
+    """
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return pd.DataFrame(columns=FINAL_COLUMNS).astype(MASTER_PANDAS_DTYPES)
+
+    df["master_project_amount_actual"] = pd.to_numeric(df.get("master_project_amount_actual"), errors="coerce")
+    df["master_project_oda_amount"] = pd.to_numeric(df.get("master_project_oda_amount"), errors="coerce")
+    df["master_project_ge_amount"] = pd.to_numeric(df.get("master_project_ge_amount"), errors="coerce")
+    df["master_project_off_amount"] = pd.to_numeric(df.get("master_project_off_amount"), errors="coerce")
+    df["project_amount_extracted"] = pd.to_numeric(df.get("project_amount_extracted"), errors="coerce")
+
+    project_counts = (
+        df[["master_project_code", "project_code"]]
+        .drop_duplicates()
+        .groupby("master_project_code")["project_code"]
+        .nunique()
+    )
+    df["_project_count"] = df["master_project_code"].map(project_counts).fillna(1).astype(int)
+
+    df["project_amount_actual"] = df["master_project_amount_actual"] / df["_project_count"]
+    df["project_oda_amount"] = df["master_project_oda_amount"] / df["_project_count"]
+    df["project_ge_amount"] = df["master_project_ge_amount"] / df["_project_count"]
+    df["project_off_amount"] = df["master_project_off_amount"] / df["_project_count"]
+
+    df.loc[df["master_project_amount_actual"].apply(is_missing_or_bad), "project_amount_actual"] = pd.NA
+    df.loc[df["master_project_oda_amount"].apply(is_missing_or_bad), "project_oda_amount"] = pd.NA
+    df.loc[df["master_project_ge_amount"].apply(is_missing_or_bad), "project_ge_amount"] = pd.NA
+    df.loc[df["master_project_off_amount"].apply(is_missing_or_bad), "project_off_amount"] = pd.NA
+
+    df.drop(columns=["_project_count"], inplace=True)
+
+    for c in FINAL_COLUMNS:
+        if c not in df.columns:
+            df[c] = None
+    df = df[FINAL_COLUMNS]
+
+    df["index"] = df["index"].astype(str)
+    return df.astype(MASTER_PANDAS_DTYPES)
+
+
+def _parse_chunk(chunk: list[tuple[dict, str]], ts_inserted) -> pd.DataFrame:
+    rows = []
+    for doc, master_project_code in chunk:
+        rows.extend(parse_master_doc(doc, master_project_code, ts_inserted))
+    return build_master_frame(rows)
+
+
+def parse_master_docs_parallel(
+    docs: list[dict],
+    codes: dict,
+    ts_inserted,
+    workers: int | None = None,
+    chunk_size: int = 500,
+) -> pd.DataFrame:
+    """
+    Parse `docs` (codes: str(index) -> master_project_code) into one typed
+    frame, in document order. Chunks go to spawned worker processes
+    (utils/process_pool.py), so this also parallelises on Windows and from
+    a 1_main.py step thread.
+    """
+    pairs = [(doc, codes[str(doc.get("index")).strip()]) for doc in docs]
+    workers = workers or os.cpu_count() or 1
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+
+    if workers <= 1 or len(chunks) <= 1:
+        return _parse_chunk(pairs, ts_inserted)
+
+    with process_pool(min(workers, len(chunks))) as pool:
+        frames = list(pool.map(partial(_parse_chunk, ts_inserted=ts_inserted), chunks))
+    return pd.concat(frames, ignore_index=True)
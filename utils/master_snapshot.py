@@ -0,0 +1,480 @@
+"""
+Local columnar snapshot of the master table, shared by the stages of a run.
+
+MasterSnapshot keeps MASTER_SNAPSHOT_CONFIG["columns"] of the master table
+in a Parquet file named after a cheap change marker of the table: row count
++ CHECKSUM_AGG(BINARY_CHECKSUM(columns)), one scan without per-row hashing,
+or row count + MAX(rowversion_column) when the table has one. Inside an
+in-process pipeline run the marker is read once and the file handed over
+(publish / consume). Every row of the file carries its HASHBYTES row hash
+in _row_hash.
+
+When the marker moves, only (key, row hash) pairs come over the wire; rows
+whose hash differs, and new keys, are fetched through a staged #temp key
+table, deleted keys are dropped, and everything else is copied from the
+previous file. Only the first snapshot (or one after a column change) pulls
+the table whole.
+
+Read-through API for source queries written in T-SQL:
+  - read_source_sql(engine, sql) -> DataFrame
+  - iter_source_records(engine, sql, chunksize, key_filters) -> dicts
+A query that reads the master table runs in-process with DuckDB: the master
+table is a view over the snapshot and every other table it reads is pulled
+from the server first, only the columns the query names. The T-SQL subset
+the source queries use is translated (to_duckdb_sql); LIKE is matched case-
+insensitively as under the server's default collation, "=" is not. Queries
+that do not read the master table, read #temp tables, or fail locally, and
+every query while the snapshot is disabled, go to the server unchanged
+(pd.read_sql / iter_sql_records).
+"""
+import hashlib
+import os
+import re
+import sys
+import threading
+import uuid
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import text as sql_text
+from sqlalchemy.exc import SQLAlchemyError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import MASTER_SNAPSHOT_CONFIG
+from utils.extraction_helpers import iter_sql_records, safe_str, stage_key_table
+from utils.pipeline_runner import publish, consume
+
+
+_LOCK = threading.Lock()
+
+ROW_HASH = "_row_hash"
+
+# every FROM / JOIN target that is a name (schema-qualified or not); subqueries start with "("
+_ANY_REF_RE = re.compile(r'\b(?:FROM|JOIN)\s+("?[#A-Za-z_]\w*"?(?:\s*\.\s*"?[A-Za-z_]\w*"?)?)', re.IGNORECASE)
+# names defined by a WITH clause
+_CTE_RE = re.compile(r'(?:\bWITH|,)\s*"?([A-Za-z_]\w*)"?\s+AS\s*\(', re.IGNORECASE)
+# SELECT * / alias.* (not COUNT(*)); a multiplication also matches, which only pulls more columns
+_STAR_RE = re.compile(r"(?<![(\s])\s*\*")
+
+
+def _arrow_type(sql_type: str):
+    import pyarrow as pa
+
+    t = sql_type.lower()
+    if t in {"bigint", "int", "smallint", "tinyint"}:
+        return pa.int64()
+    if t in {"decimal", "numeric", "float", "real", "money", "smallmoney"}:
+        return pa.float64()
+    if t in {"date", "datetime", "datetime2", "smalldatetime", "datetimeoffset"}:
+        return pa.timestamp("us")
+    if t == "bit":
+        return pa.bool_()
+    return pa.string()
+
+
+def _hash_text(col: str, sql_type: str) -> str:
+    """Lossless text of a column for HASHBYTES (default CONVERT styles round floats, money and times)."""
+    t = sql_type.lower()
+    if t in {"float", "real"}:
+        return f"CONVERT(NVARCHAR(64), [{col}], 3)"
+    if t in {"money", "smallmoney"}:
+        return f"CONVERT(NVARCHAR(64), [{col}], 2)"
+    if t in {"date", "datetime", "datetime2", "smalldatetime", "datetimeoffset", "time"}:
+        return f"CONVERT(NVARCHAR(64), [{col}], 126)"
+    return f"CAST([{col}] AS NVARCHAR(MAX))"
+
+
+class MasterSnapshot:
+    def __init__(self, engine, table: str | None = None, columns: list[str] | None = None, snapshot_dir=None):
+        self.engine = engine
+        self.table = table or MASTER_SNAPSHOT_CONFIG["table"]
+        self.columns = list(columns or MASTER_SNAPSHOT_CONFIG["columns"])
+        self.key = MASTER_SNAPSHOT_CONFIG["key_column"]
+        self.dir = Path(snapshot_dir or MASTER_SNAPSHOT_CONFIG["dir"])
+        self.schema, self.name = self.table.split(".", 1)
+        self._path = None
+        self._types = None
+
+    # -----------------------
+    # server-side hashes
+    # -----------------------
+    def _column_types(self) -> dict:
+        if self._types is not None:
+            return self._types
+        rows = pd.read_sql(
+            sql_text("""
+                SELECT COLUMN_NAME, DATA_TYPE
+                FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA = :schema AND TABLE_NAME = :name
+            """),
+            self.engine,
+            params={"schema": self.schema, "name": self.name},
+        )
+        types = {c.lower(): t for c, t in zip(rows["COLUMN_NAME"], rows["DATA_TYPE"])}
+        missing = [c for c in self.columns if c.lower() not in types]
+        if missing:
+            raise ValueError(f"{self.table} has no column(s) {missing}")
+        self._types = {c: types[c.lower()] for c in self.columns}
+        return self._types
+
+    def _row_hash_sql(self) -> str:
+        # "=" marks a value, "~" a NULL, so NULL, '' and shifted separators hash apart
+        parts = ", ".join(f"COALESCE(N'=' + {_hash_text(c, t)}, N'~')" for c, t in self._column_types().items())
+        return f"CONVERT(CHAR(64), HASHBYTES('SHA2_256', CONCAT_WS(N'|', {parts})), 2)"
+
+    def _key_text_sql(self, alias: str = "M") -> str:
+        return f"LTRIM(RTRIM(CAST({alias}.[{self.key}] AS NVARCHAR(255))))"
+
+    def checksum(self) -> str:
+        """
+        Change marker of the table: row count + MAX(rowversion_column) if
+        configured (exact), else row count + CHECKSUM_AGG(BINARY_CHECKSUM)
+        over the columns (one scan, 32-bit, so a change can in rare cases
+        cancel out; configure a rowversion column where that matters).
+        """
+        cols = ", ".join(f"[{c}]" for c in self.columns)
+        rowversion = MASTER_SNAPSHOT_CONFIG.get("rowversion_column")
+        if rowversion:
+            marker = f"CONVERT(VARCHAR(34), CAST(MAX([{rowversion}]) AS BINARY(8)), 1)"
+        else:
+            marker = f"CHECKSUM_AGG(BINARY_CHECKSUM({cols}))"
+        with self.engine.connect() as conn:
+            n, agg = conn.execute(sql_text(f"SELECT COUNT_BIG(*), {marker} FROM {self.table}")).one()
+        return hashlib.sha256(f"{n}|{agg}|{cols}".encode("utf-8")).hexdigest()[:16]
+
+    def _server_hashes(self) -> pd.Series:
+        """key -> its row hashes ("|"-joined, sorted, in case the key is not unique)."""
+        df = pd.read_sql(
+            f"SELECT {self._key_text_sql()} AS k, {self._row_hash_sql()} AS h FROM {self.table} AS M",
+            self.engine,
+        )
+        return _hashes_by_key(df["k"], df["h"])
+
+    # -----------------------
+    # snapshot file
+    # -----------------------
+    @property
+    def path(self) -> Path:
+        """Snapshot file of the current table contents, created on first use."""
+        if self._path is None:
+            with _LOCK:
+                if self._path is None:
+                    self._path = self._ensure()
+        return self._path
+
+    def _ensure(self) -> Path:
+        handoff_key = f"master_snapshot:{self.table}:{','.join(self.columns)}"
+        cached = consume(handoff_key)
+        if cached is not None and Path(cached).exists():
+            return Path(cached)
+
+        path = self.dir / f"{self.name}_{self.checksum()}.parquet"
+        if path.exists():
+            print(f"[snapshot] {self.table} unchanged, reusing {path}")
+        else:
+            base = self._latest()
+            if base is None:
+                self._write(path)
+            else:
+                self._refresh(base, path)
+            self._prune(keep=path)
+
+        publish(handoff_key, str(path))
+        return path
+
+    def _arrow_schema(self):
+        import pyarrow as pa
+
+        fields = [(c, _arrow_type(t)) for c, t in self._column_types().items()]
+        return pa.schema(fields + [(ROW_HASH, pa.string())])
+
+    def _latest(self) -> Path | None:
+        """Newest earlier snapshot with the same columns, the base of an incremental refresh."""
+        import pyarrow.parquet as pq
+
+        expected = self._arrow_schema().names
+        for p in sorted(self.dir.glob(f"{self.name}_*.parquet"), key=lambda p: p.stat().st_mtime, reverse=True):
+            try:
+                if pq.read_schema(p).names == expected:
+                    return p
+            except Exception:
+                continue
+        return None
+
+    def _to_table(self, chunk: pd.DataFrame, schema):
+        import pyarrow as pa
+
+        chunk.columns = self.columns + [ROW_HASH]
+        for c in self.columns:
+            arrow_t = schema.field(c).type
+            if pa.types.is_string(arrow_t):
+                chunk[c] = chunk[c].map(lambda v: None if v is None or v != v else str(v))
+            elif pa.types.is_timestamp(arrow_t):
+                chunk[c] = pd.to_datetime(chunk[c], errors="coerce", utc=True).dt.tz_localize(None)
+            elif not pa.types.is_boolean(arrow_t):
+                chunk[c] = pd.to_numeric(chunk[c], errors="coerce")
+        return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False, safe=False)
+
+    def _select_sql(self, where: str = "") -> str:
+        cols = ", ".join(f"M.[{c}]" for c in self.columns)
+        return f"SELECT {cols}, {self._row_hash_sql()} AS [{ROW_HASH}] FROM {self.table} AS M {where}"
+
+    def _write(self, path: Path):
+        import pyarrow.parquet as pq
+
+        schema = self._arrow_schema()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        rows = 0
+
+        print(f"[snapshot] Pulling {len(self.columns)} columns of {self.table} -> {path}")
+        with pq.ParquetWriter(tmp, schema) as writer, \
+                self.engine.connect().execution_options(stream_results=True) as conn:
+            for chunk in pd.read_sql(self._select_sql(), conn, chunksize=MASTER_SNAPSHOT_CONFIG["chunksize"]):
+                writer.write_table(self._to_table(chunk, schema))
+                rows += len(chunk)
+
+        os.replace(tmp, path)
+        print(f"[snapshot] Wrote {rows} rows to {path}")
+
+    def _refresh(self, base: Path, path: Path):
+        """New snapshot = `base` minus changed / deleted keys + the changed and new rows from the server."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        schema = self._arrow_schema()
+        local = pq.read_table(base, columns=[self.key, ROW_HASH]).to_pandas()
+        local_hashes = _hashes_by_key(local[self.key], local[ROW_HASH])
+        server_hashes = self._server_hashes()
+
+        both = pd.concat([local_hashes.rename("local"), server_hashes.rename("server")], axis=1)
+        fetch = sorted(both.index[both["server"].notna() & (both["server"] != both["local"])])
+        drop = set(fetch) | set(both.index[both["server"].isna()])
+        print(
+            f"[snapshot] {self.table} changed: fetch={len(fetch)} | deleted={len(drop) - len(fetch)} "
+            f"| unchanged={len(server_hashes) - len(fetch)} | base={base.name}"
+        )
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        rows = 0
+        drop_keys = pa.array(sorted(drop), type=pa.string())
+
+        with pq.ParquetWriter(tmp, schema) as writer:
+            for batch in pq.ParquetFile(base).iter_batches(batch_size=MASTER_SNAPSHOT_CONFIG["chunksize"]):
+                keys = pc.utf8_trim_whitespace(pc.cast(batch.column(self.key), pa.string()))
+                kept = batch.filter(pc.invert(pc.fill_null(pc.is_in(keys, value_set=drop_keys), False)))
+                writer.write_table(pa.Table.from_batches([kept], schema=schema))
+                rows += kept.num_rows
+
+            if fetch:
+                with self.engine.connect().execution_options(stream_results=True) as conn:
+                    stage_key_table(conn, "#snapshot_keys", fetch)
+                    sql = self._select_sql(f"""
+                        WHERE EXISTS (
+                            SELECT 1 FROM #snapshot_keys AS K
+                            WHERE K.[key] COLLATE DATABASE_DEFAULT = {self._key_text_sql()} COLLATE DATABASE_DEFAULT
+                        )""")
+                    for chunk in pd.read_sql(sql, conn, chunksize=MASTER_SNAPSHOT_CONFIG["chunksize"]):
+                        writer.write_table(self._to_table(chunk, schema))
+                        rows += len(chunk)
+
+        os.replace(tmp, path)
+        print(f"[snapshot] Wrote {rows} rows to {path} (incremental)")
+
+    def _prune(self, keep: Path):
+        older = sorted(
+            (p for p in self.dir.glob(f"{self.name}_*.parquet") if p != keep),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for p in older[max(MASTER_SNAPSHOT_CONFIG["keep"] - 1, 0):]:
+            p.unlink(missing_ok=True)
+
+    # -----------------------
+    # reads
+    # -----------------------
+    def read(self, columns: list[str] | None = None, indexes=None) -> pd.DataFrame:
+        """Snapshot rows (optionally only `indexes` of the key column)."""
+        filters = None
+        if indexes is not None:
+            filters = [(self.key, "in", sorted({safe_str(k).strip() for k in indexes}))]
+        return pd.read_parquet(self.path, columns=columns or self.columns, filters=filters)
+
+    def serves(self, sql: str) -> bool:
+        """True if `sql` reads the master table and no #temp table."""
+        refs = _table_refs(sql)
+        return f"{self.schema}.{self.name}".lower() in refs and not any(r.startswith("#") for r in refs)
+
+    def connect(self, sql: str | None = None):
+        """
+        DuckDB connection with the master table as a view over the snapshot
+        and the other tables `sql` reads pulled from the server (only the
+        columns `sql` names, all of them for a SELECT *).
+        """
+        import duckdb
+
+        con = duckdb.connect()
+        con.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.schema}"')
+        con.execute(
+            f"""CREATE VIEW "{self.schema}"."{self.name}" AS """
+            f"""SELECT * EXCLUDE ("{ROW_HASH}") FROM read_parquet('{self.path.as_posix()}')"""
+        )
+        try:
+            for ref in sorted(_table_refs(sql) if sql else ()):
+                if ref != f"{self.schema}.{self.name}".lower():
+                    self._pull(con, ref, sql)
+        except Exception:
+            con.close()
+            raise
+        return con
+
+    def _table_columns(self, schema: str, name: str) -> list[str]:
+        return pd.read_sql(
+            sql_text("""
+                SELECT COLUMN_NAME
+                FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA = :schema AND TABLE_NAME = :name
+                ORDER BY ORDINAL_POSITION
+            """),
+            self.engine,
+            params={"schema": schema, "name": name},
+        )["COLUMN_NAME"].tolist()
+
+    def _pull(self, con, ref: str, sql: str):
+        schema, name = ref.split(".", 1) if "." in ref else ("dbo", ref)
+        cols = self._table_columns(schema, name)
+        if not cols:
+            raise ValueError(f"{schema}.{name} not found on the server")
+
+        local_sql = to_duckdb_sql(sql)
+        if not _STAR_RE.search(local_sql):
+            named = {w.lower() for w in re.findall(r"[A-Za-z_]\w*", local_sql)}
+            cols = [c for c in cols if c.lower() in named] or cols[:1]
+
+        df = pd.read_sql(f"SELECT {', '.join(f'[{c}]' for c in cols)} FROM [{schema}].[{name}]", self.engine)
+        con.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+        con.register("_pulled", df)
+        con.execute(f'CREATE TABLE "{schema}"."{name}" AS SELECT * FROM _pulled')
+        con.unregister("_pulled")
+        print(f"[snapshot] Pulled {schema}.{name}: {len(df)} rows x {len(cols)} columns")
+
+
+def _table_refs(sql: str) -> set[str]:
+    """Lower-cased [schema.]table names `sql` reads, WITH names excluded."""
+    local_sql = to_duckdb_sql(sql)
+    ctes = {c.lower() for c in _CTE_RE.findall(local_sql)}
+    refs = {r.replace('"', "").replace(" ", "").lower() for r in _ANY_REF_RE.findall(local_sql)}
+    return refs - ctes
+
+
+def _hashes_by_key(keys: pd.Series, hashes: pd.Series) -> pd.Series:
+    df = pd.DataFrame({"k": keys.map(lambda v: safe_str(v).strip()), "h": hashes.astype(str)})
+    return df.sort_values(["k", "h"]).groupby("k")["h"].agg("|".join)
+
+
+# -----------------------
+# T-SQL -> DuckDB
+# -----------------------
+def to_duckdb_sql(sql: str) -> str:
+    """
+    The subset of T-SQL the source queries use: [quoted] and db.schema.table
+    names, -- comments, a leading SELECT [DISTINCT] TOP n, ISNULL,
+    (N)VARCHAR(MAX) and case-insensitive LIKE.
+    """
+    sql = re.sub(r"--[^\n]*", "", sql)
+    sql = re.sub(r"\[([^\]]+)\]\s*\.\s*(\[[^\]]+\]|\w+)\s*\.\s*(\[[^\]]+\]|\w+)", r"\2.\3", sql)
+    sql = re.sub(r"\[([^\]]+)\]", r'"\1"', sql)
+    sql = re.sub(r"\bISNULL\s*\(", "COALESCE(", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bN?VARCHAR\s*\(\s*MAX\s*\)", "VARCHAR", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bLIKE\b", "ILIKE", sql, flags=re.IGNORECASE)
+    sql = sql.strip().rstrip(";")
+
+    top = re.match(r"SELECT\s+(DISTINCT\s+)?TOP\s*\(?\s*(\d+)\s*\)?\s", sql, flags=re.IGNORECASE)
+    if top:
+        sql = f"SELECT {top.group(1) or ''}{sql[top.end():]}\nLIMIT {top.group(2)}"
+    return sql
+
+
+def _wrap_key_filters(con, sql: str, key_filters: list[dict]) -> str:
+    conditions = []
+    for i, flt in enumerate(key_filters):
+        if flt["mode"] not in ("include", "exclude"):
+            raise ValueError(f"Unsupported key filter mode: {flt['mode']}")
+        keys = sorted({safe_str(k).strip() for k in flt["keys"] if safe_str(k).strip()})
+        con.register(f"_keys_{i}", pd.DataFrame({"key": pd.Series(keys, dtype=object)}))
+        op = "EXISTS" if flt["mode"] == "include" else "NOT EXISTS"
+        conditions.append(
+            f"""{op} (SELECT 1 FROM _keys_{i} AS K{i} WHERE K{i}.key = CAST(src."{flt['column']}" AS VARCHAR))"""
+        )
+    return f"SELECT src.* FROM (\n{sql}\n) AS src\nWHERE " + "\n  AND ".join(conditions)
+
+
+# -----------------------
+# read-through API
+# -----------------------
+_SNAPSHOTS: dict[int, MasterSnapshot] = {}
+
+
+def master_snapshot(engine) -> MasterSnapshot | None:
+    """The snapshot for `engine` (one per engine per process), or None when disabled or not on SQL Server."""
+    if not MASTER_SNAPSHOT_CONFIG["enabled"] or engine.dialect.name != "mssql":
+        return None
+    with _LOCK:
+        snap = _SNAPSHOTS.get(id(engine))
+        if snap is None:
+            snap = _SNAPSHOTS[id(engine)] = MasterSnapshot(engine)
+    return snap
+
+
+def _local_errors() -> tuple:
+    import duckdb
+
+    return (duckdb.Error, SQLAlchemyError, ValueError)
+
+
+def read_source_sql(engine, sql: str) -> pd.DataFrame:
+    snap = master_snapshot(engine)
+    if snap is not None and snap.serves(sql):
+        try:
+            with snap.connect(sql) as con:
+                return con.execute(to_duckdb_sql(sql)).df()
+        except _local_errors() as e:
+            print(f"[snapshot] Running the query on the server instead ({type(e).__name__}: {str(e).splitlines()[0]})")
+
+    return pd.read_sql_query(sql_text(sql), engine)
+
+
+def iter_source_records(engine, sql: str, chunksize: int = 2000, key_filters: list[dict] | None = None):
+    """iter_sql_records with the same key_filters semantics, served from the snapshot when possible."""
+    snap = master_snapshot(engine)
+    if snap is None or not snap.serves(sql):
+        yield from iter_sql_records(engine, sql, chunksize=chunksize, key_filters=key_filters)
+        return
+
+    key_filters = [flt for flt in (key_filters or []) if flt["mode"] == "include" or flt["keys"]]
+    local_sql = to_duckdb_sql(sql)
+
+    con = None
+    try:
+        con = snap.connect(sql)
+        if key_filters:
+            local_sql = _wrap_key_filters(con, local_sql, key_filters)
+        res = con.execute(local_sql)
+    except _local_errors() as e:
+        if con is not None:
+            con.close()
+        print(f"[snapshot] Running the query on the server instead ({type(e).__name__}: {str(e).splitlines()[0]})")
+        yield from iter_sql_records(engine, sql, chunksize=chunksize, key_filters=key_filters)
+        return
+
+    with con:
+        names = [d[0] for d in res.description]
+        while True:
+            rows = res.fetchmany(chunksize)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(names, row))
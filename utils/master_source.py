@@ -0,0 +1,111 @@
+"""
+What 1a reads from the master table and how a source row is fingerprinted.
+
+Shared by src/1a_data_extraction.py and src/1_microbatch_daemon.py so both
+classify rows with the same hash. A row's fingerprint covers the bilingual
+text sent to the model and the amounts 1a copies into its records: an
+amount-only change re-writes the row (the extraction comes from cache, no
+model call) instead of being skipped as unchanged.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.examples.infrastructure_projects import EXAMPLES as INFRA_EXAMPLES
+from config.examples.distribution_projects import EXAMPLES as DIST_EXAMPLES
+from config.examples.service_projects import EXAMPLES as SERV_EXAMPLES
+from config.prompt import PROMPT
+
+from utils.extraction_cache import open_llm_cache
+from utils.extraction_helpers import safe_str, text_hash, build_labeled_bilingual_input
+from utils.master_snapshot import iter_source_records
+
+
+# only the columns 1a reads; rows are streamed in chunks from the local
+# master snapshot (iter_source_records)
+SOURCE_QUERY = """
+SELECT
+    [index]
+    , ProjectTitleEnglish
+    , DescriptionEnglish
+    , ProjectTitleArabic
+    , DescriptionArabic
+    , Amount
+    , ODA_Amount
+    , GE_Amount
+    , OFF_Amount
+FROM dbo.MasterTableDenormalizedCleanedFinal
+--where [index] = 'DAR-2012-083'
+"""
+SOURCE_CHUNKSIZE = 2000
+
+# source column -> field of the 1a record
+AMOUNT_COLUMNS = {
+    "Amount": "master_project_amount_actual",
+    "ODA_Amount": "master_project_oda_amount",
+    "GE_Amount": "master_project_ge_amount",
+    "OFF_Amount": "master_project_off_amount",
+}
+
+EXAMPLES = INFRA_EXAMPLES + DIST_EXAMPLES + SERV_EXAMPLES
+MODEL_ID = "gpt-4.1-mini"
+LLM_NAMESPACE = "1a_master_extraction"
+FINGERPRINT_STAGE = "1a"
+
+
+def source_text(row: dict) -> str:
+    """The labeled bilingual text 1a sends to the model for a source row."""
+    return build_labeled_bilingual_input(
+        title_en=safe_str(row.get("ProjectTitleEnglish", "") or ""),
+        desc_en=safe_str(row.get("DescriptionEnglish", "") or ""),
+        title_ar=safe_str(row.get("ProjectTitleArabic", "") or ""),
+        desc_ar=safe_str(row.get("DescriptionArabic", "") or ""),
+    ) or ""
+
+
+def _amount_text(value) -> str:
+    try:
+        f = float(value)
+    except (TypeError, ValueError):
+        return safe_str(value)
+    # NaN; floats so Decimal (server) and float (snapshot) hash alike
+    return "" if f != f else repr(f)
+
+
+def row_fingerprint(text: str, row: dict) -> str:
+    """text_hash of the model text plus the row's amounts."""
+    amounts = "|".join(_amount_text(row.get(col)) for col in AMOUNT_COLUMNS)
+    return text_hash(f"{text}\n{amounts}")
+
+
+def iter_source_rows(engine, key_filters: list[dict] | None = None, include_blank: bool = False):
+    """
+    Yield (index, text, row) for every source row with an index. Rows whose
+    text is blank are skipped unless include_blank (they have nothing to
+    extract, but still exist).
+    """
+    rows = iter_source_records(engine, SOURCE_QUERY, chunksize=SOURCE_CHUNKSIZE, key_filters=key_filters)
+    for row in rows:
+        index = safe_str(row.get("index", None) or row.get("Index", None))
+        if not index:
+            continue
+
+        text = source_text(row)
+        if not text.strip() and not include_blank:
+            continue
+
+        yield index, text, row
+
+
+def source_fingerprints(engine, key_filters: list[dict] | None = None) -> dict[str, str]:
+    """{index: row_fingerprint} of every source row, blank text included."""
+    return {
+        index: row_fingerprint(text, row)
+        for index, text, row in iter_source_rows(engine, key_filters, include_blank=True)
+    }
+
+
+def prompt_version() -> str:
+    """Version of the 1a prompt/examples/model (the fingerprints' prompt_version)."""
+    return open_llm_cache(LLM_NAMESPACE, PROMPT, EXAMPLES, MODEL_ID).version
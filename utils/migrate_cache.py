@@ -1,12 +1,14 @@
-import pickle
 from pathlib import Path
 import sys
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 import pandas as pd
+from utils.extraction_cache import open_run_cache
 from utils.extraction_helpers import normalize_text, text_hash
 
+# legacy pickle paths of the runs; the entries are read from / written to the
+# .sqlite cache next to each (open_run_cache imports a pickle it hasn't seen yet)
 OLD_PKL = Path(r"C:\Users\SREE\data-cleansing-framework\data\outputs\20251231_160609\20251231_160609_lx_cache.pkl")  # change
 NEW_PKL = Path(r"C:\Users\SREE\data-cleansing-framework\data\outputs\20251231_160609\20251231_160609_lx_cache.pkl")  # change
 
@@ -31,8 +33,9 @@ def get_input_text(annot) -> str | None:
 
     return None
 
-with OLD_PKL.open("rb") as f:
-    old_cache = pickle.load(f)
+old_db = open_run_cache(OLD_PKL)
+old_cache = dict(old_db.items())
+old_db.close()
 
 new_cache = {}
 missing_text = 0
@@ -58,12 +61,14 @@ for old_key, annot in old_cache.items():
 
     new_cache[h_new] = annot
 
-NEW_PKL.parent.mkdir(parents=True, exist_ok=True)
-with NEW_PKL.open("wb") as f:
-    pickle.dump(new_cache, f)
+new_db = open_run_cache(NEW_PKL)
+# same run: swap the re-keyed entries in for the old ones in one transaction
+new_db.update(new_cache, replace=NEW_PKL.resolve() == OLD_PKL.resolve())
+new_db.flush()
+new_db.close()
 
 print("Old cache entries     :", len(old_cache))
 print("New cache entries     :", len(new_cache))
 print("Missing input text    :", missing_text)
 print("Hash collisions merged:", collisions)
-print("Wrote:", NEW_PKL)
+print("Wrote:", new_db.path)
@@ -0,0 +1,417 @@
+"""
+Run pipeline steps in one process as a declared DAG.
+
+A step is a dict:
+
+    {"name": "1b_post_processing", "script": Path(...), "argv": [...], "deps": ["1a_data_extraction"]}
+
+Each step script is executed with runpy (run_name="__main__"), so the
+scripts stay runnable on their own. Inside a pipeline run they share:
+  - one SQLAlchemy engine (shared_engine),
+  - the process-wide LLM cache and rate governors,
+  - ID sets / DataFrames handed over in memory (publish / consume,
+    write_ids_txt / read_ids_txt).
+
+Steps whose dependencies are done run in parallel, up to max_workers.
+Per-step timings are printed and, if timings_path is given, written as JSON.
+
+With a RunManifest (utils/run_manifest.py), a step that also has
+"fingerprint" (callable -> dict of input digests) and optionally
+"outputs" (paths that must exist) is skipped when its inputs are unchanged
+since its last successful run.
+
+Streaming: a step can declare "streams": [name, ...] it produces and
+"consumes": [name, ...] it reads. Each stream is a bounded queue
+(get_stream), so producer and consumer run at the same time and a full
+queue blocks the producer (backpressure). The runner closes a producer's
+streams when it finishes and aborts a consumer's input streams when it
+fails, so neither side is left waiting on the other.
+"""
+import json
+import queue
+import runpy
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+
+# -----------------------
+# stage streams
+# -----------------------
+class StageStream:
+    """Bounded queue of items from one running step to another."""
+
+    _END = object()
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self._q = queue.Queue(maxsize=max(1, maxsize))
+        self._aborted = threading.Event()
+        self._error = None
+
+    def put(self, item) -> None:
+        """Blocks while the queue is full; raises once the consumer has stopped."""
+        while True:
+            if self._aborted.is_set():
+                raise RuntimeError(f"Stream '{self.name}': consumer stopped")
+            try:
+                self._q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, error: str | None = None) -> None:
+        self._error = error
+        while not self._aborted.is_set():
+            try:
+                self._q.put(self._END, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def abort(self) -> None:
+        self._aborted.set()
+
+    def _end(self):
+        if self._error is not None:
+            raise RuntimeError(f"Stream '{self.name}': producer failed ({self._error})")
+
+    def __iter__(self):
+        while True:
+            item = self._q.get()
+            if item is self._END:
+                self._end()
+                return
+            yield item
+
+    def batches(self, max_items: int, max_wait_s: float = 5.0):
+        """
+        Lists of up to max_items; a partial batch is yielded once no new item
+        arrived for max_wait_s, so a slow producer does not hold rows back.
+        """
+        batch = []
+        while True:
+            try:
+                item = self._q.get(timeout=max_wait_s if batch else None)
+            except queue.Empty:
+                yield batch
+                batch = []
+                continue
+            if item is self._END:
+                self._end()
+                if batch:
+                    yield batch
+                return
+            batch.append(item)
+            if len(batch) >= max_items:
+                yield batch
+                batch = []
+
+
+# -----------------------
+# pipeline context (what steps share)
+# -----------------------
+class PipelineContext:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engine = None
+        self._handoff = {}
+        self._streams = {}
+
+    def get_engine(self, factory):
+        with self._lock:
+            if self._engine is None:
+                self._engine = factory()
+            return self._engine
+
+    def publish(self, key: str, value):
+        with self._lock:
+            self._handoff[key] = value
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self._handoff.get(key, default)
+
+    def open_stream(self, name: str, maxsize: int) -> StageStream:
+        with self._lock:
+            self._streams[name] = StageStream(name, maxsize)
+            return self._streams[name]
+
+    def stream(self, name: str) -> StageStream | None:
+        with self._lock:
+            return self._streams.get(name)
+
+    def dispose(self):
+        if hasattr(self._engine, "dispose"):
+            self._engine.dispose()
+        self._engine = None
+
+
+_CONTEXT = None
+_STEP = threading.local()
+
+
+def current_context() -> PipelineContext | None:
+    """The running pipeline's context, or None when a script runs on its own."""
+    return _CONTEXT
+
+
+def step_argv() -> list[str] | None:
+    """
+    argv for the step running in this thread, for parser.parse_args(step_argv()).
+    None outside the runner, so argparse falls back to sys.argv.
+    """
+    return getattr(_STEP, "argv", None)
+
+
+def shared_engine(factory):
+    """The pipeline's shared engine if running in-process, else a fresh factory() engine."""
+    ctx = current_context()
+    return ctx.get_engine(factory) if ctx is not None else factory()
+
+
+def publish(key: str, value) -> None:
+    ctx = current_context()
+    if ctx is not None:
+        ctx.publish(key, value)
+
+
+def consume(key: str, default=None):
+    ctx = current_context()
+    return ctx.get(key, default) if ctx is not None else default
+
+
+def get_stream(name: str) -> StageStream:
+    """The stream `name` of the running pipeline; only exists in in-process runs."""
+    ctx = current_context()
+    s = ctx.stream(name) if ctx is not None else None
+    if s is None:
+        raise RuntimeError(
+            f"Stream '{name}' is not open: --stream only works inside an in-process "
+            f"pipeline run that declares it (e.g. 1_main.py --stream)"
+        )
+    return s
+
+
+def _ids_key(path: Path) -> str:
+    return f"ids:{Path(path).resolve()}"
+
+
+def write_ids_txt(path: Path, ids) -> None:
+    """Write one id per line; in a pipeline run also hand the set to later steps."""
+    ids = sorted({str(x).strip() for x in ids if str(x).strip()})
+    Path(path).write_text("\n".join(ids), encoding="utf-8")
+    publish(_ids_key(path), set(ids))
+
+
+def read_ids_txt(path: Path) -> set[str]:
+    """Ids handed over by an earlier step in this run, else read from the txt file."""
+    ids = consume(_ids_key(path))
+    if ids is not None:
+        return set(ids)
+    return {
+        line.strip()
+        for line in Path(path).read_text(encoding="utf-8").splitlines()
+        if line.strip()
+    }
+
+
+# -----------------------
+# running steps
+# -----------------------
+def _run_in_process(step: dict) -> None:
+    _STEP.argv = [str(a) for a in step.get("argv", [])]
+    try:
+        runpy.run_path(str(step["script"]), run_name="__main__")
+    except SystemExit as e:
+        # scripts exit(0) early when there is nothing to do
+        if e.code not in (None, 0):
+            raise RuntimeError(f"Step failed: {step['name']} | exit code={e.code}") from e
+    finally:
+        _STEP.argv = None
+
+
+def _run_subprocess(step: dict) -> None:
+    cmd = [sys.executable, str(step["script"]), *[str(a) for a in step.get("argv", [])]]
+    print("[PIPELINE] Command:", " ".join(cmd))
+    result = subprocess.run(cmd, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"Step failed: {step['name']} | returncode={result.returncode}")
+
+
+def _validate(steps: list[dict]) -> None:
+    names = [s["name"] for s in steps]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Duplicate step names in pipeline: {names}")
+
+    for s in steps:
+        if not Path(s["script"]).exists():
+            raise FileNotFoundError(f"Missing pipeline file: {s['script']}")
+        for d in s.get("deps", []):
+            if d not in names:
+                raise ValueError(f"Step '{s['name']}' depends on unknown step '{d}'")
+
+    producers = {}
+    for s in steps:
+        for name in s.get("streams", []):
+            if name in producers:
+                raise ValueError(f"Stream '{name}' is produced by both '{producers[name]}' and '{s['name']}'")
+            producers[name] = s["name"]
+    consumers = {}
+    for s in steps:
+        for name in s.get("consumes", []):
+            if name not in producers:
+                raise ValueError(f"Step '{s['name']}' consumes stream '{name}' that no step produces")
+            if name in consumers:
+                raise ValueError(f"Stream '{name}' is consumed by both '{consumers[name]}' and '{s['name']}'")
+            if producers[name] in s.get("deps", []):
+                raise ValueError(f"Step '{s['name']}' can't both consume '{name}' and wait for its producer")
+            consumers[name] = s["name"]
+
+    # cycle check (Kahn)
+    remaining = {s["name"]: set(s.get("deps", [])) for s in steps}
+    while remaining:
+        ready = [n for n, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Pipeline has a dependency cycle among: {sorted(remaining)}")
+        for n in ready:
+            del remaining[n]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_pipeline(
+    steps: list[dict],
+    max_workers: int = 1,
+    in_process: bool = True,
+    timings_path: Path | None = None,
+    manifest=None,
+    stream_maxsize: int = 256,
+) -> list[dict]:
+    """
+    Run `steps` in dependency order, independent steps in parallel.
+    Raises RuntimeError after the running steps finish if any step failed;
+    steps depending on a failed step are not started.
+    """
+    global _CONTEXT
+    _validate(steps)
+
+    streaming = [s["name"] for s in steps if s.get("streams") or s.get("consumes")]
+    if streaming and not in_process:
+        raise ValueError("Streaming steps need in_process=True")
+    if len(streaming) > max(1, max_workers):
+        # every step on a stream must be running at once or the queue never drains
+        raise ValueError(f"max_workers={max_workers} is below the {len(streaming)} streaming steps: {streaming}")
+
+    by_name = {s["name"]: s for s in steps}
+    pending = {s["name"]: set(s.get("deps", [])) for s in steps}
+    done = set()
+    failed = {}
+    timings = []
+    run_fn = _run_in_process if in_process else _run_subprocess
+
+    def _timed(step):
+        print("\n" + "=" * 80)
+        print(f"[PIPELINE] Starting: {step['name']}")
+        print("=" * 80)
+        t0 = time.perf_counter()
+        started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        status = "ok"
+        parts = None
+        error = None
+        try:
+            if manifest is not None and step.get("fingerprint") is not None:
+                parts = step["fingerprint"]()
+                outputs_exist = all(Path(p).exists() for p in step.get("outputs", []))
+                skip, reason = manifest.check(step["name"], parts, outputs_exist)
+                print(f"[PIPELINE] {'Skipping' if skip else 'Running'} {step['name']}: {reason}")
+                if skip:
+                    status = "skipped"
+                    return
+
+            run_fn(step)
+
+            if parts is not None:
+                manifest.record(step["name"], parts, time.perf_counter() - t0)
+        except BaseException as e:
+            status = "failed"
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if _CONTEXT is not None:
+                for name in step.get("streams", []):
+                    _CONTEXT.stream(name).close(error)
+                if error is not None:
+                    for name in step.get("consumes", []):
+                        _CONTEXT.stream(name).abort()
+
+            elapsed = time.perf_counter() - t0
+            timings.append({
+                "step": step["name"],
+                "started_at": started_at,
+                "seconds": round(elapsed, 3),
+                "status": status,
+            })
+            label = {"ok": "Completed", "skipped": "Skipped", "failed": "FAILED"}[status]
+            print(f"[PIPELINE] {label}: {step['name']} ({elapsed:.1f}s)")
+
+    _CONTEXT = PipelineContext() if in_process else None
+    if _CONTEXT is not None:
+        for s in steps:
+            for name in s.get("streams", []):
+                _CONTEXT.open_stream(name, stream_maxsize)
+    t_start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            running = {}
+            while pending or running:
+                if not failed:
+                    for name in [n for n, deps in pending.items() if deps <= done]:
+                        del pending[name]
+                        running[pool.submit(_timed, by_name[name])] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    exc = fut.exception()
+                    if exc is None:
+                        done.add(name)
+                    else:
+                        failed[name] = exc
+                        # nothing new starts now, so no producer may wait on a consumer
+                        if _CONTEXT is not None:
+                            for s in steps:
+                                for stream_name in s.get("streams", []):
+                                    _CONTEXT.stream(stream_name).abort()
+    finally:
+        if _CONTEXT is not None:
+            _CONTEXT.dispose()
+        _CONTEXT = None
+
+        total = time.perf_counter() - t_start
+        print("\n[PIPELINE] Step timings:")
+        for t in timings:
+            print(f"[PIPELINE]   {t['step']:<45} {t['seconds']:>10.1f}s  {t['status']}")
+        print(f"[PIPELINE]   {'TOTAL (wall)':<45} {total:>10.1f}s")
+
+        if timings_path is not None:
+            Path(timings_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(timings_path, "w", encoding="utf-8") as f:
+                json.dump({"total_seconds": round(total, 3), "steps": timings}, f, indent=2)
+            print(f"[PIPELINE] Timings saved: {timings_path}")
+
+    if failed:
+        name, exc = next(iter(failed.items()))
+        skipped = sorted(pending)
+        msg = f"{name}: {exc}"
+        if skipped:
+            msg += f" | not started: {', '.join(skipped)}"
+        raise RuntimeError(msg)
+
+    return timings
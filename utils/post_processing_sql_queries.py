@@ -1,10 +1,7 @@
-QUERIES = [
-    """TRUNCATE TABLE silver.cleaned_master_project""",
-
-    """TRUNCATE TABLE silver.cleaned_project""",
-
-    """TRUNCATE TABLE silver.cleaned_project_asset""",
-
+# silver tables rebuilt from silver.MasterTable_extracted after 1b; every
+# SELECT reads MasterTable_extracted as alias a
+SILVER_INSERTS = {
+    "silver.cleaned_master_project":
     """INSERT INTO silver.cleaned_master_project
        SELECT DISTINCT
            a.[Index],
@@ -26,6 +23,7 @@ QUERIES = [
        LEFT JOIN silver.cleaned_master_project_description b
         ON a.[index] = b.[index]""",
 
+    "silver.cleaned_project":
     """INSERT INTO silver.cleaned_project
        SELECT DISTINCT
            [Index],
@@ -53,6 +51,7 @@ QUERIES = [
        LEFT JOIN silver.cleaned_project_type b
         ON a.project_code = b.project_code;""",
 
+    "silver.cleaned_project_asset":
     """INSERT INTO silver.cleaned_project_asset
        SELECT DISTINCT
            [Index],
@@ -84,9 +83,61 @@ QUERIES = [
            input_text
        FROM silver.MasterTable_extracted a
        LEFT JOIN silver.cleaned_project_type b
-        ON a.project_code = b.project_code"""
+        ON a.project_code = b.project_code""",
+}
+
+# full rebuild (1b --full-refresh)
+QUERIES = [
+    *(f"TRUNCATE TABLE {table}" for table in SILVER_INSERTS),
+    *SILVER_INSERTS.values(),
 ]
 
+_IN_IDX = """
+       WHERE EXISTS (
+           SELECT 1 FROM #idx AS I
+           WHERE I.[index] COLLATE DATABASE_DEFAULT = CAST(a.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
+       )"""
+
+
+def incremental_queries(inserts: dict = SILVER_INSERTS) -> list[str]:
+    """
+    Refresh only the indexes staged in #idx ([index] NVARCHAR(255)) on the
+    same connection: delete their rows from each table, then insert them
+    again with the same SELECT as the full rebuild.
+    """
+    out = []
+    for table, insert in inserts.items():
+        out.append(
+            f"""DELETE T
+       FROM {table} AS T
+       INNER JOIN #idx AS I
+        ON CAST(T.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT = I.[index] COLLATE DATABASE_DEFAULT"""
+        )
+        out.append(insert.rstrip().rstrip(";") + _IN_IDX)
+    return out
+
+
+INCREMENTAL_QUERIES = incremental_queries()
+
+# tables joining silver.cleaned_project_type, which 1d writes after 1b's
+# refresh; 1d re-runs them for the project codes staged in #codes
+PROJECT_TYPE_DEPENDENT_INSERTS = {
+    table: insert for table, insert in SILVER_INSERTS.items() if "silver.cleaned_project_type" in insert
+}
+
+PROJECT_TYPE_REFRESH_QUERIES = [
+    "IF OBJECT_ID('tempdb..#idx') IS NOT NULL DROP TABLE #idx",
+    """SELECT DISTINCT CAST(a.[index] AS NVARCHAR(255)) AS [index]
+       INTO #idx
+       FROM silver.MasterTable_extracted a
+       WHERE EXISTS (
+           SELECT 1 FROM #codes AS C
+           WHERE C.[project_code] COLLATE DATABASE_DEFAULT = CAST(a.project_code AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
+       )""",
+    *incremental_queries(PROJECT_TYPE_DEPENDENT_INSERTS),
+]
+
+
 
 OLLAMA_QUERIES = [
     """TRUNCATE TABLE ollama.cleaned_master_project""",
@@ -0,0 +1,48 @@
+"""
+Spawn-context process pools for the CPU-bound helpers the pipeline scripts
+call (utils/master_doc_parser.py, utils/extraction_planner.py).
+
+spawn exists on every platform (Windows has no fork) and is safe from a
+multi-threaded parent, e.g. a step running in a 1_main.py thread: fork
+would copy locks held by the other threads into the child. A spawned child
+normally re-runs the parent's __main__ script first; the pipeline scripts
+do their work at module level, so the children of these pools skip that and
+only import the module of the function they are given. Submitted functions
+must therefore be top-level functions of an importable module.
+"""
+import multiprocessing as mp
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import spawn
+
+
+_prep_lock = threading.Lock()
+_get_preparation_data = spawn.get_preparation_data
+
+
+def _preparation_data_without_main(name):
+    data = _get_preparation_data(name)
+    data.pop("init_main_from_path", None)
+    data.pop("init_main_from_name", None)
+    return data
+
+
+class _SpawnProcess(mp.context.SpawnProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        # the spawn Popen classes read spawn.get_preparation_data at launch
+        with _prep_lock:
+            spawn.get_preparation_data = _preparation_data_without_main
+            try:
+                return mp.context.SpawnProcess._Popen(process_obj)
+            finally:
+                spawn.get_preparation_data = _get_preparation_data
+
+
+class _SpawnContext(mp.context.SpawnContext):
+    Process = _SpawnProcess
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """ProcessPoolExecutor whose spawned workers do not re-run the calling script."""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=_SpawnContext())
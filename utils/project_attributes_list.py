@@ -4,26 +4,12 @@ from pathlib import Path
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
 
-import urllib.parse
 import pandas as pd
-from sqlalchemy import create_engine, text as sql_text
+from sqlalchemy import text as sql_text
 
 import langextract as lx
 
 
-# ============================================================
-# SQL Server connection (Windows Auth)
-# ============================================================
-def get_sql_server_engine():
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=SREESPOORTHY\\SQLEXPRESS01;"
-        "DATABASE=ForeignAidDatabase_2019;"
-        "Trusted_Connection=yes;"
-    )
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}", fast_executemany=True)
-
-
 # ============================================================
 # Load allowed subsectors from SQL
 # ============================================================
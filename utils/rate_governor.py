@@ -0,0 +1,417 @@
+"""
+Shared rate governor for model calls.
+
+    governor = get_governor("openai")
+    result = governor.call(lx.extract, text_or_documents=..., est_tokens=1200)
+
+Combines
+  - token buckets for the provider's requests/min and tokens/min budgets,
+  - an AIMD concurrency limit (additive increase on success, halve on a
+    429 / timeout),
+  - exponential backoff with full jitter (honouring Retry-After when the
+    error carries one),
+and keeps live throughput stats (stats() / stats_line()).
+
+Try it against the local stub that simulates a rate-limited endpoint:
+
+    python utils/rate_governor.py stub --port 8765 --rpm 60
+    python utils/rate_governor.py stub --port 8765 --rpm 10 --window-s 5    # quick run
+    python utils/rate_governor.py demo --url http://127.0.0.1:8765 --requests 200 --threads 16
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import RATE_GOVERNOR_CONFIG
+
+
+# -----------------------
+# error classification
+# -----------------------
+def _status_code(exc) -> int | None:
+    for obj in (exc, getattr(exc, "response", None)):
+        if obj is None:
+            continue
+        for attr in ("status_code", "code", "status"):
+            val = getattr(obj, attr, None)
+            if isinstance(val, int):
+                return val
+    return None
+
+
+def _classify_typed(exc) -> tuple[bool, str | None]:
+    """(decided, kind) from the HTTP status or the exception type alone."""
+    status = _status_code(exc)
+    if status is not None:
+        if status == 429:
+            return True, "rate_limit"
+        if status == 408:
+            return True, "timeout"
+        if status in (500, 502, 503, 504):
+            return True, "server"
+        return True, None
+
+    name = type(exc).__name__.lower()
+    if isinstance(exc, TimeoutError) or isinstance(getattr(exc, "reason", None), TimeoutError) or "timeout" in name:
+        return True, "timeout"
+    if "ratelimit" in name:
+        return True, "rate_limit"
+    if "internalserver" in name or "serviceunavailable" in name or "overloaded" in name:
+        return True, "server"
+    return False, None
+
+
+def classify_error(exc: BaseException) -> str | None:
+    """
+    "rate_limit" / "timeout" (retry + shrink concurrency), "server" (retry
+    only) or None (not retryable). Decided by the HTTP status or exception
+    type of the error or of what it wraps (__cause__ / __context__);
+    langextract re-raises provider errors without either, so those fall back
+    to the message.
+    """
+    seen = set()
+    err = exc
+    while err is not None and id(err) not in seen:
+        seen.add(id(err))
+        decided, kind = _classify_typed(err)
+        if decided:
+            return kind
+        err = err.__cause__ or err.__context__
+
+    msg = str(exc).lower()
+    if "rate limit" in msg or "too many requests" in msg or " 429" in msg:
+        return "rate_limit"
+    if "timed out" in msg:
+        return "timeout"
+    if "overloaded" in msg or "service unavailable" in msg:
+        return "server"
+    return None
+
+
+def _retry_after_s(exc) -> float | None:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or getattr(exc, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# -----------------------
+# building blocks
+# -----------------------
+class TokenBucket:
+    """Continuous-refill bucket holding at most one minute of budget."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+
+class RateGovernor:
+    def __init__(
+        self,
+        name: str,
+        rpm: float | None = None,
+        tpm: float | None = None,
+        initial_concurrency: int = 4,
+        min_concurrency: int = 1,
+        max_concurrency: int = 16,
+        max_retries: int = 6,
+        base_backoff_s: float = 1.0,
+        max_backoff_s: float = 60.0,
+    ):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.limit = float(min(max(initial_concurrency, self.min_concurrency), self.max_concurrency))
+        self.max_retries = max_retries
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._last_decrease = 0.0
+
+        self._stats_lock = threading.Lock()
+        self._window = deque()  # (finished_at, est_tokens) of successful calls, last 60s
+        self._started = time.monotonic()
+        self.counts = {
+            "calls": 0,
+            "ok": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "timeouts": 0,
+            "server_errors": 0,
+            "failed": 0,
+        }
+
+    # -------- concurrency (AIMD) --------
+    def _enter(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def _exit(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_success(self):
+        with self._cond:
+            # +1 slot per "limit" successes, i.e. roughly one per round trip
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _on_throttle(self):
+        with self._cond:
+            now = time.monotonic()
+            # one burst of 429s should only halve the window once
+            if now - self._last_decrease >= self.base_backoff_s:
+                self.limit = max(self.min_concurrency, self.limit / 2.0)
+                self._last_decrease = now
+
+    # -------- public --------
+    def call(self, fn, *args, est_tokens: int = 0, **kwargs):
+        """Run fn(*args, **kwargs) under the budgets; retries rate-limit / timeout / 5xx errors."""
+        attempt = 0
+        while True:
+            if self.requests:
+                self.requests.acquire(1)
+            if self.tokens and est_tokens:
+                self.tokens.acquire(est_tokens)
+
+            self._enter()
+            with self._stats_lock:
+                self.counts["calls"] += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                self._exit()
+
+                with self._stats_lock:
+                    if kind == "rate_limit":
+                        self.counts["rate_limited"] += 1
+                    elif kind == "timeout":
+                        self.counts["timeouts"] += 1
+                    elif kind == "server":
+                        self.counts["server_errors"] += 1
+
+                if kind is None or attempt >= self.max_retries:
+                    with self._stats_lock:
+                        self.counts["failed"] += 1
+                    raise
+
+                if kind in ("rate_limit", "timeout"):
+                    self._on_throttle()
+
+                delay = random.uniform(0, min(self.max_backoff_s, self.base_backoff_s * (2 ** attempt)))
+                retry_after = _retry_after_s(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+
+                attempt += 1
+                with self._stats_lock:
+                    self.counts["retries"] += 1
+                time.sleep(delay)
+                continue
+
+            self._exit()
+            self._on_success()
+            with self._stats_lock:
+                self.counts["ok"] += 1
+                self._window.append((time.monotonic(), est_tokens))
+            return result
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._stats_lock:
+            while self._window and now - self._window[0][0] > 60.0:
+                self._window.popleft()
+            span = min(60.0, max(now - self._started, 1e-6))
+            req_per_min = len(self._window) * 60.0 / span
+            tok_per_min = sum(t for _, t in self._window) * 60.0 / span
+            counts = dict(self.counts)
+
+        with self._cond:
+            limit, in_flight = self.limit, self._in_flight
+
+        return {
+            "name": self.name,
+            **counts,
+            "concurrency_limit": round(limit, 2),
+            "in_flight": in_flight,
+            "req_per_min": round(req_per_min, 1),
+            "est_tokens_per_min": round(tok_per_min),
+        }
+
+    def stats_line(self) -> str:
+        s = self.stats()
+        return (
+            f"[governor:{s['name']}] ok={s['ok']} | retries={s['retries']} | 429={s['rate_limited']} "
+            f"| timeouts={s['timeouts']} | failed={s['failed']} | limit={s['concurrency_limit']} "
+            f"| in_flight={s['in_flight']} | rpm={s['req_per_min']} | tpm~{s['est_tokens_per_min']}"
+        )
+
+
+_GOVERNORS = {}
+_GOVERNORS_LOCK = threading.Lock()
+
+
+def get_governor(provider: str) -> RateGovernor:
+    """Process-wide governor for a provider in RATE_GOVERNOR_CONFIG, shared by every caller."""
+    with _GOVERNORS_LOCK:
+        if provider not in _GOVERNORS:
+            if provider not in RATE_GOVERNOR_CONFIG:
+                raise ValueError(
+                    f"Unknown provider='{provider}'. Allowed values: {', '.join(sorted(RATE_GOVERNOR_CONFIG))}"
+                )
+            _GOVERNORS[provider] = RateGovernor(provider, **RATE_GOVERNOR_CONFIG[provider])
+        return _GOVERNORS[provider]
+
+
+# -----------------------
+# local stub endpoint + demo
+# -----------------------
+def make_stub(port: int, rpm: int, latency_s: float = 0.0, timeout_rate: float = 0.0, window_s: float = 60.0):
+    """
+    HTTP server that answers 429 (Retry-After: 1) above `rpm` requests per
+    rolling window (a minute by default; shorten it for quick experiments).
+    Port 0 picks a free port (server.server_address).
+    """
+    hits = deque()
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _handle(self):
+            now = time.monotonic()
+            with lock:
+                while hits and now - hits[0] > window_s:
+                    hits.popleft()
+                limited = len(hits) >= rpm
+                if not limited:
+                    hits.append(now)
+
+            if limited:
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(b'{"error": "rate limit exceeded"}')
+                return
+
+            if random.random() < timeout_rate:
+                time.sleep(latency_s * 20)
+            else:
+                time.sleep(latency_s)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"ok": True}).encode("utf-8"))
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+
+def run_stub(port: int, rpm: int, latency_s: float, timeout_rate: float, window_s: float = 60.0):
+    server = make_stub(port, rpm, latency_s, timeout_rate, window_s)
+    print(
+        f"[stub] listening on http://127.0.0.1:{server.server_address[1]} | limit={rpm} per {window_s:g}s "
+        f"| latency={latency_s}s | timeout_rate={timeout_rate}"
+    )
+    server.serve_forever()
+
+
+def run_demo(url: str, n_requests: int, threads: int, rpm: int | None, timeout_s: float):
+    from concurrent.futures import ThreadPoolExecutor
+
+    governor = RateGovernor(
+        "stub", rpm=rpm, initial_concurrency=4, max_concurrency=threads,
+        max_retries=8, base_backoff_s=0.5, max_backoff_s=10.0,
+    )
+
+    def one(_):
+        def request():
+            with urllib.request.urlopen(url, data=b"{}", timeout=timeout_s) as resp:
+                return resp.status
+        return governor.call(request, est_tokens=500)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(one, i) for i in range(n_requests)]
+        done = 0
+        for f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                print(f"[demo] request failed: {type(e).__name__}: {e}")
+            done += 1
+            if done % 20 == 0:
+                print(governor.stats_line())
+
+    print(governor.stats_line())
+    print(f"[demo] {n_requests} requests in {time.monotonic() - started:.1f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rate governor stub endpoint / demo")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    stub = sub.add_parser("stub", help="Serve a local endpoint that simulates provider rate limits")
+    stub.add_argument("--port", type=int, default=8765)
+    stub.add_argument("--rpm", type=int, default=60)
+    stub.add_argument("--latency-s", type=float, default=0.2)
+    stub.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of requests that stall (x20 latency)")
+    stub.add_argument("--window-s", type=float, default=60.0, help="Length of the rolling rate-limit window")
+
+    demo = sub.add_parser("demo", help="Drive the stub through a RateGovernor and print live stats")
+    demo.add_argument("--url", default="http://127.0.0.1:8765")
+    demo.add_argument("--requests", type=int, default=200)
+    demo.add_argument("--threads", type=int, default=16)
+    demo.add_argument("--rpm", type=int, default=None, help="Client-side request budget (default: none, rely on AIMD)")
+    demo.add_argument("--timeout-s", type=float, default=5.0)
+
+    args = parser.parse_args(argv)
+    if args.command == "stub":
+        run_stub(args.port, args.rpm, args.latency_s, args.timeout_rate, args.window_s)
+    else:
+        run_demo(args.url, args.requests, args.threads, args.rpm, args.timeout_s)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Run manifest: skip pipeline steps whose inputs have not changed.
+
+Before a step runs, its inputs are fingerprinted as a dict of parts, e.g.
+
+    {
+        "sql:dbo.MasterTableDenormalizedCleanedFinal": "412733:-1938204711",
+        "file:data/outputs/<run>/<run>_processed_indexes.txt": "9f2c...",
+        "file:src/1b_post_processing.py": "51ab...",
+        "argv": "c03e...",
+    }
+
+If the manifest holds the same fingerprint for that step from a successful
+run, and the step's outputs still exist, the step is skipped. Any changed
+part reruns it (the changed keys are printed); --force-step overrides.
+
+SQL result checksums use COUNT_BIG + CHECKSUM_AGG(BINARY_CHECKSUM(*)),
+computed on the server. They are cheap but not collision-proof; use
+--force-step when a rerun must happen regardless.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import inspect, text as sql_text
+
+
+# -----------------------
+# fingerprint parts
+# -----------------------
+def value_digest(obj) -> str:
+    """Stable sha256 of a config value / prompt / argv list."""
+    payload = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_digest(path: Path, block_size: int = 1 << 20) -> str | None:
+    """sha256 of a file's bytes, or None if it does not exist."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _python_checksum(engine, sql: str, chunksize: int = 20000) -> str:
+    # fallback for queries SQL Server can't wrap in a derived table (CTEs, ORDER BY, unnamed columns)
+    h = hashlib.sha256()
+    n = 0
+    for chunk in pd.read_sql(sql, engine, chunksize=chunksize):
+        n += len(chunk)
+        h.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+    return f"{n}:{h.hexdigest()[:16]}"
+
+
+def sql_checksum(engine, sql: str) -> str:
+    """'<row count>:<checksum>' of a query's result set."""
+    q = sql.strip().rstrip(";")
+    if not re.match(r"(?is)^\s*with\b", q):
+        wrapped = (
+            "SELECT COUNT_BIG(*) AS n, CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS cs "
+            f"FROM (\n{q}\n) AS fp_src"
+        )
+        try:
+            with engine.connect() as conn:
+                n, cs = conn.execute(sql_text(wrapped)).one()
+            return f"{n}:{cs}"
+        except Exception:
+            pass
+    return _python_checksum(engine, q)
+
+
+def table_checksum(engine, table: str) -> str:
+    """sql_checksum of a whole table ('schema.table')."""
+    return sql_checksum(engine, f"SELECT * FROM {table}")
+
+
+def tables_exist(engine, tables) -> bool:
+    insp = inspect(engine)
+    for t in tables:
+        schema, _, name = t.rpartition(".")
+        if not insp.has_table(name, schema=schema or None):
+            return False
+    return True
+
+
+def _label(path: Path) -> str:
+    path = Path(path)
+    try:
+        return path.resolve().relative_to(Path.cwd().resolve()).as_posix()
+    except ValueError:
+        return path.as_posix()
+
+
+def fingerprint_parts(*, engine=None, tables=(), queries=None, files=(), values=None) -> dict:
+    """
+    Input fingerprint of a step:
+      tables  -> "sql:<table>"   whole-table checksums
+      queries -> "sql:<label>"   query result checksums ({label: sql})
+      files   -> "file:<path>"   sha256 of upstream artifacts / code / config files
+      values  -> "<label>"       digests of in-memory config, prompts, argv ({label: obj})
+    """
+    parts = {}
+    for t in tables:
+        parts[f"sql:{t}"] = table_checksum(engine, t)
+    for label, sql in (queries or {}).items():
+        parts[f"sql:{label}"] = sql_checksum(engine, sql)
+    for f in files:
+        parts[f"file:{_label(f)}"] = file_digest(f)
+    for label, obj in (values or {}).items():
+        parts[label] = value_digest(obj)
+    return parts
+
+
+# -----------------------
+# manifest
+# -----------------------
+class RunManifest:
+    """
+    JSON file holding, per step, the input fingerprint of its last
+    successful run. Safe to use from parallel steps in one process.
+    """
+
+    def __init__(self, path: Path, force_steps=()):
+        self.path = Path(path)
+        self.force_steps = [str(s) for s in force_steps]
+        self._lock = threading.Lock()
+        self._steps = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._steps = json.load(f).get("steps", {})
+
+    def is_forced(self, step: str) -> bool:
+        # "all", the exact name, or a prefix ending at a word boundary ("1b" -> "1b_post_processing", not "1" -> "10")
+        return any(
+            f == "all" or step == f or (step.startswith(f) and not step[len(f)].isalnum())
+            for f in self.force_steps
+        )
+
+    def check(self, step: str, parts: dict, outputs_exist: bool = True) -> tuple[bool, str]:
+        """(skip?, reason) for a step about to run with input fingerprint `parts`."""
+        if self.is_forced(step):
+            return False, "forced"
+        with self._lock:
+            prev = self._steps.get(step)
+        if prev is None:
+            return False, "no previous run"
+
+        old = prev.get("parts", {})
+        changed = sorted(k for k in set(old) | set(parts) if old.get(k) != parts.get(k))
+        if changed:
+            return False, "changed: " + ", ".join(changed)
+        if not outputs_exist:
+            return False, "outputs missing"
+        return True, f"unchanged since {prev.get('completed_at')}"
+
+    def record(self, step: str, parts: dict, seconds: float | None = None):
+        with self._lock:
+            self._steps[step] = {
+                "fingerprint": value_digest(parts),
+                "parts": parts,
+                "completed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "seconds": round(seconds, 3) if seconds is not None else None,
+            }
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"steps": self._steps}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,213 @@
+"""
+Per-row source fingerprints for the extraction stages.
+
+silver.source_fingerprints holds, per (stage, [index]), the fingerprint
+of the row as it was extracted (for 1a: utils/master_source.row_fingerprint,
+the model text plus the amounts) and the prompt version
+(LlmCacheNamespace.version) it was extracted with. A run stages the
+current (index, fingerprint) pairs into #fp_current and one FULL OUTER JOIN
+against the table classifies every row as new, changed (fingerprint or
+prompt version differs) or deleted (fingerprinted but gone from the source).
+The micro-batch daemon polls the same table, so it and 1a agree on what
+changed.
+
+A fingerprint may only be stored once its row is in silver: otherwise a
+failed post-processing step would leave rows that the next run skips as
+unchanged. The extraction stage therefore writes the fingerprints of the
+rows it extracted to <run>_pending_fingerprints.json, and 1b commits them
+after its MERGE and silver refresh succeed. Deleted rows are written to
+<run>_deleted_indexes.txt by the extraction stage and removed from the
+silver tables (DELETION_PROPAGATION_CONFIG) by 1b, which then forgets their
+fingerprints; the daemon does both itself for the deletions it sees.
+"""
+import json
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import text as sql_text
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.app_config import DELETION_PROPAGATION_CONFIG
+from utils.bulk_writer import bulk_write
+from utils.db import require_mssql
+from utils.extraction_helpers import stage_key_table
+
+
+FINGERPRINT_TABLE = "silver.source_fingerprints"
+
+
+def ensure_fingerprint_table(conn):
+    require_mssql(conn, "source_fingerprints")
+    conn.execute(sql_text(f"""
+        IF OBJECT_ID('{FINGERPRINT_TABLE}') IS NULL
+        CREATE TABLE {FINGERPRINT_TABLE} (
+            stage NVARCHAR(64) NOT NULL,
+            [index] NVARCHAR(255) NOT NULL,
+            text_hash CHAR(64) NOT NULL,
+            prompt_version CHAR(64) NOT NULL,
+            updated_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+            CONSTRAINT pk_source_fingerprints PRIMARY KEY (stage, [index])
+        );
+    """))
+
+
+def _stage_hashes(conn, table: str, hashes: dict[str, str]):
+    conn.execute(sql_text(f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table};"))
+    conn.execute(sql_text(f"CREATE TABLE {table} ([index] NVARCHAR(255) NOT NULL PRIMARY KEY, text_hash CHAR(64) NOT NULL);"))
+    if hashes:
+        bulk_write(
+            pd.DataFrame({"index": list(hashes.keys()), "text_hash": list(hashes.values())}),
+            table, conn, if_exists="append",
+        )
+
+
+def diff_fingerprints(
+    engine,
+    stage: str,
+    current: dict[str, str],
+    prompt_version: str,
+    detect_deletions: bool = True,
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    (new, changed, deleted) indexes of `current` ({index: text_hash}) against
+    the stored fingerprints of `stage`. Pass detect_deletions=False when
+    `current` is only part of the source (e.g. an --ids-file batch).
+    """
+    join = "FULL OUTER JOIN" if detect_deletions else "LEFT JOIN"
+
+    with engine.begin() as conn:
+        ensure_fingerprint_table(conn)
+        _stage_hashes(conn, "#fp_current", current)
+        rows = conn.execute(sql_text(f"""
+            SELECT change, [index]
+            FROM (
+                SELECT
+                    COALESCE(C.[index], F.[index] COLLATE DATABASE_DEFAULT) AS [index],
+                    CASE
+                        WHEN F.[index] IS NULL THEN 'new'
+                        WHEN C.[index] IS NULL THEN 'deleted'
+                        WHEN F.text_hash <> C.text_hash COLLATE DATABASE_DEFAULT
+                          OR F.prompt_version <> :prompt_version THEN 'changed'
+                    END AS change
+                FROM #fp_current AS C
+                {join} (
+                    SELECT [index], text_hash, prompt_version
+                    FROM {FINGERPRINT_TABLE}
+                    WHERE stage = :stage
+                ) AS F
+                    ON F.[index] COLLATE DATABASE_DEFAULT = C.[index] COLLATE DATABASE_DEFAULT
+            ) AS d
+            WHERE change IS NOT NULL;
+        """), {"stage": stage, "prompt_version": prompt_version}).fetchall()
+
+    out = {"new": [], "changed": [], "deleted": []}
+    for change, index in rows:
+        out[change].append(index)
+    return out["new"], out["changed"], out["deleted"]
+
+
+def count_fingerprints(engine, stage: str) -> int:
+    with engine.begin() as conn:
+        ensure_fingerprint_table(conn)
+        return conn.execute(
+            sql_text(f"SELECT COUNT_BIG(*) FROM {FINGERPRINT_TABLE} WHERE stage = :stage;"),
+            {"stage": stage},
+        ).scalar()
+
+
+def commit_fingerprints(engine, stage: str, hashes: dict[str, str], prompt_version: str):
+    """Upsert the fingerprints of rows whose extraction has been written."""
+    if not hashes:
+        return
+    with engine.begin() as conn:
+        ensure_fingerprint_table(conn)
+        _stage_hashes(conn, "#fp_done", hashes)
+        conn.execute(sql_text(f"""
+            DELETE F
+            FROM {FINGERPRINT_TABLE} AS F
+            INNER JOIN #fp_done AS D
+                ON F.[index] COLLATE DATABASE_DEFAULT = D.[index] COLLATE DATABASE_DEFAULT
+            WHERE F.stage = :stage;
+
+            INSERT INTO {FINGERPRINT_TABLE} (stage, [index], text_hash, prompt_version)
+            SELECT :stage, D.[index], D.text_hash, :prompt_version
+            FROM #fp_done AS D;
+        """), {"stage": stage, "prompt_version": prompt_version})
+
+
+def write_pending_fingerprints(path: Path, stage: str, hashes: dict[str, str], prompt_version: str):
+    """Replace the run's pending fingerprint file (committed later by commit_pending_fingerprints)."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"stage": stage, "prompt_version": prompt_version, "hashes": hashes}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def commit_pending_fingerprints(engine, path: Path, indexes=None) -> int:
+    """
+    Commit the fingerprints of a pending file (only `indexes`, if given) and
+    remove the file. Call once the rows are in silver. Returns the number
+    committed.
+    """
+    path = Path(path)
+    if not path.exists():
+        return 0
+    with open(path, encoding="utf-8") as f:
+        pending = json.load(f)
+
+    hashes = pending["hashes"]
+    if indexes is not None:
+        hashes = {k: h for k, h in hashes.items() if k in indexes}
+    commit_fingerprints(engine, pending["stage"], hashes, pending["prompt_version"])
+    path.unlink()
+    return len(hashes)
+
+
+def forget_fingerprints(conn, stage: str, indexes):
+    """Drop fingerprints (after their rows were deleted downstream). Uses #del_idx."""
+    stage_key_table(conn, "#del_idx", indexes, column="index")
+    conn.execute(sql_text(f"""
+        DELETE F
+        FROM {FINGERPRINT_TABLE} AS F
+        INNER JOIN #del_idx AS D
+            ON F.[index] COLLATE DATABASE_DEFAULT = D.[index] COLLATE DATABASE_DEFAULT
+        WHERE F.stage = :stage;
+    """), {"stage": stage})
+
+
+def propagate_deletions(conn, indexes) -> dict[str, int]:
+    """
+    Delete rows of source indexes that no longer exist from every table in
+    DELETION_PROPAGATION_CONFIG. Tables keyed by project_code are resolved
+    through MasterTable_extracted first, so they are handled before it.
+    Missing tables are skipped. Returns rows deleted per table.
+    """
+    stage_key_table(conn, "#del_idx", indexes, column="index")
+    conn.execute(sql_text("IF OBJECT_ID('tempdb..#del_pc') IS NOT NULL DROP TABLE #del_pc;"))
+    conn.execute(sql_text(f"""
+        SELECT DISTINCT CAST(M.project_code AS NVARCHAR(255)) AS project_code
+        INTO #del_pc
+        FROM {DELETION_PROPAGATION_CONFIG['project_code_source']} AS M
+        INNER JOIN #del_idx AS D
+            ON CAST(M.[index] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT = D.[index] COLLATE DATABASE_DEFAULT
+        WHERE M.project_code IS NOT NULL;
+    """))
+
+    deleted = {}
+    for target in DELETION_PROPAGATION_CONFIG["targets"]:
+        table, key = target["table"], target["key"]
+        keys_table, keys_col = ("#del_idx", "index") if key == "index" else ("#del_pc", "project_code")
+        res = conn.execute(sql_text(f"""
+            IF OBJECT_ID('{table}') IS NOT NULL
+            DELETE T
+            FROM {table} AS T
+            INNER JOIN {keys_table} AS K
+                ON CAST(T.[{key}] AS NVARCHAR(255)) COLLATE DATABASE_DEFAULT
+                 = K.[{keys_col}] COLLATE DATABASE_DEFAULT;
+        """))
+        deleted[table] = max(res.rowcount, 0)
+    return deleted
@@ -0,0 +1,187 @@
+"""
+Staged MERGE upserts into SQL Server tables.
+
+The batch is bulk-loaded into a #temp staging table created from the
+target's own column definitions (SELECT TOP 0 ... INTO), so staging and
+target share types and collations and the MERGE join needs no CAST /
+COLLATE. One MERGE per batch, in the caller's transaction, then applies
+it and its OUTPUT $action rows are counted.
+
+Two modes:
+  - key_columns only: rows are matched on the target's primary key; changed
+    matches are updated, new keys inserted (1d).
+  - scope_columns (+ key_columns): the target rows of every scope value in
+    the batch (or in a staged scope table) are brought in line with the
+    batch rows, for tables without a unique row key, e.g.
+    MasterTable_extracted with several rows per [index] (1b) or
+    cleaned_project_attributes per run index (2b). Within the scope rows
+    are paired on the key columns (NULLs match NULLs; repeated keys are
+    paired in order of their values): unchanged pairs are left alone,
+    changed ones updated, unpaired batch rows inserted and unpaired target
+    rows deleted.
+
+A matched row only counts as changed when a column outside the key and
+`ignore_columns` (e.g. ts_inserted) differs.
+"""
+import pandas as pd
+from sqlalchemy import text as sql_text
+
+from utils.bulk_writer import bulk_write
+from utils.db import require_mssql
+
+
+def _q(col: str) -> str:
+    return f"[{col}]"
+
+
+def table_exists(conn, target: str) -> bool:
+    return conn.execute(sql_text("SELECT OBJECT_ID(:t, N'U')"), {"t": target}).scalar() is not None
+
+
+def create_typed_staging(conn, target: str, columns: list[str], table: str) -> None:
+    """(Re)create #table with the target's definitions of `columns`."""
+    require_mssql(conn, "sql_upsert")
+    conn.execute(sql_text(f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table};"))
+    conn.execute(sql_text(f"SELECT TOP 0 {', '.join(_q(c) for c in columns)} INTO {table} FROM {target};"))
+
+
+def stage_dataframe(conn, df: pd.DataFrame, target: str, table: str = "#stg_upsert", chunksize: int = 2000) -> None:
+    create_typed_staging(conn, target, list(df.columns), table)
+    if not df.empty:
+        bulk_write(df, table, conn, if_exists="append", batch_rows=chunksize)
+
+
+def stage_keys(conn, target: str, column: str, keys, table: str = "#scope_keys") -> None:
+    """Typed one-column key table, e.g. the run's indexes as a replace scope."""
+    create_typed_staging(conn, target, [column], table)
+    values = sorted({str(k).strip() for k in keys if k is not None and str(k).strip()})
+    if values:
+        bulk_write(pd.DataFrame({column: values}), table, conn, if_exists="append")
+
+
+def _null_safe_eq(left: str, right: str, col: str) -> str:
+    return f"({left}.{_q(col)} = {right}.{_q(col)} OR ({left}.{_q(col)} IS NULL AND {right}.{_q(col)} IS NULL))"
+
+
+def merge_staged(
+    conn,
+    staging: str,
+    target: str,
+    columns: list[str],
+    *,
+    key_columns: list[str] | None = None,
+    scope_columns: list[str] | None = None,
+    scope_table: str | None = None,
+    ignore_columns: list[str] | None = None,
+) -> dict[str, int]:
+    """
+    MERGE `staging` into `target` (see module docstring for the two modes).
+    Returns {"inserted", "updated", "deleted"} row counts.
+    """
+    if not key_columns and not scope_columns:
+        raise ValueError("Pass key_columns, or scope_columns with the key columns within the scope")
+    if scope_columns and not key_columns:
+        raise ValueError("scope_columns needs key_columns to pair the rows within a scope")
+
+    cols = ", ".join(_q(c) for c in columns)
+    src_cols = ", ".join(f"S.{_q(c)}" for c in columns)
+
+    key_columns = list(scope_columns or []) + [c for c in key_columns if c not in (scope_columns or [])]
+    set_cols = [c for c in columns if c not in key_columns]
+    compare_cols = [c for c in set_cols if c not in (ignore_columns or [])]
+
+    when_matched = ""
+    if set_cols:
+        changed = ""
+        if compare_cols:
+            # EXCEPT compares NULLs as equal
+            changed = (
+                f"AND EXISTS (SELECT {', '.join(f'S.{_q(c)}' for c in compare_cols)} "
+                f"EXCEPT SELECT {', '.join(f'T.{_q(c)}' for c in compare_cols)})"
+            )
+        when_matched = (
+            f"WHEN MATCHED {changed} THEN UPDATE SET {', '.join(f'T.{_q(c)} = S.{_q(c)}' for c in set_cols)}"
+        )
+
+    if not scope_columns:
+        on = " AND ".join(f"T.{_q(c)} = S.{_q(c)}" for c in key_columns)
+        cte = ""
+        merge_target = f"{target} AS T"
+        source = f"{staging} AS S"
+        tail = ""
+    else:
+        # only the scoped slice of the target takes part. MERGE accepts a
+        # (single-table, hence updatable) CTE as target, not a derived
+        # table. Rows sharing a key are numbered on both sides, ordered by
+        # their values, so identical duplicates pair up with each other.
+        scope_src = scope_table or staging
+        scope_match = " AND ".join(f"X.{_q(c)} = D.{_q(c)}" for c in scope_columns)
+        partition = ", ".join(_q(c) for c in key_columns)
+        order = ", ".join(_q(c) for c in compare_cols) or "(SELECT NULL)"
+        dup = f"ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {order}) AS [_dup]"
+        cte = f"""WITH T AS (
+            SELECT D.*, {dup} FROM {target} AS D
+            WHERE EXISTS (SELECT 1 FROM {scope_src} AS X WHERE {scope_match})
+        )"""
+        merge_target = "T"
+        source = f"(SELECT {cols}, {dup} FROM {staging}) AS S"
+        on = " AND ".join([_null_safe_eq("T", "S", c) for c in key_columns] + ["T.[_dup] = S.[_dup]"])
+        tail = "WHEN NOT MATCHED BY SOURCE THEN DELETE"
+
+    conn.execute(sql_text("IF OBJECT_ID('tempdb..#merge_actions') IS NOT NULL DROP TABLE #merge_actions;"))
+    conn.execute(sql_text("CREATE TABLE #merge_actions (action NVARCHAR(10) NOT NULL);"))
+    conn.execute(sql_text(f"""
+        {cte}
+        MERGE {merge_target}
+        USING {source}
+            ON {on}
+        {when_matched}
+        WHEN NOT MATCHED BY TARGET THEN INSERT ({cols}) VALUES ({src_cols})
+        {tail}
+        OUTPUT $action INTO #merge_actions (action);
+    """))
+
+    counts = dict(conn.execute(sql_text("SELECT action, COUNT(*) FROM #merge_actions GROUP BY action;")).fetchall())
+    return {
+        "inserted": int(counts.get("INSERT", 0)),
+        "updated": int(counts.get("UPDATE", 0)),
+        "deleted": int(counts.get("DELETE", 0)),
+    }
+
+
+def upsert_dataframe(
+    engine,
+    df: pd.DataFrame,
+    target: str,
+    *,
+    key_columns: list[str] | None = None,
+    scope_columns: list[str] | None = None,
+    ignore_columns: list[str] | None = None,
+    dtype: dict | None = None,
+    chunksize: int = 2000,
+) -> dict[str, int]:
+    """
+    Stage `df` and MERGE it into `target` ("schema.table") in one
+    transaction. A missing target is created from df's columns and dtype.
+    """
+    schema, table = target.split(".", 1)
+
+    with engine.begin() as conn:
+        if not table_exists(conn, target):
+            print(f"[INFO] Target table does not exist. Creating: {target}")
+            df.head(0).to_sql(table, conn, schema=schema, if_exists="fail", index=False, dtype=dtype)
+
+        stage_dataframe(conn, df, target, chunksize=chunksize)
+        return merge_staged(
+            conn,
+            "#stg_upsert",
+            target,
+            list(df.columns),
+            key_columns=key_columns,
+            scope_columns=scope_columns,
+            ignore_columns=ignore_columns,
+        )
+
+
+def format_counts(counts: dict) -> str:
+    return f"inserted={counts['inserted']} | updated={counts['updated']} | deleted={counts['deleted']}"
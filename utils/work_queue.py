@@ -0,0 +1,216 @@
+"""
+Durable local work queue (SQLite) for multi-process extraction.
+
+A coordinator enqueues items (key + JSON payload); worker processes, on
+this host or on other hosts sharing the filesystem, lease a few items at a
+time, process them and mark them done. A lease that is not completed
+before it expires (worker crashed / host lost) becomes leasable again, so
+nothing is lost; an item that keeps failing is parked as 'failed' after
+max_attempts and requeued on the next coordinator start.
+
+Leasing runs in a BEGIN IMMEDIATE transaction, so two workers never hold
+the same item at once. SQLite locking over network filesystems (SMB/NFS)
+depends on the filesystem honouring byte-range locks; keep the queue on
+storage that does (a local disk for single-host runs).
+
+Workers renew their leases while they work (LeaseHeartbeat), so a batch
+that takes longer than the lease is not handed to a second worker; a lease
+only expires once its worker stops renewing it.
+
+Only 1a uses the queue (--role coordinator / worker); 1c and 2a run as
+one process each.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, path: Path, max_attempts: int = 3):
+        self.path = Path(path)
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            "  key TEXT PRIMARY KEY,"
+            "  payload TEXT NOT NULL,"
+            "  status TEXT NOT NULL,"
+            "  worker TEXT,"
+            "  lease_until REAL,"
+            "  attempts INTEGER NOT NULL DEFAULT 0,"
+            "  error TEXT,"
+            "  updated_at REAL NOT NULL"
+            ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_work_items_status ON work_items(status, lease_until)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit; transactions are opened explicitly where they matter
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -------- coordinator --------
+    def enqueue(self, items) -> int:
+        """Add (key, payload) items; keys already queued (any status) are left alone."""
+        now = time.time()
+        conn = self._conn()
+        before = conn.total_changes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO work_items (key, payload, status, attempts, updated_at) "
+                "VALUES (?, ?, ?, 0, ?)",
+                ((key, json.dumps(payload, ensure_ascii=False, default=str), PENDING, now) for key, payload in items),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return conn.total_changes - before
+
+    def requeue_failed(self) -> int:
+        cur = self._conn().execute(
+            "UPDATE work_items SET status = ?, attempts = 0, error = NULL, updated_at = ? WHERE status = ?",
+            (PENDING, time.time(), FAILED),
+        )
+        return cur.rowcount
+
+    def counts(self) -> dict:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM work_items GROUP BY status").fetchall()
+        out = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        out.update(dict(rows))
+        return out
+
+    def drained(self) -> bool:
+        c = self.counts()
+        return c[PENDING] == 0 and c[LEASED] == 0
+
+    def iter_done(self):
+        """(key, payload) of every finished item."""
+        for key, payload in self._conn().execute("SELECT key, payload FROM work_items WHERE status = ?", (DONE,)):
+            yield key, json.loads(payload)
+
+    def failed_keys(self) -> list[str]:
+        return [r[0] for r in self._conn().execute("SELECT key FROM work_items WHERE status = ?", (FAILED,))]
+
+    # -------- worker --------
+    def lease(self, worker_id: str, n: int, lease_s: float) -> list[tuple[str, dict]]:
+        """Lease up to n pending (or lease-expired) items for lease_s seconds."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT key, payload FROM work_items "
+                "WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ? "
+                "ORDER BY rowid LIMIT ?",
+                (PENDING, LEASED, now, self.max_attempts, n),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work_items SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE key = ?",
+                ((LEASED, worker_id, now + lease_s, now, key) for key, _ in rows),
+            )
+            # expired leases that used up their attempts
+            conn.execute(
+                "UPDATE work_items SET status = ?, error = COALESCE(error, 'lease expired'), updated_at = ? "
+                "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def extend(self, keys, worker_id: str, lease_s: float) -> int:
+        """Push the lease of `keys` still held by worker_id to now + lease_s; returns how many were renewed."""
+        now = time.time()
+        conn = self._conn()
+        before = conn.total_changes
+        conn.executemany(
+            "UPDATE work_items SET lease_until = ?, updated_at = ? WHERE key = ? AND status = ? AND worker = ?",
+            ((now + lease_s, now, k, LEASED, worker_id) for k in keys),
+        )
+        return conn.total_changes - before
+
+    def complete(self, key: str, worker_id: str) -> bool:
+        """Mark done. False if the lease had expired and moved to another worker."""
+        cur = self._conn().execute(
+            "UPDATE work_items SET status = ?, lease_until = NULL, error = NULL, updated_at = ? "
+            "WHERE key = ? AND status = ? AND worker = ?",
+            (DONE, time.time(), key, LEASED, worker_id),
+        )
+        return cur.rowcount == 1
+
+    def fail(self, key: str, worker_id: str, error: str):
+        """Release a lease after an error: back to pending, or failed once attempts run out."""
+        self._conn().execute(
+            "UPDATE work_items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+            "lease_until = NULL, error = ?, updated_at = ? "
+            "WHERE key = ? AND status = ? AND worker = ?",
+            (self.max_attempts, FAILED, PENDING, error[:2000], time.time(), key, LEASED, worker_id),
+        )
+
+
+class LeaseHeartbeat:
+    """
+    Background thread renewing a worker's open leases every lease_s / 3
+    seconds while the `with` block runs. keys_fn() returns the keys still
+    being worked on (completed items drop out of it).
+    """
+
+    def __init__(self, queue: WorkQueue, worker_id: str, lease_s: float, keys_fn):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.lease_s = lease_s
+        self.keys_fn = keys_fn
+        self.interval = max(1.0, lease_s / 3)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            keys = list(self.keys_fn())
+            if not keys:
+                continue
+            try:
+                renewed = self.queue.extend(keys, self.worker_id, self.lease_s)
+            except sqlite3.Error as e:
+                print(f"[worker {self.worker_id}] lease renewal failed ({e}); retrying in {self.interval:.0f}s")
+                continue
+            if renewed < len(keys):
+                print(f"[worker {self.worker_id}] {len(keys) - renewed} leases were lost before renewal")
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f"lease-heartbeat-{self.worker_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False